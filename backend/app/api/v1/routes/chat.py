@@ -1,7 +1,12 @@
 ﻿"""
 Chat API endpoints
 """
-from fastapi import APIRouter, HTTPException, status
+import json
+from typing import AsyncIterator, Dict
+from uuid import uuid4
+from fastapi import APIRouter, BackgroundTasks, HTTPException, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from app.models.chat import ChatRequest, ChatResponse, ErrorResponse
 from app.services.chat_service import chat_service
 from app.utils.logger import get_logger
@@ -12,7 +17,7 @@ router = APIRouter(prefix="/chat", tags=["chat"])
 
 
 @router.post("/", response_model=ChatResponse, status_code=status.HTTP_200_OK)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, background_tasks: BackgroundTasks):
     """
     Send a message and get AI response
     
@@ -31,6 +36,8 @@ async def chat(request: ChatRequest):
             context=request.context
         )
         
+        # Fold older turns into the session summary after the response is sent
+        background_tasks.add_task(chat_service.summarize_session, response.session_id)
         return response
         
     except Exception as e:
@@ -41,6 +48,42 @@ async def chat(request: ChatRequest):
         )
 
 
+@router.post("/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Send a message and stream the AI response as server-sent events
+    
+    - **message**: User message (required)
+    - **session_id**: Optional session ID for conversation continuity
+    - **context**: Optional additional context
+    
+    Emits a `meta` event (session_id, sources, method), then `token` events
+    as the answer is generated, and a final `done` event (or `error`)
+    """
+    logger.info(f"Received stream request: '{request.message[:50]}...'")
+    
+    session_id = request.session_id or str(uuid4())
+    events = chat_service.stream_message(
+        message=request.message,
+        session_id=session_id,
+        context=request.context
+    )
+    
+    return StreamingResponse(
+        _to_sse(events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(chat_service.summarize_session, session_id)
+    )
+
+
+async def _to_sse(events: AsyncIterator[Dict]) -> AsyncIterator[str]:
+    """Format service events as server-sent events"""
+    async for event in events:
+        event_type = event.pop("type")
+        yield f"event: {event_type}\ndata: {json.dumps(event, default=str)}\n\n"
+
+
 @router.get("/history/{session_id}")
 async def get_chat_history(session_id: str):
     """
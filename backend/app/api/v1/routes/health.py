@@ -4,6 +4,7 @@ Health check endpoints
 from fastapi import APIRouter
 from datetime import datetime
 from app.config import settings
+from app.utils.metrics import metrics
 
 router = APIRouter(prefix="/health", tags=["health"])
 
@@ -43,3 +44,15 @@ async def detailed_health_check():
     # For now, return optimistic status
     
     return health_status
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """
+    Runtime metrics
+    Returns counters, gauges and latency percentiles
+    """
+    return {
+        "timestamp": datetime.now().isoformat(),
+        **metrics.snapshot()
+    }
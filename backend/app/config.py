@@ -4,7 +4,7 @@ Loads environment variables and provides settings throughout the app
 """
 from pydantic_settings import BaseSettings
 from functools import lru_cache
-from typing import Optional
+from typing import List, Optional
 
 
 class Settings(BaseSettings):
@@ -24,29 +24,133 @@ class Settings(BaseSettings):
     REDIS_URL: str = "redis://localhost:6379"
     
     # Vector Database
+    VECTOR_BACKEND: str = "qdrant"  # qdrant or local
     VECTOR_DB_URL: str = "http://localhost:6333"
     VECTOR_DB_COLLECTION: str = "bank_documents"
+    QDRANT_ASYNC: bool = True
+    VECTOR_PAYLOAD_INDEXES: List[str] = ["doc_type", "source"]
+    VECTOR_UPSERT_BATCH_SIZE: int = 256
+    VECTOR_UPSERT_PARALLELISM: int = 4
+    LOCAL_VECTOR_PATH: str = "../data/embeddings"
+    LOCAL_VECTOR_INDEX: str = "exact"  # exact or ivf
+    LOCAL_VECTOR_COMPACT_RATIO: float = 0.5  # compact payloads.bin after ingestion once this share is dead
+    IVF_NLIST: int = 0  # 0 = 4 * sqrt(vector count)
+    IVF_NPROBE: int = 8
+    IVF_MIN_TRAIN_SIZE: int = 10000
     
     # Embedding Model
     EMBEDDING_MODEL: str = "sentence-transformers/all-MiniLM-L6-v2"
     EMBEDDING_DIMENSION: int = 384
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 10000
+    EMBEDDING_CACHE_MAX_BYTES: int = 32 * 1024 * 1024  # 32 MB
+    EMBEDDING_BATCH_MAX_SIZE: int = 32
+    EMBEDDING_BATCH_WAIT_MS: float = 3.0
+    EMBEDDING_SERVER_SOCKET: Optional[str] = None  # e.g. /tmp/bank-embeddings.sock
+    EMBEDDING_SERVER_TIMEOUT: float = 10.0  # seconds
     
     # RAG Settings
     CHUNK_SIZE: int = 512
     CHUNK_OVERLAP: int = 50
-    TOP_K_RESULTS: int = 5
-    RERANK_TOP_K: int = 5
+    TOP_K_RESULTS: int = 20  # candidates retrieved per query before reranking
+    RERANK_TOP_K: int = 5  # chunks kept after reranking
     SIMILARITY_THRESHOLD: float = 0.7
+    RRF_K: int = 60  # reciprocal-rank fusion damping constant
+    KEYWORD_INDEX_PATH: str = "../data/processed/keyword_index.json"
+    BM25_K1: float = 1.5
+    BM25_B: float = 0.75
+    HYBRID_VECTOR_WEIGHT: float = 1.0  # RRF weight of vector result lists
+    HYBRID_KEYWORD_WEIGHT: float = 1.0  # RRF weight of BM25 result lists
+    RERANKER_ENABLED: bool = True
+    RERANKER_MODEL: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    RERANKER_MAX_LENGTH: int = 512
+    RERANKER_BUDGET_MS: float = 200.0  # fall back to fused order past this
+    RERANKER_CACHE_MAX_ENTRIES: int = 50000
+    RERANKER_BATCH_MAX_SIZE: int = 64  # pairs per cross-encoder pass, across concurrent requests
+    RERANKER_BATCH_WAIT_MS: float = 5.0
+    MMR_ENABLED: bool = True
+    MMR_LAMBDA: float = 0.7  # 1.0 = relevance only, lower = more diverse
+    DUPLICATE_THRESHOLD: float = 0.95  # cosine similarity of near-duplicate chunks
+    RETRIEVAL_CACHE_ENABLED: bool = True
+    RETRIEVAL_CACHE_MAX_ENTRIES: int = 2000
+    RETRIEVAL_CACHE_TTL: int = 3600  # 1 hour
+    RETRIEVAL_CACHE_REDIS: bool = False  # share ranked results across workers
+    CORPUS_VERSION_PATH: str = "../data/processed/corpus_version"
+    CORPUS_VERSION_REFRESH: float = 1.0  # seconds a resolved corpus version is reused in-process
+    CORPUS_VERSION_REDIS_BACKOFF: float = 60.0  # seconds to skip Redis after a failed read
+    SENTENCE_STORE_PATH: str = "../data/processed/sentences"
+    CONTEXT_COMPRESSION_ENABLED: bool = True
+    COMPRESSION_MAX_SENTENCES: int = 4  # sentences kept per chunk
+    COMPRESSION_MIN_SIMILARITY: float = 0.25  # below this only the best sentence is kept
     
     # LLM Settings
     GROQ_MODEL: str = "llama-3.3-70b-versatile"
     MAX_TOKENS: int = 2000
+    CONTEXT_TOKEN_BUDGET: int = 1500  # prompt tokens for documents, web results and history
+    CONTEXT_ITEM_MAX_TOKENS: int = 300  # per document, web result or history message
+    CONTEXT_TOKENIZER: Optional[str] = None  # HF tokenizer matching GROQ_MODEL; None = ~4 chars/token
+    CONTEXT_ESTIMATE_MARGIN: float = 1.25  # scales estimated counts up; Llama 3 runs below 4 chars/token on numbers and codes
+    TOKEN_COUNT_CACHE_MAX_ENTRIES: int = 10000
     TEMPERATURE: float = 0.7
+    GROQ_MAX_CONNECTIONS: int = 100
+    GROQ_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    GROQ_KEEPALIVE_EXPIRY: float = 30.0  # seconds
+    GROQ_CONNECT_TIMEOUT: float = 5.0  # seconds
+    GROQ_READ_TIMEOUT: float = 60.0  # seconds
+    
+    # LLM Rate Limiting (client-side, shared by every Groq call in a worker)
+    LLM_RATE_LIMIT_ENABLED: bool = True
+    GROQ_REQUESTS_PER_MINUTE: int = 30
+    GROQ_TOKENS_PER_MINUTE: int = 12000
+    LLM_QUEUE_MAX_SIZE: int = 100
+    LLM_QUEUE_MAX_WAIT: float = 15.0  # seconds an interactive request may queue
+    LLM_BACKGROUND_MAX_WAIT: float = 120.0  # seconds for summaries and cache warmers
+    LLM_MAX_RETRIES: int = 2  # on 429, connection errors and 5xx
+    LLM_RETRY_BACKOFF: float = 1.0  # seconds, doubled per retry; 429s prefer retry-after
+    
+    # LLM Hedging (interactive, non-streaming completions)
+    LLM_HEDGE_ENABLED: bool = True
+    LLM_FALLBACK_MODEL: Optional[str] = "llama-3.1-8b-instant"  # hedge target; None = GROQ_MODEL
+    LLM_HEDGE_PERCENTILE: float = 95.0  # hedge once a call outlives this latency percentile
+    LLM_HEDGE_MIN_SAMPLES: int = 20  # observed latencies needed before the percentile is trusted
+    LLM_HEDGE_DEFAULT_DELAY: float = 4.0  # seconds, until enough samples exist
+    LLM_HEDGE_MIN_DELAY: float = 0.5  # seconds
+    LLM_HARD_DEADLINE: float = 20.0  # seconds; then a degraded answer is returned
     
     # Search Settings
     TAVILY_MAX_RESULTS: int = 5
     SEARCH_CACHE_TTL: int = 3600  # 1 hour
     
+    # Request Coalescing (single-flight for identical in-flight LLM and search calls)
+    SINGLEFLIGHT_ENABLED: bool = True
+    SINGLEFLIGHT_REDIS: bool = False  # also coordinate across workers through Redis
+    SINGLEFLIGHT_LOCK_TTL: float = 30.0  # seconds; followers run the call themselves after this
+    SINGLEFLIGHT_RESULT_TTL: float = 5.0  # seconds a leader's result stays readable for followers
+    SINGLEFLIGHT_POLL_INTERVAL: float = 0.05  # seconds
+    
+    # Orchestration Settings
+    HYBRID_RAG_TIMEOUT: float = 3.0  # seconds
+    HYBRID_SEARCH_TIMEOUT: float = 5.0  # seconds
+    
+    # Tool Calling
+    TOOL_CALLING_ENABLED: bool = False  # opt-in: hybrid questions on /chat/ take 2+ sequential completions
+    TOOL_TIMEOUT: float = 5.0  # seconds, for tools without their own timeout
+    TOOL_RESULT_MAX_CHARS: int = 4000  # JSON characters of one tool result sent back to the model
+    TOOL_MAX_ROUNDS: int = 3  # tool-calling completions before answering from the results so far
+    
+    # Semantic Answer Cache
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_MAX_DISTANCE: float = 0.08  # cosine distance to a cached question
+    ANSWER_CACHE_TTL: int = 3600  # 1 hour
+    ANSWER_CACHE_MAX_ENTRIES: int = 1000
+    ANSWER_CACHE_ROUTES: List[str] = ["rag", "hybrid"]  # never escalate or temporal search
+    
+    # Conversation Memory Settings
+    SUMMARY_ENABLED: bool = True
+    SUMMARY_WINDOW_MESSAGES: int = 6  # unsummarized messages sent verbatim; folding starts past this
+    SUMMARY_KEEP_MESSAGES: int = 2  # recent messages left verbatim after a fold
+    SUMMARY_MAX_WORDS: int = 120
+    SUMMARY_MAX_TOKENS: int = 256
+    
     # Security
     SECRET_KEY: str = "your-secret-key-change-this-in-production"
     ALGORITHM: str = "HS256"
@@ -0,0 +1,179 @@
+﻿"""
+Token-budgeted prompt context
+Fills a fixed model-token budget with sentence-aligned extracts of retrieved
+documents, web results and conversation history, in that priority order
+"""
+import hashlib
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+from app.config import settings
+from app.utils.cache import LRUCache
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+
+class TokenCounter:
+    """
+    Counts model tokens
+
+    Uses the Hugging Face tokenizer named by CONTEXT_TOKENIZER (one matching
+    GROQ_MODEL) when available, otherwise estimates ~4 characters per token
+    scaled up by CONTEXT_ESTIMATE_MARGIN, so an estimated budget errs on the
+    short side. Sentence splits and counts are cached per chunk text.
+    """
+
+    def __init__(self, tokenizer_name: Optional[str] = None, margin: Optional[float] = None):
+        self.tokenizer = None
+        self.margin = margin if margin is not None else settings.CONTEXT_ESTIMATE_MARGIN
+        name = tokenizer_name or settings.CONTEXT_TOKENIZER
+        if name:
+            try:
+                from tokenizers import Tokenizer
+
+                self.tokenizer = Tokenizer.from_pretrained(name)
+                logger.info(f"Counting context tokens with {name}")
+            except Exception as e:
+                logger.warning(f"Could not load tokenizer {name}: {e}. Estimating token counts.")
+        self.cache = LRUCache(name="token_count", max_entries=settings.TOKEN_COUNT_CACHE_MAX_ENTRIES)
+
+    def count(self, text: str) -> int:
+        """Number of tokens in text"""
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+        return math.ceil(len(text) / 4 * self.margin)
+
+    def sentences(self, text: str) -> List[Tuple[str, int]]:
+        """Sentences of text with their token counts (cached by text hash)"""
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        cached = self.cache.get(key)
+        if cached is None:
+            sentences = [s.strip() for s in SENTENCE_BOUNDARY.split(text) if s.strip()]
+            cached = [(sentence, self.count(sentence)) for sentence in sentences]
+            self.cache.set(key, cached)
+        return cached
+
+
+class ContextPacker:
+    """Packs prompt context into CONTEXT_TOKEN_BUDGET tokens"""
+
+    def __init__(
+        self,
+        budget: Optional[int] = None,
+        item_max_tokens: Optional[int] = None,
+        counter: Optional[TokenCounter] = None
+    ):
+        """
+        Args:
+            budget: Tokens available for context (system prompt and question excluded)
+            item_max_tokens: Cap per document, web result or history message
+            counter: Token counter (defaults to one for CONTEXT_TOKENIZER)
+        """
+        self.budget = budget or settings.CONTEXT_TOKEN_BUDGET
+        self.item_max_tokens = item_max_tokens or settings.CONTEXT_ITEM_MAX_TOKENS
+        self.counter = counter or TokenCounter()
+
+    def pack(
+        self,
+        sections: List[Tuple[str, List[Dict]]],
+        history: Optional[List[Dict]] = None,
+        budget: Optional[int] = None
+    ) -> Dict:
+        """
+        Fill the budget section by section, then with the most recent history
+
+        Args:
+            sections: (name, items) in priority order; items are dicts with
+                "text" and an optional "header" (other keys are passed through)
+            history: Conversation messages (oldest first); a "system" message
+                holds the rolling conversation summary
+            budget: Override CONTEXT_TOKEN_BUDGET
+
+        Returns:
+            {"sections": {name: packed items}, "history": packed messages,
+             "tokens": {name: used, "history": used, "total": used, "budget": budget}}
+        """
+        budget = budget or self.budget
+        remaining = budget
+        packed, tokens = {}, {}
+
+        for name, items in sections:
+            packed[name], tokens[name] = [], 0
+            for item in items:
+                header_tokens = self.counter.count(item.get("header", ""))
+                room = min(self.item_max_tokens, remaining) - header_tokens
+                text, used = self._extract(item["text"], room)
+                if not text:
+                    continue
+                packed[name].append({**item, "text": text})
+                tokens[name] += header_tokens + used
+                remaining -= header_tokens + used
+
+        messages = [msg for msg in history or [] if isinstance(msg, dict) and "role" in msg and "content" in msg]
+        kept, tokens["history"] = [], 0
+        
+        # A rolling conversation summary (system message) goes in before the turns
+        summary = []
+        summaries = [msg for msg in messages if msg["role"] == "system"]
+        if summaries:
+            text, used = self._extract(summaries[-1]["content"] or "", min(self.item_max_tokens, remaining))
+            if text:
+                summary = [{"role": "system", "content": text}]
+                tokens["history"] += used
+                remaining -= used
+        
+        # Most recent turns first; stop at the first that no longer fits. There is
+        # no message cap: history holds only turns the summary does not cover yet
+        recent = [msg for msg in messages if msg["role"] != "system"]
+        for msg in reversed(recent):
+            text, used = self._extract(msg["content"] or "", min(self.item_max_tokens, remaining))
+            if not text:
+                break
+            kept.append({"role": msg["role"], "content": text})
+            tokens["history"] += used
+            remaining -= used
+
+        tokens["total"] = budget - remaining
+        tokens["budget"] = budget
+        metrics.observe("context_tokens", tokens["total"])
+        return {"sections": packed, "history": summary + list(reversed(kept)), "tokens": tokens}
+
+    def _extract(self, text: str, room: int) -> Tuple[str, int]:
+        """Leading whole sentences of text fitting in room tokens"""
+        if room <= 0 or not text:
+            return "", 0
+
+        selected, used = [], 0
+        for sentence, count in self.counter.sentences(text):
+            if used + count > room:
+                break
+            selected.append(sentence)
+            used += count
+
+        if not selected:
+            # A single over-long sentence: keep as many leading words as fit
+            return self._truncate_words(self.counter.sentences(text)[0][0], room)
+        return " ".join(selected), used
+
+    def _truncate_words(self, sentence: str, room: int) -> Tuple[str, int]:
+        """Longest word prefix of sentence within room tokens (binary search)"""
+        words = sentence.split()
+        low, high = 0, len(words)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.counter.count(" ".join(words[:mid])) <= room:
+                low = mid
+            else:
+                high = mid - 1
+        text = " ".join(words[:low])
+        return text, self.counter.count(text)
+
+
+# Global context packer
+context_packer = ContextPacker()
@@ -2,30 +2,119 @@
 Groq LLM Client
 Handles all interactions with Groq API for text generation
 """
-from groq import Groq
-from typing import List, Dict, Optional, AsyncIterator
+import asyncio
+import time
+import httpx
+from groq import APIConnectionError, APIStatusError, AsyncGroq, RateLimitError
+from typing import Any, Awaitable, Callable, List, Dict, Optional, AsyncIterator, Tuple
 import json
 from app.config import settings
+from app.core.llm.rate_limiter import LLMOverloadedError, Priority, rate_limiter
+from app.core.llm.response_parser import StreamingJSONParser, parse_json
 from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+from app.utils.singleflight import SingleFlight
 
 logger = get_logger(__name__)
 
 
+class LLMDeadlineExceeded(Exception):
+    """Raised when an interactive completion misses LLM_HARD_DEADLINE"""
+
+
 class GroqClient:
     """Client for interacting with Groq LLM API"""
     
     def __init__(self, api_key: Optional[str] = None):
-        """Initialize Groq client"""
+        """
+        Initialize async Groq client on a shared, bounded connection pool
+        
+        SDK retries are disabled: retries go back through the rate limiter so
+        they respect the shared budget and the provider's retry-after.
+        """
         self.api_key = api_key or settings.GROQ_API_KEY
-        self.client = Groq(api_key=self.api_key)
+        timeout = httpx.Timeout(settings.GROQ_READ_TIMEOUT, connect=settings.GROQ_CONNECT_TIMEOUT)
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.GROQ_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.GROQ_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.GROQ_KEEPALIVE_EXPIRY
+            ),
+            timeout=timeout
+        )
+        self.client = AsyncGroq(
+            api_key=self.api_key,
+            http_client=self.http_client,
+            timeout=timeout,
+            max_retries=0
+        )
         self.model = settings.GROQ_MODEL
+        self.limiter = rate_limiter
+        self.singleflight = SingleFlight("llm")
+        self.fallback_model = settings.LLM_FALLBACK_MODEL or self.model
+        self.completions = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+    
+    async def close(self):
+        """Close pooled HTTP connections"""
+        await self.client.close()
+    
+    async def _create(self, priority: Priority, model: Optional[str] = None, **params) -> Tuple[Any, int]:
+        """
+        Send a chat completion once the rate limiter admits it
+        
+        Retries 429s, connection errors and 5xx up to LLM_MAX_RETRIES times.
+        Returns the parsed response and the estimated token cost; raises
+        LLMOverloadedError when the request is shed or stays rate limited.
+        Latencies of non-streaming primary-model completions feed the
+        llm_latency_ms histogram; a stream returns at its first byte, so its
+        time would drag the hedge percentile down.
+        """
+        model = model or self.model
+        timed = model == self.model and not params.get("stream")
+        estimated = self.limiter.estimate(params["messages"], params["max_tokens"])
+        
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            await self.limiter.acquire(estimated, priority)
+            start = time.perf_counter()
+            try:
+                raw = await self.client.chat.completions.with_raw_response.create(model=model, **params)
+                self.limiter.update_from_headers(raw.headers)
+                response = await raw.parse()
+                if timed:
+                    metrics.observe("llm_latency_ms", (time.perf_counter() - start) * 1000)
+                return response, estimated
+            except asyncio.CancelledError:
+                # A cancelled (hedged-out) call took at least this long; keep it
+                # in the histogram so the tail is not hidden by survivorship
+                if timed:
+                    metrics.observe("llm_latency_ms", (time.perf_counter() - start) * 1000)
+                raise
+            except RateLimitError as e:
+                # Rejected requests use no tokens; the limiter pauses for retry-after
+                self.limiter.settle(estimated, 0)
+                self.limiter.on_rate_limited(e.response.headers)
+                if attempt == settings.LLM_MAX_RETRIES:
+                    raise LLMOverloadedError("rate limited by provider") from e
+            except (APIConnectionError, APIStatusError) as e:
+                # Failed attempts are billed nothing; return the estimate before
+                # the retry takes it again
+                self.limiter.settle(estimated, 0)
+                if isinstance(e, APIStatusError) and e.status_code < 500:
+                    raise
+                if attempt == settings.LLM_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(settings.LLM_RETRY_BACKOFF * 2 ** attempt)
+            logger.warning(f"Retrying Groq request (attempt {attempt + 2})")
         
     async def generate(
         self,
         messages: List[Dict[str, str]],
         temperature: float = None,
         max_tokens: int = None,
-        stream: bool = False
+        stream: bool = False,
+        priority: Priority = Priority.INTERACTIVE
     ) -> str:
         """
         Generate completion from Groq
@@ -35,6 +124,7 @@ class GroqClient:
             temperature: Sampling temperature (0-2)
             max_tokens: Maximum tokens to generate
             stream: Whether to stream response
+            priority: Admission priority when the rate limit is contended
             
         Returns:
             Generated text or stream iterator
@@ -53,84 +143,276 @@ class GroqClient:
                 print("---")
             print("==========================================\n")
             
-            response = self.client.chat.completions.create(
-                model=self.model,
+            if stream:
+                response, estimated = await self._create(
+                    priority,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                return self._settled_stream(response, estimated, max_tokens)
+            
+            # Identical prompts already in flight share one completion
+            key = self.singleflight.key(self.model, messages, temperature, max_tokens)
+            content = await self.singleflight.do(
+                key,
+                lambda: self._complete(
+                    lambda model: self._attempt(model, messages, temperature, max_tokens, priority),
+                    priority
+                )
+            )
+            logger.info(f"Generated {len(content)} characters")
+            return content
+                
+        except Exception as e:
+            logger.error(f"Error generating completion: {str(e)}")
+            raise
+    
+    async def _complete(
+        self,
+        attempt: Callable[[str], Awaitable[Any]],
+        priority: Priority,
+        deadline: Optional[float] = None
+    ) -> Any:
+        """
+        One non-streaming completion, hedged for interactive requests
+        
+        attempt(model) makes the call against one model. When the primary call
+        outlives the LLM_HEDGE_PERCENTILE latency, one duplicate goes to
+        LLM_FALLBACK_MODEL; the first success wins and the other call is
+        cancelled. Interactive calls give up with LLMDeadlineExceeded after
+        LLM_HARD_DEADLINE, or at deadline (event loop time) when the caller
+        shares one deadline across several completions.
+        """
+        interactive = priority == Priority.INTERACTIVE
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        if deadline is None and interactive:
+            deadline = start + settings.LLM_HARD_DEADLINE
+        hedge_at = start + self._hedge_delay() if interactive and settings.LLM_HEDGE_ENABLED else None
+        
+        self.completions += 1
+        primary = asyncio.ensure_future(attempt(self.model))
+        hedge = None
+        pending = {primary}
+        error = None
+        try:
+            while pending:
+                waits = [t - loop.time() for t in (deadline, hedge_at) if t is not None]
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=max(0.0, min(waits)) if waits else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                            metrics.increment("llm_hedge_wins")
+                        self._update_hedge_rates()
+                        return task.result()
+                    error = error or task.exception()
+                
+                if done or not pending:
+                    continue
+                if hedge_at is not None and loop.time() >= hedge_at:
+                    hedge_at = None
+                    if self.limiter.queue_depth() == 0:
+                        # Hedging while requests are queued would only deepen the queue
+                        logger.info(f"Hedging slow completion with {self.fallback_model}")
+                        hedge = asyncio.ensure_future(attempt(self.fallback_model))
+                        pending.add(hedge)
+                        self.hedged += 1
+                        metrics.increment("llm_hedged")
+                elif deadline is not None and loop.time() >= deadline:
+                    metrics.increment("llm_deadline_exceeded")
+                    self._update_hedge_rates()
+                    raise LLMDeadlineExceeded(f"no completion within {loop.time() - start:.2f}s")
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def _attempt(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        priority: Priority
+    ) -> str:
+        """Completion text from one model, settled against its reported usage"""
+        response, estimated = await self._create(
+            priority,
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        if response.usage:
+            self.limiter.settle(estimated, response.usage.total_tokens)
+        return response.choices[0].message.content
+    
+    def _hedge_delay(self) -> float:
+        """Seconds before hedging: the observed LLM_HEDGE_PERCENTILE latency of the primary model"""
+        histogram = metrics.histogram("llm_latency_ms")
+        if len(histogram.values) < settings.LLM_HEDGE_MIN_SAMPLES:
+            return settings.LLM_HEDGE_DEFAULT_DELAY
+        return max(settings.LLM_HEDGE_MIN_DELAY, histogram.percentile(settings.LLM_HEDGE_PERCENTILE) / 1000)
+    
+    def _update_hedge_rates(self):
+        """Hedge rate (hedged / completions) and win rate (hedge finished first / hedged)"""
+        metrics.set_gauge("llm_hedge_rate", round(self.hedged / self.completions, 4))
+        if self.hedged:
+            metrics.set_gauge("llm_hedge_win_rate", round(self.hedge_wins / self.hedged, 4))
+    
+    async def generate_stream(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = None,
+        max_tokens: int = None,
+        priority: Priority = Priority.INTERACTIVE
+    ) -> AsyncIterator[str]:
+        """
+        Stream completion tokens from Groq as they are generated
+        
+        Args:
+            messages: List of message dicts with 'role' and 'content'
+            temperature: Sampling temperature (0-2)
+            max_tokens: Maximum tokens to generate
+            priority: Admission priority when the rate limit is contended
+            
+        Yields:
+            Content deltas in generation order
+        """
+        temperature = temperature or settings.TEMPERATURE
+        max_tokens = max_tokens or settings.MAX_TOKENS
+        
+        logger.info(f"Streaming completion with {len(messages)} messages")
+        
+        try:
+            response, estimated = await self._create(
+                priority,
                 messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
-                stream=stream
+                stream=True
             )
-            
-            if stream:
-                return self._handle_stream(response)
-            else:
-                content = response.choices[0].message.content
-                logger.info(f"Generated {len(content)} characters")
-                return content
-                
         except Exception as e:
-            logger.error(f"Error generating completion: {str(e)}")
+            logger.error(f"Error starting completion stream: {str(e)}")
             raise
+        
+        async for token in self._settled_stream(response, estimated, max_tokens):
+            yield token
+    
+    async def _settled_stream(self, stream, estimated: int, max_tokens: int) -> AsyncIterator[str]:
+        """
+        Content deltas of a stream, settled once it ends or is abandoned
+        
+        Streams carry no usage here; settle with the counted completion instead.
+        """
+        generated = []
+        try:
+            async for token in self._handle_stream(stream):
+                generated.append(token)
+                yield token
+        finally:
+            completion = self.limiter.counter.count("".join(generated))
+            self.limiter.settle(estimated, estimated - max_tokens + completion)
     
-    def _handle_stream(self, stream) -> AsyncIterator[str]:
+    async def _handle_stream(self, stream) -> AsyncIterator[str]:
         """Handle streaming response"""
-        for chunk in stream:
-            if chunk.choices[0].delta.content:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
                 yield chunk.choices[0].delta.content
     
     async def generate_with_tools(
         self,
         messages: List[Dict[str, str]],
         tools: List[Dict],
-        temperature: float = None
+        temperature: float = None,
+        tool_choice: Optional[str] = None,
+        deadline: Optional[float] = None
     ) -> Dict:
         """
         Generate completion with tool calling support
         
+        Hedged and bounded by the hard deadline like generate().
+        
         Args:
             messages: Conversation messages
             tools: Available tools/functions
             temperature: Sampling temperature
+            tool_choice: "auto" (default), "none" to force a text answer, or "required"
+            deadline: Event loop time shared by all completions of a tool loop
+                (default: LLM_HARD_DEADLINE from now)
             
         Returns:
-            Response dict with content or tool calls
+            Response dict with content or tool calls; a call whose arguments
+            are not valid JSON carries an "error" and empty "arguments"
         """
         try:
             temperature = temperature or settings.TEMPERATURE
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                tools=tools,
-                temperature=temperature,
-                max_tokens=settings.MAX_TOKENS
+            return await self._complete(
+                lambda model: self._tool_attempt(model, messages, tools, temperature, tool_choice),
+                Priority.INTERACTIVE,
+                deadline
             )
-            
-            choice = response.choices[0]
-            
-            # Check if model wants to call a tool
-            if choice.message.tool_calls:
-                return {
-                    "type": "tool_call",
-                    "tool_calls": [
-                        {
-                            "id": tc.id,
-                            "name": tc.function.name,
-                            "arguments": json.loads(tc.function.arguments)
-                        }
-                        for tc in choice.message.tool_calls
-                    ]
-                }
-            else:
-                return {
-                    "type": "text",
-                    "content": choice.message.content
-                }
-                
         except Exception as e:
             logger.error(f"Error in tool generation: {str(e)}")
             raise
     
+    async def _tool_attempt(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        tools: List[Dict],
+        temperature: float,
+        tool_choice: Optional[str]
+    ) -> Dict:
+        """Tool-calling completion from one model, settled against its reported usage"""
+        extra = {"tool_choice": tool_choice} if tool_choice else {}
+        response, estimated = await self._create(
+            Priority.INTERACTIVE,
+            model=model,
+            messages=messages,
+            tools=tools,
+            temperature=temperature,
+            max_tokens=settings.MAX_TOKENS,
+            **extra
+        )
+        if response.usage:
+            self.limiter.settle(estimated, response.usage.total_tokens)
+        
+        choice = response.choices[0]
+        
+        # Check if model wants to call a tool
+        if choice.message.tool_calls:
+            return {
+                "type": "tool_call",
+                "tool_calls": [self._parse_tool_call(tc) for tc in choice.message.tool_calls]
+            }
+        return {
+            "type": "text",
+            "content": choice.message.content
+        }
+    
+    @staticmethod
+    def _parse_tool_call(tool_call) -> Dict:
+        """Tool call as a dict; malformed arguments become an error for that call only"""
+        call = {"id": tool_call.id, "name": tool_call.function.name, "arguments": {}}
+        try:
+            arguments = json.loads(tool_call.function.arguments or "{}")
+            if not isinstance(arguments, dict):
+                raise ValueError("arguments must be a JSON object")
+            call["arguments"] = arguments
+        except ValueError as e:  # includes json.JSONDecodeError
+            logger.warning(f"Malformed arguments for tool {call['name']}: {e}")
+            call["raw_arguments"] = tool_call.function.arguments
+            call["error"] = f"Invalid arguments: {e}"
+        return call
+    
     async def generate_structured(
         self,
         messages: List[Dict[str, str]],
@@ -149,36 +431,66 @@ class GroqClient:
             Parsed JSON response
         """
         try:
-            # Add instruction to return JSON
-            system_msg = {
-                "role": "system",
-                "content": f"You must respond with valid JSON matching this schema: {json.dumps(response_format)}"
-            }
-            
-            full_messages = [system_msg] + messages
-            
             response = await self.generate(
-                messages=full_messages,
+                messages=self._structured_messages(messages, response_format),
                 temperature=temperature
             )
             
-            # Parse JSON response
-            try:
-                return json.loads(response)
-            except json.JSONDecodeError:
-                # Try to extract JSON from markdown code blocks
-                if "```json" in response:
-                    json_str = response.split("```json")[1].split("```")[0].strip()
-                    return json.loads(json_str)
-                elif "```" in response:
-                    json_str = response.split("```")[1].split("```")[0].strip()
-                    return json.loads(json_str)
-                else:
-                    raise ValueError("Could not parse JSON from response")
+            # Tolerates prose and markdown code fences around the object
+            return parse_json(response)
                     
         except Exception as e:
             logger.error(f"Error generating structured response: {str(e)}")
             raise
+    
+    async def generate_structured_stream(
+        self,
+        messages: List[Dict[str, str]],
+        response_format: Dict,
+        temperature: float = 0.3,
+        priority: Priority = Priority.INTERACTIVE
+    ) -> AsyncIterator[Tuple[Any, Any]]:
+        """
+        Stream a structured JSON response field by field
+        
+        Args:
+            messages: Conversation messages
+            response_format: Expected JSON schema
+            temperature: Lower temp for more consistent structure
+            priority: Admission priority when the rate limit is contended
+            
+        Yields:
+            (field, value) for each top-level field as soon as its value is
+            complete ((index, item) for an array); raises ValueError if the
+            stream ends without a full object
+        """
+        parser = StreamingJSONParser()
+        tokens = self.generate_stream(
+            self._structured_messages(messages, response_format),
+            temperature=temperature,
+            priority=priority
+        )
+        try:
+            async for token in tokens:
+                for field in parser.feed(token):
+                    yield field
+                if parser.done:
+                    break  # ignore a trailing code fence or commentary
+            parser.close()
+        except Exception as e:
+            logger.error(f"Error streaming structured response: {str(e)}")
+            raise
+        finally:
+            await tokens.aclose()
+    
+    @staticmethod
+    def _structured_messages(messages: List[Dict[str, str]], response_format: Dict) -> List[Dict[str, str]]:
+        """Prepend the instruction to answer with JSON matching response_format"""
+        system_msg = {
+            "role": "system",
+            "content": f"You must respond with valid JSON matching this schema: {json.dumps(response_format)}"
+        }
+        return [system_msg] + messages
 
 
 # Global client instance
@@ -3,6 +3,7 @@ Centralized prompt templates for LLM interactions
 """
 from typing import Dict, List, Optional
 from string import Template
+from app.config import settings
 
 
 class PromptTemplates:
@@ -94,6 +95,20 @@ $specialist_capabilities
 
 Would you like me to initiate the transfer?""")
 
+    # Conversation memory prompts
+    CONVERSATION_SUMMARY = Template("""Update the running summary of a bank support conversation.
+
+CURRENT SUMMARY:
+$summary
+
+NEW MESSAGES:
+$messages
+
+Write an updated summary of at most $max_words words. Keep the customer's goals, products and
+facts they mentioned, answers already given and open questions. Leave out greetings and filler.
+
+UPDATED SUMMARY:""")
+
     # Query routing prompts
     ROUTING_ANALYSIS = Template("""Analyze this query and determine the best approach:
 
@@ -140,3 +155,14 @@ def format_form_start_prompt(form_name: str, required_fields: List[str], first_f
         required_fields=fields_str,
         first_field=first_field
     )
+
+
+def format_summary_prompt(summary: str, messages: List[Dict]) -> str:
+    """Format prompt folding new messages into the conversation summary"""
+    messages_str = "\n".join([f"{msg['role'].upper()}: {msg['content']}" for msg in messages])
+    
+    return PromptTemplates.CONVERSATION_SUMMARY.substitute(
+        summary=summary or "(none yet)",
+        messages=messages_str,
+        max_words=settings.SUMMARY_MAX_WORDS
+    )
@@ -0,0 +1,292 @@
+﻿"""
+Client-side admission control for Groq calls
+Token buckets for requests and tokens per minute, fed by the provider's
+rate-limit headers, with a priority queue so interactive chat is admitted
+before background summaries and cache warmers
+"""
+import asyncio
+import heapq
+import itertools
+import re
+import time
+from enum import IntEnum
+from typing import Dict, List, Mapping, Optional
+from app.config import settings
+from app.core.llm.context_packer import TokenCounter, context_packer
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separators per chat message
+
+
+class Priority(IntEnum):
+    """Admission priority (lower is served first)"""
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    WARMUP = 2
+
+
+class LLMOverloadedError(Exception):
+    """Raised when a request is shed instead of being sent to the provider"""
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parse a rate-limit reset value ("7.66s", "2m59.56s", "120ms", "30") into seconds"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_SECONDS[unit] for amount, unit in parts)
+
+
+class TokenBucket:
+    """Continuously refilling budget of `capacity` units per minute"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken (0 if it can be taken now)"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing / self.rate) if self.rate else float("inf")
+
+    def take(self, amount: float):
+        """Take amount (may leave the bucket in debt)"""
+        self._refill()
+        self.available -= min(amount, self.capacity)
+
+    def credit(self, amount: float):
+        """Return (or, if negative, charge) units after settling an estimate"""
+        self._refill()
+        self.available = min(self.capacity, self.available + amount)
+
+    def sync(self, remaining: Optional[float], reset: Optional[float]):
+        """
+        Adopt the provider's view of the budget
+
+        The server's remaining count only ever lowers the local estimate (other
+        workers share the same key); when it is exhausted, nothing refills
+        before the reported reset.
+        """
+        if remaining is None:
+            return
+        self._refill()
+        if remaining < self.available:
+            self.available = remaining
+        if remaining <= 0 and reset:
+            self.available = min(self.available, -reset * self.rate)
+
+
+class _Waiter:
+    """A queued request"""
+
+    __slots__ = ("future", "tokens", "priority", "enqueued", "deadline")
+
+    def __init__(self, future: asyncio.Future, tokens: int, priority: Priority, deadline: float):
+        self.future = future
+        self.tokens = tokens
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.deadline = deadline
+
+
+class RateLimiter:
+    """
+    Shared scheduler for LLM requests
+
+    acquire() queues a request with its estimated token cost; a dispatcher task
+    admits the queue head whenever both buckets can afford it. Requests that
+    would wait longer than their priority allows, or arrive when the queue is
+    full, are shed with LLMOverloadedError.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        counter: Optional[TokenCounter] = None
+    ):
+        self.requests = TokenBucket(requests_per_minute or settings.GROQ_REQUESTS_PER_MINUTE)
+        self.tokens = TokenBucket(tokens_per_minute or settings.GROQ_TOKENS_PER_MINUTE)
+        self.counter = counter or context_packer.counter
+        self.max_queue = settings.LLM_QUEUE_MAX_SIZE
+        self.max_wait = {
+            Priority.INTERACTIVE: settings.LLM_QUEUE_MAX_WAIT,
+            Priority.BACKGROUND: settings.LLM_BACKGROUND_MAX_WAIT,
+            Priority.WARMUP: settings.LLM_BACKGROUND_MAX_WAIT
+        }
+        self.paused_until = 0.0
+        self._queue: List = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def estimate(self, messages: List[Dict], max_tokens: int) -> int:
+        """Token cost of a request: prompt tokens plus the completion budget"""
+        prompt = sum(
+            self.counter.count(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+            for message in messages
+        )
+        return prompt + max_tokens
+
+    async def acquire(self, tokens: int, priority: Priority = Priority.INTERACTIVE):
+        """Wait until a request costing tokens may be sent"""
+        if not settings.LLM_RATE_LIMIT_ENABLED:
+            return
+
+        if len(self._queue) >= self.max_queue and not self._evict(priority):
+            self._shed(priority, "queue full")
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), tokens, priority, time.monotonic() + self.max_wait[priority])
+        heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+        self._notify(loop)
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if not waiter.future.done():
+                waiter.future.cancel()  # caller cancelled; the dispatcher skips it
+            elif not waiter.future.cancelled() and waiter.future.exception() is None:
+                # Admitted just before the caller went away: nothing will be sent
+                self.settle(tokens, 0)
+            raise
+        metrics.observe("llm_queue_wait_ms", (time.monotonic() - waiter.enqueued) * 1000)
+
+    def queue_depth(self) -> int:
+        """Requests currently waiting for admission"""
+        return len(self._queue)
+
+    def settle(self, estimated: int, actual: Optional[int]):
+        """Correct the token bucket once the real usage is known"""
+        if actual is not None and settings.LLM_RATE_LIMIT_ENABLED:
+            self.tokens.credit(estimated - actual)
+
+    def update_from_headers(self, headers: Optional[Mapping[str, str]]):
+        """Sync the buckets with x-ratelimit-* response headers"""
+        if not headers:
+            return
+        self.requests.sync(
+            self._number(headers.get("x-ratelimit-remaining-requests")),
+            parse_duration(headers.get("x-ratelimit-reset-requests"))
+        )
+        self.tokens.sync(
+            self._number(headers.get("x-ratelimit-remaining-tokens")),
+            parse_duration(headers.get("x-ratelimit-reset-tokens"))
+        )
+
+    def on_rate_limited(self, headers: Optional[Mapping[str, str]]):
+        """Pause admissions after a 429 for retry-after (or a short default)"""
+        metrics.increment("llm_rate_limited")
+        self.update_from_headers(headers)
+        delay = parse_duration((headers or {}).get("retry-after")) or settings.LLM_RETRY_BACKOFF
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        logger.warning(f"Groq rate limit hit, pausing admissions for {delay:.1f}s")
+
+    def _notify(self, loop: asyncio.AbstractEventLoop):
+        """Wake the dispatcher, starting it on first use"""
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = loop.create_task(self._dispatch())
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        """Admit queued requests in priority order as the budget allows"""
+        while True:
+            self._wakeup.clear()
+            delay = self._admit()
+            metrics.set_gauge("llm_queue_depth", len(self._queue))
+            if delay is None:
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _admit(self) -> Optional[float]:
+        """Release every affordable head; return seconds until the next check (None if idle)"""
+        while self._queue:
+            _, _, waiter = self._queue[0]
+            now = time.monotonic()
+            if waiter.future.done():
+                heapq.heappop(self._queue)
+                continue
+
+            wait = max(
+                self.paused_until - now,
+                self.requests.wait_time(1),
+                self.tokens.wait_time(waiter.tokens)
+            )
+            if wait > 0:
+                if now >= waiter.deadline:
+                    heapq.heappop(self._queue)
+                    self._fail(waiter, "queue wait exceeded")
+                    continue
+                # Only wake early for the head's deadline; a later item cannot jump it
+                return min(wait, waiter.deadline - now)
+
+            heapq.heappop(self._queue)
+            self.requests.take(1)
+            self.tokens.take(waiter.tokens)
+            waiter.future.set_result(None)
+        return None
+
+    def _evict(self, priority: Priority) -> bool:
+        """Make room by shedding the least important queued request if it ranks below priority"""
+        live = [entry for entry in self._queue if not entry[2].future.done()]
+        if len(live) < len(self._queue):
+            self._queue = live
+            heapq.heapify(self._queue)
+            if len(self._queue) < self.max_queue:
+                return True
+        worst = max(self._queue, key=lambda entry: (entry[0], entry[1]), default=None)
+        if worst is None or worst[0] <= priority:
+            return False
+        self._queue.remove(worst)
+        heapq.heapify(self._queue)
+        self._fail(worst[2], "evicted by higher priority request")
+        return True
+
+    def _fail(self, waiter: _Waiter, reason: str):
+        self._record_shed(waiter.priority, reason)
+        waiter.future.set_exception(LLMOverloadedError(reason))
+
+    def _shed(self, priority: Priority, reason: str):
+        self._record_shed(priority, reason)
+        raise LLMOverloadedError(reason)
+
+    @staticmethod
+    def _record_shed(priority: Priority, reason: str):
+        metrics.increment("llm_shed")
+        metrics.increment(f"llm_shed_{priority.name.lower()}")
+        logger.warning(f"Shedding {priority.name.lower()} LLM request: {reason}")
+
+    @staticmethod
+    def _number(value: Optional[str]) -> Optional[float]:
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+
+# Global limiter shared by all Groq calls in this process
+rate_limiter = RateLimiter()
@@ -1 +1,154 @@
-# Parse and validate LLM output
\ No newline at end of file
+﻿"""
+Parse and validate LLM output
+Incremental JSON parsing for structured completions: top-level fields (or
+array items) are emitted as soon as their value is complete, while tokens are
+still streaming
+"""
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# Characters that end a run of plain string content
+STRING_SPECIAL = re.compile(r'["\\]')
+# Characters that open the top-level value
+CONTAINER_START = re.compile(r"[{\[]")
+
+
+class StreamingJSONParser:
+    """
+    Incremental parser for one JSON object or array
+
+    feed() takes chunks in arrival order and returns the (field, value) pairs
+    whose values completed in that chunk; for a top-level array the pairs are
+    (index, item). Anything before the first "{" or "[" and after its match
+    (code fences, a "json" language tag, prose) is ignored. Each value is
+    decoded once, from its own slice of the text.
+    """
+
+    def __init__(self):
+        self.result: Union[Dict[str, Any], List[Any]] = {}
+        self.done = False
+        self._started = False
+        self._array = False
+        self._depth = 0  # 1 while between the top-level container's members
+        self._in_string = False
+        self._escape = False
+        self._key_parts: List[str] = []
+        self._value_parts: Optional[List[str]] = None
+        self._key: Optional[str] = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """Consume a chunk; return the top-level fields it completed"""
+        fields = []
+        i, n = 0, len(chunk)
+        while i < n and not self.done:
+            if not self._started:
+                match = CONTAINER_START.search(chunk, i)
+                if match is None:
+                    break
+                self._started = True
+                self._depth = 1
+                if match.group() == "[":
+                    self._array = True
+                    self.result = []
+                    self._value_parts = []
+                i = match.end()
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._collect(chunk[i])
+                    self._escape = False
+                    i += 1
+                    continue
+                match = STRING_SPECIAL.search(chunk, i)
+                if match is None:
+                    self._collect(chunk[i:])
+                    break
+                self._collect(chunk[i:match.end()])
+                if match.group() == "\\":
+                    self._escape = True
+                else:
+                    self._in_string = False
+                i = match.end()
+                continue
+
+            char = chunk[i]
+            i += 1
+            if char == '"':
+                self._in_string = True
+                self._collect(char)
+            elif char in "{[":
+                self._depth += 1
+                self._collect(char)
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.done = True
+                    self._finish_member(fields)
+                else:
+                    self._collect(char)
+            elif self._depth == 1 and char == ":" and self._value_parts is None and not self._array:
+                self._key = self._decode("".join(self._key_parts), "key")
+                self._value_parts = []
+            elif self._depth == 1 and char == ",":
+                self._finish_member(fields)
+            else:
+                self._collect(char)
+        return fields
+
+    def close(self) -> Union[Dict[str, Any], List[Any]]:
+        """Finish parsing; raise ValueError unless a complete object or array was read"""
+        if not self.done:
+            raise ValueError("Could not parse JSON from response: object is incomplete")
+        return list(self.result) if self._array else dict(self.result)
+
+    def _collect(self, text: str):
+        if self._value_parts is not None:
+            self._value_parts.append(text)
+        else:
+            self._key_parts.append(text)
+
+    def _finish_member(self, fields: List[Tuple[Any, Any]]):
+        """Decode the member that just ended and reset for the next one"""
+        if self._array:
+            text = "".join(self._value_parts)
+            if text.strip() or self.result or not self.done:
+                value = self._decode(text, f"item {len(self.result)}")
+                fields.append((len(self.result), value))
+                self.result.append(value)
+            self._value_parts = []
+            return
+        if self._value_parts is None:
+            if "".join(self._key_parts).strip():
+                raise ValueError("Could not parse JSON from response: field without a value")
+        else:
+            value = self._decode("".join(self._value_parts), f"value of {self._key!r}")
+            self.result[self._key] = value
+            fields.append((self._key, value))
+        self._key_parts = []
+        self._value_parts = None
+        self._key = None
+
+    @staticmethod
+    def _decode(text: str, what: str) -> Any:
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Could not parse JSON from response: invalid {what}: {e}") from e
+
+
+def parse_json(text: str) -> Any:
+    """
+    Parse a complete response holding one JSON value
+
+    Any top-level value is accepted when the response is bare JSON; objects and
+    arrays are also found inside code fences or surrounding prose.
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    parser = StreamingJSONParser()
+    parser.feed(text)
+    return parser.close()
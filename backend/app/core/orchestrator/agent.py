@@ -1,12 +1,20 @@
 ﻿"""
 Agent - formats conversation history naturally for LLM
 """
-from typing import Dict, Optional, List
-from app.core.llm.groq_client import groq_client
+import asyncio
+import time
+from typing import Any, AsyncIterator, Awaitable, Dict, Optional, List, Tuple
+from app.config import settings
+from app.core.llm.context_packer import context_packer
+from app.core.llm.groq_client import LLMDeadlineExceeded, groq_client
+from app.core.llm.rate_limiter import LLMOverloadedError
 from app.core.llm.prompt_templates import PromptTemplates
 from app.core.rag.retriever import retriever
+from app.core.search.search_optimizer import query_optimizer
 from app.core.search.tavily_client import tavily_client
 from app.core.orchestrator.router import query_router, QueryType
+from app.core.orchestrator.answer_cache import answer_cache
+from app.core.orchestrator.tools import tool_runner
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -20,6 +28,10 @@ class BankingSupportAgent:
         self.retriever = retriever
         self.search = tavily_client
         self.router = query_router
+        self.optimizer = query_optimizer
+        self.answer_cache = answer_cache
+        self.packer = context_packer
+        self.tools = tool_runner
     
     async def process_query(
         self, 
@@ -28,174 +40,367 @@ class BankingSupportAgent:
     ) -> Dict:
         """Process query with conversation history"""
         try:
-            conversation_history = conversation_history or []
+            history = conversation_history or []
+            query_type, metadata = await self._route(query)
             
-            # Route based on current query
-            query_type, metadata = await self.router.route(query, {})
-            logger.info(f"Query type: {query_type.value}")
+            # Paraphrases of generic questions reuse an earlier answer
+            cacheable = self.answer_cache.is_cacheable(query, query_type, history)
+            if cacheable:
+                cached = await self.answer_cache.lookup(query, query_type)
+                if cached:
+                    return cached
             
-            # Handle based on type
-            if query_type == QueryType.ESCALATE:
-                return self._handle_escalation(metadata)
-            elif query_type == QueryType.RAG_ONLY:
-                return await self._handle_rag(query, conversation_history)
-            elif query_type == QueryType.SEARCH_ONLY:
-                return await self._handle_search(query, conversation_history)
-            else:  # HYBRID or FORM
-                return await self._handle_hybrid(query, conversation_history)
-                
+            # Hybrid questions let the model call retrieval, search and rate tools
+            if query_type == QueryType.HYBRID and settings.TOOL_CALLING_ENABLED:
+                result = await self._answer_with_tools(query, history)
+                if result is not None:
+                    if cacheable and self._is_complete(result):
+                        await self.answer_cache.store(query, query_type, result)
+                    return result
+            
+            plan = await self._prepare(query, history, query_type, metadata)
+            messages = plan.pop("messages", None)
+            excerpt = plan.pop("excerpt", None)
+            if messages is None:
+                return plan
+            
+            try:
+                answer = await self.llm.generate(messages)
+            except LLMDeadlineExceeded as e:
+                logger.warning(f"LLM deadline exceeded: {e}")
+                return self._handle_deadline(plan, excerpt)
+            result = {"answer": answer, **plan}
+            if cacheable and self._is_complete(result):
+                await self.answer_cache.store(query, query_type, result)
+            return result
+        
+        except LLMOverloadedError as e:
+            logger.warning(f"LLM busy: {e}")
+            return self._handle_overload()
         except Exception as e:
             logger.error(f"Error: {e}")
             return {"answer": "Error occurred.", "error": str(e)}
     
-    async def _handle_rag(self, query: str, history: List[Dict]) -> Dict:
-        """RAG with conversation context"""
-        docs = await self.retriever.retrieve(query)
+    async def stream_query(
+        self,
+        query: str,
+        conversation_history: Optional[List[Dict]] = None
+    ) -> AsyncIterator[Dict]:
+        """
+        Process query and stream the answer
         
-        if not docs:
-            return {"answer": "No info found.", "sources": [], "method": "rag_no_results"}
+        Yields a "meta" event (sources, method) first, then "token" events,
+        or a single "error" event if processing fails.
+        """
+        try:
+            history = conversation_history or []
+            query_type, metadata = await self._route(query)
+            
+            cacheable = self.answer_cache.is_cacheable(query, query_type, history)
+            cached = await self.answer_cache.lookup(query, query_type) if cacheable else None
+            if cached:
+                yield {
+                    "type": "meta",
+                    "sources": cached.get("sources", []),
+                    "method": cached.get("method", "unknown"),
+                    "escalate": False,
+                    "metadata": cached.get("metadata", {})
+                }
+                yield {"type": "token", "content": cached["answer"]}
+                return
+            
+            plan = await self._prepare(query, history, query_type, metadata)
+            messages = plan.pop("messages", None)
+            plan.pop("excerpt", None)
+            
+            yield {
+                "type": "meta",
+                "sources": plan.get("sources", []),
+                "method": plan.get("method", "unknown"),
+                "escalate": plan.get("escalate", False),
+                "metadata": plan.get("metadata", {})
+            }
+            
+            if messages is None:
+                # Canned answers (escalation, no results) need no LLM call
+                yield {"type": "token", "content": plan.get("answer", "")}
+                return
+            
+            tokens = []
+            try:
+                async for token in self.llm.generate_stream(messages):
+                    tokens.append(token)
+                    yield {"type": "token", "content": token}
+            except LLMOverloadedError as e:
+                if tokens:
+                    raise
+                logger.warning(f"LLM busy: {e}")
+                yield {"type": "token", "content": self._handle_overload()["answer"]}
+                return
+            
+            if cacheable and self._is_complete(plan):
+                await self.answer_cache.store(query, query_type, {"answer": "".join(tokens), **plan})
+                
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            yield {"type": "error", "error": str(e)}
+    
+    async def _route(self, query: str) -> Tuple[QueryType, Dict]:
+        """Route based on current query"""
+        query_type, metadata = await self.router.route(query, {})
+        logger.info(f"Query type: {query_type.value}")
+        return query_type, metadata
+    
+    async def _prepare(
+        self,
+        query: str,
+        history: List[Dict],
+        query_type: QueryType,
+        metadata: Dict
+    ) -> Dict:
+        """
+        Gather the context for a routed query
         
-        # Build context
-        context = "\n\n".join([f"[{d['metadata'].get('source')}]\n{d['text'][:400]}" for d in docs[:3]])
+        Returns either a finished result with an "answer", or a plan holding
+        the LLM "messages" plus the sources/method to report with the answer.
+        """
+        # Handle based on type
+        if query_type == QueryType.ESCALATE:
+            return self._handle_escalation(metadata)
+        elif query_type == QueryType.RAG_ONLY:
+            return await self._prepare_rag(query, history, metadata.get("filters"))
+        elif query_type == QueryType.SEARCH_ONLY:
+            return await self._prepare_search(query, history)
+        else:  # HYBRID or FORM
+            return await self._prepare_hybrid(query, history, metadata.get("filters"))
+    
+    async def _answer_with_tools(self, query: str, history: List[Dict]) -> Optional[Dict]:
+        """
+        Answer through the tool-calling loop (tool calls of a turn run concurrently)
         
-        # Build messages with conversation history
-        messages = [{"role": "system", "content": PromptTemplates.BANKING_ASSISTANT_SYSTEM}]
+        Tool results get the context budget left after the packed history.
+        Returns None when tool calling fails, so the caller falls back to the
+        prepared hybrid context; shed requests still raise LLMOverloadedError
+        and a missed LLM_HARD_DEADLINE gives the degraded answer.
+        """
+        packed = self.packer.pack([], history)
+        try:
+            result = await self.tools.run(
+                self._build_messages(packed["history"], query),
+                budget=max(1, packed["tokens"]["budget"] - packed["tokens"]["total"])
+            )
+        except LLMOverloadedError:
+            raise
+        except LLMDeadlineExceeded as e:
+            logger.warning(f"LLM deadline exceeded in tool loop: {e}")
+            return self._handle_deadline({"sources": [], "metadata": {"context_tokens": packed["tokens"]}}, None)
+        except Exception as e:
+            logger.error(f"Tool calling failed, using hybrid context: {e}")
+            return None
+        
+        return {
+            "answer": result["answer"],
+            "sources": result["sources"],
+            "method": "tools",
+            "metadata": {
+                "tool_calls": result["tool_calls"],
+                "context_tokens": {**packed["tokens"], "tools": result["tokens"]}
+            }
+        }
+    
+    async def _retrieve(
+        self,
+        query: str,
+        top_k: Optional[int] = None,
+        filters: Optional[Dict] = None,
+        history: Optional[List[Dict]] = None
+    ) -> List[Dict]:
+        """Retrieve with the router's filters, widening to the full corpus if they match nothing"""
+        variants = self.optimizer.variants(query, history or [])
+        docs = await self.retriever.retrieve(query, top_k=top_k, filters=filters, query_variants=variants)
+        if not docs and filters:
+            logger.info(f"No results for filters {filters}, retrying unfiltered")
+            docs = await self.retriever.retrieve(query, top_k=top_k, query_variants=variants)
+        return docs
+    
+    async def _prepare_rag(
+        self,
+        query: str,
+        history: List[Dict],
+        filters: Optional[Dict] = None
+    ) -> Dict:
+        """RAG with conversation context"""
+        docs = await self._retrieve(query, filters=filters, history=history)
         
-        # Add history
-        if history:
-            recent_history = history[-4:] if len(history) >= 4 else history
-            for msg in recent_history:
-                if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                    messages.append({
-                        "role": msg["role"], 
-                        "content": msg["content"][:500] if msg["content"] else ""
-                    })
+        if not docs:
+            return {"answer": "No info found.", "sources": [], "method": "rag_no_results"}
         
-        # Add current query with context
-        messages.append({
-            "role": "user",
-            "content": f"Documents:\n{context}\n\nQuestion: {query}"
-        })
+        # Pack sentence-aligned extracts into the token budget
+        packed = self.packer.pack(
+            [("docs", [
+                {"header": f"[{d['metadata'].get('source')}]", "text": d["text"], "source": d["metadata"].get("source")}
+                for d in docs[:3]
+            ])],
+            history
+        )
+        docs = packed["sections"]["docs"]
+        context = "\n\n".join([f"{d['header']}\n{d['text']}" for d in docs])
         
-        answer = await self.llm.generate(messages)
+        # Build messages with conversation history and the query with context
+        messages = self._build_messages(packed["history"], f"Documents:\n{context}\n\nQuestion: {query}")
         
         return {
-            "answer": answer,
-            "sources": [{"source": d["metadata"].get("source")} for d in docs[:3]],
-            "method": "rag"
+            "messages": messages,
+            "excerpt": docs[0]["text"] if docs else None,
+            "sources": [{"source": d["source"]} for d in docs],
+            "method": "rag",
+            "metadata": {"context_tokens": packed["tokens"]}
         }
     
-    async def _handle_search(self, query: str, history: List[Dict]) -> Dict:
+    async def _prepare_search(self, query: str, history: List[Dict]) -> Dict:
         """Search with conversation context"""
         
         # Enhance search query with conversation context
-        search_query = query
-        if history and len(history) >= 2:
-            # Get the last user question
-            last_user_msg = None
-            for msg in reversed(history):
-                if msg.get("role") == "user":
-                    last_user_msg = msg.get("content", "")
-                    break
-            
-            # If current query is short/vague, combine with previous context
-            if last_user_msg and len(query.split()) <= 5:
-                search_query = f"{last_user_msg} {query}"
-                print(f"[DEBUG SEARCH] Enhanced query: {search_query}")
+        search_query = self.optimizer.with_history(query, history)
         
         results = await self.search.search_banking_info(search_query)
         
         if not results:
             return {"answer": "No results found.", "sources": [], "method": "search_no_results"}
         
-        context = "\n\n".join([f"[{r['title']}]\n{r['content'][:400]}" for r in results[:3]])
-        
-        # Build messages
-        messages = [{"role": "system", "content": PromptTemplates.BANKING_ASSISTANT_SYSTEM}]
-        
-        # Add history
-        if history:
-            recent_history = history[-4:] if len(history) >= 4 else history
-            for msg in recent_history:
-                if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                    messages.append({
-                        "role": msg["role"], 
-                        "content": msg["content"][:500] if msg["content"] else ""
-                    })
+        packed = self.packer.pack(
+            [("web", [
+                {"header": f"[{r['title']}]", "text": r["content"], "title": r["title"], "url": r["url"]}
+                for r in results[:3]
+            ])],
+            history
+        )
+        results = packed["sections"]["web"]
+        context = "\n\n".join([f"{r['header']}\n{r['text']}" for r in results])
         
-        # Add current with search results
-        messages.append({
-            "role": "user",
-            "content": f"Web results:\n{context}\n\nQuestion: {query}"
-        })
-        
-        answer = await self.llm.generate(messages)
+        # Build messages with search results
+        messages = self._build_messages(packed["history"], f"Web results:\n{context}\n\nQuestion: {query}")
         
         return {
-            "answer": answer,
-            "sources": [{"title": r["title"], "url": r["url"]} for r in results[:3]],
-            "method": "search"
+            "messages": messages,
+            "excerpt": results[0]["text"] if results else None,
+            "sources": [{"title": r["title"], "url": r["url"]} for r in results],
+            "method": "search",
+            "metadata": {"context_tokens": packed["tokens"]}
         }
     
-    async def _handle_hybrid(self, query: str, history: List[Dict]) -> Dict:
+    async def _prepare_hybrid(
+        self,
+        query: str,
+        history: List[Dict],
+        filters: Optional[Dict] = None
+    ) -> Dict:
         """Hybrid with conversation context"""
         
-        docs = await self.retriever.retrieve(query, top_k=2)
-        
         # Enhance search query with conversation context
-        search_query = query
-        if history and len(history) >= 2:
-            # Get the last user question
-            last_user_msg = None
-            for msg in reversed(history):
-                if msg.get("role") == "user":
-                    last_user_msg = msg.get("content", "")
-                    break
-            
-            # If current query is short/vague, combine with previous context
-            if last_user_msg and len(query.split()) <= 5:
-                search_query = f"{last_user_msg} {query}"
-                print(f"[DEBUG HYBRID SEARCH] Enhanced query: {search_query}")
+        search_query = self.optimizer.with_history(query, history)
         
-        results = await self.search.search_banking_info(search_query)
+        # Run both branches concurrently; a slow branch only drops its own context
+        (docs, rag_info), (results, search_info) = await asyncio.gather(
+            self._run_branch(
+                self._retrieve(query, top_k=2, filters=filters, history=history),
+                settings.HYBRID_RAG_TIMEOUT,
+                "rag"
+            ),
+            self._run_branch(
+                self.search.search_banking_info(search_query),
+                settings.HYBRID_SEARCH_TIMEOUT,
+                "search"
+            )
+        )
+        metadata = {"branches": {"rag": rag_info, "search": search_info}}
+        
+        packed = self.packer.pack(
+            [
+                ("docs", [{"text": d["text"], "source": d["metadata"].get("source")} for d in docs]),
+                ("web", [{"text": r["content"], "title": r["title"], "url": r["url"]} for r in results[:2]])
+            ],
+            history
+        )
+        docs, results = packed["sections"]["docs"], packed["sections"]["web"]
+        metadata["context_tokens"] = packed["tokens"]
         
         contexts = []
         if docs:
-            contexts.append("Internal:\n" + "\n".join([d['text'][:300] for d in docs]))
+            contexts.append("Internal:\n" + "\n".join([d["text"] for d in docs]))
         if results:
-            contexts.append("Web:\n" + "\n".join([r['content'][:300] for r in results[:2]]))
+            contexts.append("Web:\n" + "\n".join([r["text"] for r in results]))
         
         if not contexts:
-            return {"answer": "No info found.", "sources": [], "method": "hybrid_no_results"}
-        
-        # Build messages
-        messages = [{"role": "system", "content": PromptTemplates.BANKING_ASSISTANT_SYSTEM}]
-        
-        # Add history
-        if history:
-            recent_history = history[-4:] if len(history) >= 4 else history
-            for msg in recent_history:
-                if isinstance(msg, dict) and "role" in msg and "content" in msg:
-                    messages.append({
-                        "role": msg["role"], 
-                        "content": msg["content"][:500] if msg["content"] else ""
-                    })
-        
-        # Add current with combined context
-        messages.append({
-            "role": "user",
-            "content": f"{chr(10).join(contexts)}\n\nQuestion: {query}"
-        })
+            return {
+                "answer": "No info found.",
+                "sources": [],
+                "method": "hybrid_no_results",
+                "metadata": metadata
+            }
         
-        answer = await self.llm.generate(messages)
+        # Build messages with combined context
+        messages = self._build_messages(packed["history"], f"{chr(10).join(contexts)}\n\nQuestion: {query}")
         
         all_sources = []
         if docs:
-            all_sources.extend([{"source": d["metadata"].get("source")} for d in docs])
+            all_sources.extend([{"source": d["source"]} for d in docs])
         if results:
-            all_sources.extend([{"title": r["title"], "url": r["url"]} for r in results[:2]])
+            all_sources.extend([{"title": r["title"], "url": r["url"]} for r in results])
         
-        return {"answer": answer, "sources": all_sources, "method": "hybrid"}
+        return {
+            "messages": messages,
+            "excerpt": (docs or results)[0]["text"],
+            "sources": all_sources,
+            "method": "hybrid",
+            "metadata": metadata
+        }
+    
+    def _build_messages(self, history: List[Dict], content: str) -> List[Dict]:
+        """System prompt, packed history, then the user turn with its context"""
+        messages = [{"role": "system", "content": PromptTemplates.BANKING_ASSISTANT_SYSTEM}]
+        messages.extend(history)
+        messages.append({"role": "user", "content": content})
+        return messages
+    
+    async def _run_branch(
+        self,
+        coro: Awaitable[List[Dict]],
+        timeout: float,
+        name: str
+    ) -> Tuple[List[Dict], Dict[str, Any]]:
+        """Await one context branch with its own timeout and record its latency"""
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            results = await asyncio.wait_for(coro, timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"{name} branch timed out after {timeout}s")
+            results, status = [], "timeout"
+        except Exception as e:
+            logger.error(f"{name} branch failed: {e}")
+            results, status = [], "error"
+        
+        info = {
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+            "status": status,
+            "results": len(results or [])
+        }
+        return results or [], info
+    
+    @staticmethod
+    def _is_complete(result: Dict) -> bool:
+        """
+        Whether an answer was built from its full context
+        
+        Degraded answers, and answers missing a hybrid branch or a tool result
+        that timed out or failed, are not worth serving from the answer cache.
+        """
+        if result.get("method") == "degraded":
+            return False
+        metadata = result.get("metadata") or {}
+        steps = list((metadata.get("branches") or {}).values()) + list(metadata.get("tool_calls") or [])
+        return all(step.get("status") == "ok" for step in steps)
     
     def _handle_escalation(self, metadata: Dict) -> Dict:
         reason = metadata.get("reason")
@@ -208,6 +413,22 @@ class BankingSupportAgent:
             msg = "Need a specialist for this."
         
         return {"answer": msg, "escalate": True, "reason": reason, "method": "escalation"}
+    
+    def _handle_deadline(self, plan: Dict, excerpt: Optional[str]) -> Dict:
+        """Degraded answer when the LLM misses its hard deadline: the best retrieved passage"""
+        if excerpt:
+            msg = f"I can't put together a full answer right now, but this should help:\n\n{excerpt}"
+        else:
+            msg = "I can't put together an answer right now. Please try again in a moment."
+        return {**plan, "answer": msg, "method": "degraded"}
+    
+    def _handle_overload(self) -> Dict:
+        """Answer given when the LLM request was shed by the rate limiter"""
+        return {
+            "answer": "We're handling a lot of requests right now. Please try again in a moment.",
+            "sources": [],
+            "method": "rate_limited"
+        }
 
 
 banking_agent = BankingSupportAgent()
\ No newline at end of file
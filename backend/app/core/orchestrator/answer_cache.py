@@ -0,0 +1,149 @@
+﻿"""
+Semantic answer cache
+Serves a stored answer when a new question is a close paraphrase of a cached
+one, skipping retrieval and the LLM call
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+from app.config import settings
+from app.core.rag.embeddings import embedding_service
+from app.core.rag.vector_ops import l2_normalize
+from app.core.orchestrator.router import QueryType
+from app.core.search.search_optimizer import query_optimizer
+from app.utils.cache import corpus_version
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+from app.utils.validators import contains_personal_data
+
+logger = get_logger(__name__)
+
+NEVER_CACHED_ROUTES = {QueryType.ESCALATE.value, QueryType.SEARCH_ONLY.value}
+
+
+class SemanticAnswerCache:
+    """
+    Cache of generated answers keyed by query embedding
+
+    Cached query vectors live in one preallocated float32 matrix, so a lookup
+    is a single matrix-vector product over at most ANSWER_CACHE_MAX_ENTRIES
+    rows. Entries expire after ANSWER_CACHE_TTL, are evicted least recently
+    used first and are all dropped when the corpus version changes.
+    Only routes listed in ANSWER_CACHE_ROUTES are cached; escalations and
+    live web searches (time-sensitive) never are, whatever the setting says.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, dimension: Optional[int] = None):
+        self.enabled = settings.ANSWER_CACHE_ENABLED
+        self.max_entries = max_entries or settings.ANSWER_CACHE_MAX_ENTRIES
+        self.max_distance = settings.ANSWER_CACHE_MAX_DISTANCE
+        self.ttl = settings.ANSWER_CACHE_TTL
+        self.routes = set(settings.ANSWER_CACHE_ROUTES) - NEVER_CACHED_ROUTES
+        self.embedding_service = embedding_service
+        self.versions = corpus_version
+
+        dimension = dimension or settings.EMBEDDING_DIMENSION
+        self._vectors = np.zeros((self.max_entries, dimension), dtype=np.float32)
+        self._live = np.zeros(self.max_entries, dtype=bool)
+        self._expires = np.zeros(self.max_entries, dtype=np.float64)
+        self._routes = np.full(self.max_entries, "", dtype="<U16")
+        self._entries: "OrderedDict[int, Dict]" = OrderedDict()  # slot -> entry, LRU order
+        self._free = list(range(self.max_entries - 1, -1, -1))
+        self._version: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, query: str, query_type: QueryType, history: List[Dict]) -> bool:
+        """Opted-in route, standalone question (not a follow-up) and no personal data"""
+        if not self.enabled or query_type.value not in self.routes:
+            return False
+        if self._is_followup(query, history):
+            return False
+        return not contains_personal_data(query)
+
+    async def lookup(self, query: str, query_type: QueryType) -> Optional[Dict]:
+        """Cached result of the most similar query on the same route, if close enough"""
+        vector = l2_normalize(await self.embedding_service.aembed_text(query))
+        version = await self.versions.aget()
+        now = time.time()
+
+        with self._lock:
+            self._check_version(version)
+            for slot in np.flatnonzero(self._live & (self._expires < now)):
+                self._evict(int(slot))
+
+            scores = self._vectors @ vector
+            scores[~(self._live & (self._routes == query_type.value))] = -np.inf
+            best = int(np.argmax(scores))
+            similarity = float(scores[best])
+
+            if not np.isfinite(similarity) or 1 - similarity > self.max_distance:
+                metrics.increment("answer_cache_misses")
+                return None
+
+            entry = self._entries[best]
+            self._entries.move_to_end(best)
+            metrics.increment("answer_cache_hits")
+            metrics.observe("answer_cache_similarity", similarity)
+
+        logger.info(f"Semantic cache hit ({similarity:.3f}) for: '{query}' ~ '{entry['query']}'")
+        result = dict(entry["result"])
+        result["metadata"] = {
+            **result.get("metadata", {}),
+            "cache": {"type": "semantic", "similarity": round(similarity, 4), "matched_query": entry["query"]}
+        }
+        return result
+
+    async def store(self, query: str, query_type: QueryType, result: Dict):
+        """Cache a generated result (answer, sources, method, metadata)"""
+        vector = l2_normalize(await self.embedding_service.aembed_text(query))
+        version = await self.versions.aget()
+
+        with self._lock:
+            self._check_version(version)
+            if not self._free:
+                self._evict(next(iter(self._entries)))
+
+            slot = self._free.pop()
+            self._vectors[slot] = vector
+            self._live[slot] = True
+            self._expires[slot] = time.time() + self.ttl
+            self._routes[slot] = query_type.value
+            self._entries[slot] = {
+                "query": query,
+                "result": {key: result[key] for key in ("answer", "sources", "method", "metadata") if key in result}
+            }
+            metrics.set_gauge("answer_cache_entries", len(self._entries))
+
+    def clear(self):
+        """Drop all entries"""
+        with self._lock:
+            for slot in list(self._entries):
+                self._evict(slot)
+
+    def _check_version(self, version: int):
+        """Drop everything when ingestion changed the corpus (caller holds the lock)"""
+        if version != self._version:
+            if self._entries:
+                logger.info(f"Corpus version changed to {version}, clearing semantic answer cache")
+                metrics.increment("answer_cache_invalidations")
+            for slot in list(self._entries):
+                self._evict(slot)
+            self._version = version
+
+    def _evict(self, slot: int):
+        """Free one slot (caller holds the lock)"""
+        self._entries.pop(slot, None)
+        self._live[slot] = False
+        self._free.append(slot)
+        metrics.set_gauge("answer_cache_entries", len(self._entries))
+
+    @staticmethod
+    def _is_followup(query: str, history: List[Dict]) -> bool:
+        """Short questions after earlier turns depend on the conversation"""
+        return query_optimizer.with_history(query, history) != query
+
+
+# Global answer cache
+answer_cache = SemanticAnswerCache()
@@ -25,6 +25,10 @@ class QueryRouter:
         self.temporal_keywords = ["current", "latest", "today", "2024", "2025", "recent"]
         self.sensitive_keywords = ["password", "pin", "account number", "ssn", "transfer money"]
         self.form_keywords = ["fill out", "application", "apply for", "form"]
+        self.faq_keywords = [
+            "contact", "phone", "call you", "email", "customer service", "branch",
+            "hours", "open on", "locked out", "lost card", "stolen card", "dispute", "complaint"
+        ]
     
     async def route(self, query: str, context: Optional[Dict] = None) -> Tuple[QueryType, Dict]:
         """Determine how to handle query"""
@@ -53,7 +57,9 @@ class QueryRouter:
         if self._is_account_specific(query_lower):
             return QueryType.ESCALATE, {"reason": "account_access_required"}
         
-        # Default to hybrid
+        # Default to hybrid; customer-service questions only need the FAQ documents
+        if self._is_faq(query_lower):
+            return QueryType.HYBRID, {"confidence": 0.8, "filters": {"doc_type": "faq"}}
         return QueryType.HYBRID, {"confidence": 0.8}
     
     def _contains_sensitive(self, query: str) -> bool:
@@ -65,6 +71,9 @@ class QueryRouter:
     def _needs_current_info(self, query: str) -> bool:
         return any(kw in query for kw in self.temporal_keywords)
     
+    def _is_faq(self, query: str) -> bool:
+        return any(kw in query for kw in self.faq_keywords)
+    
     def _is_account_specific(self, query: str) -> bool:
         patterns = [r"my account", r"my balance", r"my transactions"]
         return any(re.search(p, query) for p in patterns)
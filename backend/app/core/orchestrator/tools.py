@@ -0,0 +1,341 @@
+﻿"""
+Tool-calling runtime
+Registry of async tools the LLM may call, concurrent execution of every call
+in a turn, and the follow-up completion that answers from the tool results
+"""
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from app.config import settings
+from app.core.llm.context_packer import ContextPacker, context_packer
+from app.core.llm.groq_client import groq_client
+from app.core.rag.retriever import retriever
+from app.core.search.tavily_client import tavily_client
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+
+class Tool:
+    """An async function the LLM can call, described by a JSON schema"""
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        parameters: Dict,
+        func: Callable[..., Awaitable[Any]],
+        timeout: Optional[float] = None
+    ):
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.func = func
+        self.timeout = timeout or settings.TOOL_TIMEOUT
+
+    def schema(self) -> Dict:
+        """Tool definition in the chat completions format"""
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": self.parameters
+            }
+        }
+
+
+class ToolRegistry:
+    """
+    Named tools plus their concurrent execution
+
+    Every call in a turn runs at once, each under its tool's timeout, so a
+    turn takes about as long as its slowest tool. Failures and timeouts become
+    error results for the model instead of exceptions. Passages and web
+    results are packed into a token budget with the context packer before
+    they go back to the model.
+    """
+
+    def __init__(self, tools: Optional[List[Tool]] = None, packer: Optional[ContextPacker] = None):
+        self.tools: Dict[str, Tool] = {}
+        self.packer = packer or context_packer
+        self.max_result_chars = settings.TOOL_RESULT_MAX_CHARS
+        for tool in tools or []:
+            self.register(tool)
+
+    def register(self, tool: Tool):
+        """Add (or replace) a tool"""
+        self.tools[tool.name] = tool
+
+    def schemas(self) -> List[Dict]:
+        """Definitions of all registered tools"""
+        return [tool.schema() for tool in self.tools.values()]
+
+    async def execute_all(self, calls: List[Dict], budget: Optional[int] = None) -> List[Dict]:
+        """
+        Run tool calls ({"id", "name", "arguments"}) concurrently, results in call order
+
+        Passages in the results share budget tokens (default
+        CONTEXT_TOKEN_BUDGET); each result reports the "tokens" it used.
+        """
+        start = time.perf_counter()
+        results = await asyncio.gather(*(self.execute(call) for call in calls))
+        metrics.observe("tool_turn_latency_ms", (time.perf_counter() - start) * 1000)
+        metrics.observe("tool_calls_per_turn", len(calls))
+        return self._pack(results, budget)
+
+    async def execute(self, call: Dict) -> Dict:
+        """Run one tool call; never raises ("data" holds the raw result until packed)"""
+        name = call["name"]
+        start = time.perf_counter()
+        tool = self.tools.get(name)
+        status = "ok"
+
+        if tool is None:
+            content, status = {"error": f"Unknown tool: {name}"}, "unknown_tool"
+        elif call.get("error"):
+            content, status = {"error": call["error"]}, "invalid_arguments"
+        else:
+            try:
+                content = await asyncio.wait_for(tool.func(**(call.get("arguments") or {})), timeout=tool.timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Tool {name} timed out after {tool.timeout}s")
+                content, status = {"error": f"{name} timed out"}, "timeout"
+            except Exception as e:
+                logger.error(f"Tool {name} failed: {e}")
+                content, status = {"error": f"{name} failed: {e}"}, "error"
+
+        latency_ms = (time.perf_counter() - start) * 1000
+        if tool is not None:
+            metrics.observe(f"tool_{name}_latency_ms", latency_ms)
+        if status != "ok":
+            metrics.increment(f"tool_{status}")
+        return {
+            "tool_call_id": call["id"],
+            "name": name,
+            "data": content,
+            "status": status,
+            "latency_ms": round(latency_ms, 1)
+        }
+
+    def _pack(self, results: List[Dict], budget: Optional[int]) -> List[Dict]:
+        """Fit the passages of all results into budget tokens and serialize them"""
+        sections = [(result["tool_call_id"], self._passages(result["data"])) for result in results]
+        packed = {"sections": {}, "tokens": {}}
+        if any(items for _, items in sections) and (budget is None or budget > 0):
+            packed = self.packer.pack(sections, budget=budget)
+
+        for result, (key, items) in zip(results, sections):
+            data = result.pop("data")
+            if items:
+                # Sentence-aligned extracts; passages that did not fit are dropped
+                data = [{**item["item"], item["field"]: item["text"]} for item in packed["sections"].get(key, [])]
+            result["content"] = self._serialize(data)
+            result["sources"] = self._sources(data) if result["status"] == "ok" else []
+            result["tokens"] = packed["tokens"].get(key, 0)
+        return results
+
+    @staticmethod
+    def _passages(data: Any) -> List[Dict]:
+        """Packer items for a list of passages ("text" or web "content"), else []"""
+        if not isinstance(data, list) or not data:
+            return []
+        items = []
+        for entry in data:
+            if not isinstance(entry, dict):
+                return []
+            field = "text" if isinstance(entry.get("text"), str) else "content"
+            if not isinstance(entry.get(field), str):
+                return []
+            items.append({"text": entry[field], "field": field, "item": entry})
+        return items
+
+    @staticmethod
+    def _sources(content: Any) -> List[Dict]:
+        """Document sources and web pages a result was built from"""
+        sources = []
+        for item in content if isinstance(content, list) else []:
+            if not isinstance(item, dict):
+                continue
+            if item.get("url"):
+                sources.append({"title": item.get("title", ""), "url": item["url"]})
+            elif item.get("source"):
+                sources.append({"source": item["source"]})
+        return sources
+
+    def _serialize(self, content: Any) -> str:
+        """
+        JSON text of a result, capped at TOOL_RESULT_MAX_CHARS
+
+        A backstop for results the packer does not shape: lists lose trailing
+        items first so the result stays valid JSON; only a single oversized
+        value is cut mid-text.
+        """
+        text = json.dumps(content, default=str, ensure_ascii=False)
+        if len(text) <= self.max_result_chars:
+            return text
+
+        metrics.increment("tool_results_truncated")
+        if isinstance(content, list):
+            items = list(content)
+            while len(items) > 1:
+                items.pop()
+                text = json.dumps(items, default=str, ensure_ascii=False)
+                if len(text) <= self.max_result_chars:
+                    return text
+        return text[:self.max_result_chars] + "... [truncated]"
+
+
+class ToolRunner:
+    """
+    Completion loop that executes requested tools and feeds results back
+
+    Every completion is hedged like a plain one, and the whole loop shares one
+    LLM_HARD_DEADLINE (LLMDeadlineExceeded once it passes). Tool results of
+    all rounds share one context token budget.
+    """
+
+    def __init__(self, registry: ToolRegistry):
+        self.llm = groq_client
+        self.registry = registry
+        self.max_rounds = settings.TOOL_MAX_ROUNDS
+
+    async def run(
+        self,
+        messages: List[Dict],
+        temperature: Optional[float] = None,
+        budget: Optional[int] = None
+    ) -> Dict:
+        """
+        Answer messages, running tool calls until the model replies with text
+
+        Args:
+            messages: Conversation messages
+            temperature: Sampling temperature
+            budget: Tokens for tool results (default CONTEXT_TOKEN_BUDGET)
+
+        Returns:
+            Dict with the "answer", the "sources" tools returned, the executed
+            "tool_calls" (name, status, latency per call) and the result "tokens"
+        """
+        messages = list(messages)
+        executed = []
+        sources = []
+        budget = budget or self.registry.packer.budget
+        used = 0
+        deadline = asyncio.get_running_loop().time() + settings.LLM_HARD_DEADLINE
+
+        for _ in range(self.max_rounds):
+            response = await self.llm.generate_with_tools(
+                messages, self.registry.schemas(), temperature, deadline=deadline
+            )
+            if response["type"] == "text":
+                return {"answer": response["content"], "sources": sources, "tool_calls": executed, "tokens": used}
+
+            calls = response["tool_calls"]
+            logger.info(f"Executing {len(calls)} tool calls: {[call['name'] for call in calls]}")
+            messages.append({
+                "role": "assistant",
+                "content": "",
+                "tool_calls": [
+                    {
+                        "id": call["id"],
+                        "type": "function",
+                        "function": {
+                            "name": call["name"],
+                            "arguments": call.get("raw_arguments") or json.dumps(call["arguments"])
+                        }
+                    }
+                    for call in calls
+                ]
+            })
+
+            results = await self.registry.execute_all(calls, budget=budget - used)
+            for result in results:
+                used += result["tokens"]
+                messages.append({
+                    "role": "tool",
+                    "tool_call_id": result["tool_call_id"],
+                    "name": result["name"],
+                    "content": result["content"]
+                })
+                executed.append({k: result[k] for k in ("name", "status", "latency_ms")})
+                sources.extend(s for s in result["sources"] if s not in sources)
+
+        # Out of rounds: answer from what the tools returned so far. The history
+        # holds tool turns, so the tools stay declared but may not be called.
+        response = await self.llm.generate_with_tools(
+            messages, self.registry.schemas(), temperature, tool_choice="none", deadline=deadline
+        )
+        return {"answer": response.get("content") or "", "sources": sources, "tool_calls": executed, "tokens": used}
+
+
+async def search_documents(query: str, top_k: int = 3) -> List[Dict]:
+    """Bank policy and FAQ passages relevant to query (top_k clamped to 1..RERANK_TOP_K)"""
+    top_k = max(1, min(int(top_k), settings.RERANK_TOP_K))
+    docs = await retriever.retrieve(query, top_k=top_k)
+    return [{"source": d["metadata"].get("source"), "text": d["text"]} for d in docs]
+
+
+async def web_search(query: str) -> List[Dict]:
+    """Banking information from the web"""
+    results = await tavily_client.search_banking_info(query)
+    return [{"title": r["title"], "url": r["url"], "content": r["content"]} for r in results]
+
+
+async def get_current_rates(bank_name: Optional[str] = None) -> List[Dict]:
+    """Current savings and checking interest rates"""
+    results = await tavily_client.get_current_rates(bank_name)
+    return [{"title": r["title"], "url": r["url"], "content": r["content"]} for r in results]
+
+
+def default_tools() -> List[Tool]:
+    """Retriever search, web search and rate lookup"""
+    return [
+        Tool(
+            name="search_documents",
+            description="Search the bank's policy documents and FAQs.",
+            parameters={
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "What to look up"},
+                    "top_k": {
+                        "type": "integer",
+                        "description": f"Number of passages (default 3, at most {settings.RERANK_TOP_K})"
+                    }
+                },
+                "required": ["query"]
+            },
+            func=search_documents,
+            timeout=settings.HYBRID_RAG_TIMEOUT
+        ),
+        Tool(
+            name="web_search",
+            description="Search the web for current banking information.",
+            parameters={
+                "type": "object",
+                "properties": {"query": {"type": "string", "description": "Search query"}},
+                "required": ["query"]
+            },
+            func=web_search,
+            timeout=settings.HYBRID_SEARCH_TIMEOUT
+        ),
+        Tool(
+            name="get_current_rates",
+            description="Look up current savings and checking interest rates, optionally for one bank.",
+            parameters={
+                "type": "object",
+                "properties": {"bank_name": {"type": "string", "description": "Bank to look up"}},
+                "required": []
+            },
+            func=get_current_rates,
+            timeout=settings.HYBRID_SEARCH_TIMEOUT
+        )
+    ]
+
+
+# Global tool registry and runner
+tool_registry = ToolRegistry(default_tools())
+tool_runner = ToolRunner(tool_registry)
@@ -0,0 +1,146 @@
+﻿"""
+Approximate nearest-neighbour index for the local vector store
+Inverted-file (IVF) index: vectors are bucketed by their nearest k-means centroid
+and a query only scans the rows of its nprobe closest buckets
+"""
+from pathlib import Path
+from typing import Optional
+import numpy as np
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class IVFIndex:
+    """
+    IVF index over the rows of a normalized float32 matrix
+
+    The index stores only centroids and one list assignment per row; vectors
+    stay in the store's memory-mapped file. Recall/speed is tuned with nprobe
+    (more probed lists = higher recall, more rows scanned).
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        dimension: int,
+        nlist: Optional[int] = None,
+        nprobe: Optional[int] = None
+    ):
+        """
+        Args:
+            path: Directory holding ivf_centroids.npy / ivf_assignments.npy
+            dimension: Vector dimension
+            nlist: Number of lists (0 or None = sized from the corpus at training)
+            nprobe: Lists scanned per query
+        """
+        self.path = Path(path)
+        self.dimension = dimension
+        self.nlist = nlist if nlist is not None else settings.IVF_NLIST
+        self.nprobe = nprobe or settings.IVF_NPROBE
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments = np.empty(0, dtype=np.int32)
+        self._order = np.empty(0, dtype=np.int64)
+        self._bounds = np.zeros(1, dtype=np.int64)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def train(self, vectors: np.ndarray, iterations: int = 10, seed: int = 0):
+        """Fit centroids with spherical k-means and assign every row"""
+        count = len(vectors)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(count)))
+        nlist = min(nlist, count)
+        rng = np.random.default_rng(seed)
+
+        # A few hundred points per centroid is plenty for k-means
+        sample_size = min(count, nlist * 256)
+        sample = np.asarray(vectors[np.sort(rng.choice(count, sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=nlist) == 0
+            # Re-seed empty lists from random points so no centroid is wasted
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+
+        self.centroids = centroids.astype(np.float32)
+        self.assignments = np.empty(0, dtype=np.int32)
+        self.add(vectors)
+        logger.info(f"Trained IVF index with {nlist} lists on {count} vectors")
+
+    def add(self, vectors: np.ndarray, chunk_size: int = 65536):
+        """Assign appended rows to their nearest list"""
+        if not self.is_trained or not len(vectors):
+            return
+        labels = [
+            np.argmax(np.asarray(vectors[start:start + chunk_size]) @ self.centroids.T, axis=1)
+            for start in range(0, len(vectors), chunk_size)
+        ]
+        self.assignments = np.concatenate([self.assignments, *labels]).astype(np.int32)
+        self._rebuild_lists()
+
+    def update(self, rows: np.ndarray, vectors: np.ndarray):
+        """Reassign rows whose vectors were overwritten"""
+        if not self.is_trained or not len(rows):
+            return
+        self.assignments[rows] = np.argmax(np.asarray(vectors) @ self.centroids.T, axis=1)
+        self._rebuild_lists()
+
+    def candidates(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """Rows in the nprobe lists closest to a normalized query"""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self._order[self._bounds[lst]:self._bounds[lst + 1]] for lst in probe])
+
+    def remove(self, rows: np.ndarray):
+        """Drop the assignments of deleted rows (later rows shift down)"""
+        if not self.is_trained or not len(rows):
+            return
+        self.assignments = np.delete(self.assignments, rows)
+        self._rebuild_lists()
+
+    def truncate(self, count: int):
+        """Drop assignments past count (rows not yet published by the store)"""
+        if len(self.assignments) > count:
+            self.assignments = self.assignments[:count]
+            self._rebuild_lists()
+
+    def save(self):
+        """Persist centroids and assignments"""
+        if not self.is_trained:
+            return
+        for name, array in (("ivf_centroids.npy", self.centroids), ("ivf_assignments.npy", self.assignments)):
+            tmp_path = self.path / (name + ".tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            tmp_path.replace(self.path / name)
+
+    def load(self) -> bool:
+        """Load a persisted index; returns False if none exists"""
+        centroids_path = self.path / "ivf_centroids.npy"
+        assignments_path = self.path / "ivf_assignments.npy"
+        if not (centroids_path.exists() and assignments_path.exists()):
+            return False
+
+        centroids = np.load(centroids_path)
+        if centroids.shape[1] != self.dimension:
+            logger.warning("Ignoring IVF index built for a different dimension")
+            return False
+
+        self.centroids = centroids
+        self.assignments = np.load(assignments_path)
+        self._rebuild_lists()
+        return True
+
+    def _rebuild_lists(self):
+        """Group row ids by list for contiguous per-list slices"""
+        self._order = np.argsort(self.assignments, kind="stable")
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self._bounds = np.concatenate([[0], np.cumsum(counts)])
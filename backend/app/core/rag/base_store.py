@@ -0,0 +1,140 @@
+﻿"""
+Vector store interface implemented by all backends
+"""
+import asyncio
+from typing import Any, List, Dict, Optional
+from uuid import NAMESPACE_URL, uuid5
+import numpy as np
+
+# Namespace for content-derived point ids
+POINT_ID_NAMESPACE = uuid5(NAMESPACE_URL, "bank-support-ai/chunks")
+
+
+def make_point_id(text: str, metadata: Dict) -> str:
+    """
+    Deterministic point id for a chunk
+    
+    Derived from the chunk's source and text, so re-ingesting a file
+    overwrites its existing points instead of duplicating them.
+    """
+    return str(uuid5(POINT_ID_NAMESPACE, f"{metadata.get('source', '')}\x00{text}"))
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """
+    Normalize metadata filters to {field: [allowed values]}
+    
+    Filters map a metadata field to one value or a list of values; a document
+    matches when every field has one of its allowed values.
+    """
+    return {
+        field: list(value) if isinstance(value, (list, tuple, set)) else [value]
+        for field, value in (filters or {}).items()
+        if value is not None
+    }
+
+
+def matches_filters(metadata: Dict, filters: Optional[Dict[str, Any]]) -> bool:
+    """Check a document's metadata against filters"""
+    return all(metadata.get(field) in values for field, values in normalize_filters(filters).items())
+
+
+class VectorStore:
+    """Interface shared by vector store backends"""
+    
+    def add_documents(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadata: List[Dict],
+        ids: Optional[List[str]] = None
+    ) -> List[str]:
+        """
+        Upsert documents (embeddings as a (n, dim) float32 array)
+        
+        Ids default to make_point_id, so adding the same chunk twice is idempotent
+        """
+        raise NotImplementedError
+    
+    def search(
+        self,
+        query_embedding: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[Dict]:
+        """Search for similar documents (cosine similarity scores), optionally filtered by metadata"""
+        raise NotImplementedError
+    
+    def search_batch(
+        self,
+        query_embeddings: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict]]:
+        """Search several query vectors ((n, dim) array) in one round trip"""
+        return [self.search(query, limit, score_threshold, filters) for query in query_embeddings]
+    
+    def get_vectors(self, ids: List[str]) -> np.ndarray:
+        """Stored vectors of ids as a (len(ids), dim) float32 array (zero rows for unknown ids)"""
+        raise NotImplementedError
+    
+    def get_documents(self, ids: List[str]) -> List[Optional[Dict]]:
+        """Stored {"id", "text", "metadata"} of ids, in order (None for unknown ids)"""
+        raise NotImplementedError
+    
+    def delete_stale(self, source: str, keep_ids: List[str]) -> List[str]:
+        """
+        Delete the points of source whose ids are not in keep_ids
+        
+        Called after re-ingesting an edited file: chunks it no longer produces
+        have ids of their own and would otherwise stay searchable. Returns the
+        deleted ids.
+        """
+        raise NotImplementedError
+    
+    async def aadd_documents(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadata: List[Dict],
+        ids: Optional[List[str]] = None
+    ) -> List[str]:
+        """Async add_documents (runs the sync version on a worker thread by default)"""
+        return await asyncio.to_thread(self.add_documents, texts, embeddings, metadata, ids)
+    
+    async def asearch(
+        self,
+        query_embedding: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[Dict]:
+        """Async search (runs the sync version on a worker thread by default)"""
+        return await asyncio.to_thread(self.search, query_embedding, limit, score_threshold, filters)
+    
+    async def asearch_batch(
+        self,
+        query_embeddings: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict]]:
+        """Async search_batch (runs the sync version on a worker thread by default)"""
+        return await asyncio.to_thread(self.search_batch, query_embeddings, limit, score_threshold, filters)
+    
+    async def aget_vectors(self, ids: List[str]) -> np.ndarray:
+        """Async get_vectors (runs the sync version on a worker thread by default)"""
+        return await asyncio.to_thread(self.get_vectors, ids)
+    
+    async def aget_documents(self, ids: List[str]) -> List[Optional[Dict]]:
+        """Async get_documents (runs the sync version on a worker thread by default)"""
+        return await asyncio.to_thread(self.get_documents, ids)
+    
+    async def adelete_stale(self, source: str, keep_ids: List[str]) -> List[str]:
+        """Async delete_stale (runs the sync version on a worker thread by default)"""
+        return await asyncio.to_thread(self.delete_stale, source, keep_ids)
+    
+    async def close(self):
+        """Release client resources"""
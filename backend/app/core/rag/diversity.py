@@ -0,0 +1,60 @@
+﻿"""
+Result diversification
+Maximal marginal relevance (MMR) selection with near-duplicate suppression
+"""
+from typing import List
+import numpy as np
+from app.core.rag.vector_ops import as_float32, l2_normalize
+
+
+def mmr_select(
+    vectors: np.ndarray,
+    relevance: np.ndarray,
+    k: int,
+    lambda_mult: float = 0.7,
+    duplicate_threshold: float = 0.95
+) -> List[int]:
+    """
+    Pick up to k diverse, relevant candidates
+    
+    The pairwise cosine similarity of all candidates is computed once as a
+    matrix product; each step then takes the candidate maximizing
+    lambda * relevance - (1 - lambda) * (max similarity to the picks so far).
+    Candidates at or above duplicate_threshold similarity to a pick are dropped.
+    
+    Args:
+        vectors: (n, dim) candidate vectors
+        relevance: (n,) relevance scores (higher is better, any scale)
+        k: Maximum number of picks
+        lambda_mult: Relevance vs diversity trade-off (1 = relevance only)
+        duplicate_threshold: Cosine similarity treated as a duplicate
+        
+    Returns:
+        Indices of the picks, in selection order
+    """
+    count = len(vectors)
+    if count == 0 or k <= 0:
+        return []
+    
+    normalized = l2_normalize(np.atleast_2d(as_float32(vectors)))
+    similarity = normalized @ normalized.T
+    
+    relevance = np.asarray(relevance, dtype=np.float32)
+    spread = relevance.max() - relevance.min()
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones(count, dtype=np.float32)
+    
+    available = np.ones(count, dtype=bool)
+    redundancy = np.zeros(count, dtype=np.float32)
+    picks = []
+    
+    while len(picks) < k and available.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy if picks else relevance.copy()
+        scores[~available] = -np.inf
+        pick = int(np.argmax(scores))
+        picks.append(pick)
+        
+        available[pick] = False
+        available &= similarity[pick] < duplicate_threshold
+        redundancy = np.maximum(redundancy, similarity[pick])
+    
+    return picks
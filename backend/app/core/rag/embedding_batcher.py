@@ -0,0 +1,123 @@
+﻿"""
+Micro-batching executor for embeddings
+Groups concurrent embedding requests into small batches run on a worker thread
+(the reranker batches its (query, text) pairs the same way)
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+import numpy as np
+from app.config import settings
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    Collects concurrent requests and encodes them together
+
+    The first pending request opens a batch window; the batch is flushed when
+    the window (max_wait_ms) elapses or max_batch_size texts are waiting,
+    whichever comes first. Encoding runs on a dedicated thread so the event
+    loop stays responsive while the model runs.
+    """
+
+    def __init__(
+        self,
+        encode: Callable[[List[Any]], np.ndarray],
+        max_batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None,
+        name: str = "embedding"
+    ):
+        """
+        Args:
+            encode: Function turning a list of items (texts) into one result row each
+            max_batch_size: Maximum items per forward pass
+            max_wait_ms: How long to wait for more requests after the first
+            name: Thread name and metrics prefix ("<name>_batch_size")
+        """
+        self.encode = encode
+        self.name = name
+        self.max_batch_size = max_batch_size or settings.EMBEDDING_BATCH_MAX_SIZE
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else settings.EMBEDDING_BATCH_WAIT_MS) / 1000
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+
+    async def submit(self, text: str) -> np.ndarray:
+        """Embed one text as part of the next batch"""
+        return (await self.submit_many([text]))[0]
+
+    async def submit_many(self, texts: List[Any]) -> List[np.ndarray]:
+        """
+        Embed several texts, possibly sharing batches with other requests
+
+        Cancelled requests are dropped from batches that have not started yet.
+        """
+        self._ensure_worker()
+        futures = []
+        for text in texts:
+            future = self._loop.create_future()
+            self._pending.append((text, future))
+            futures.append(future)
+
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch_size:
+            self._full.set()
+        return list(await asyncio.gather(*futures))
+
+    def _ensure_worker(self):
+        """Start the batching task on the running loop"""
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._pending = []
+            self._wakeup = asyncio.Event()
+            self._full = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        """Flush pending requests in batches"""
+        while True:
+            await self._wakeup.wait()
+
+            # Give concurrent requests a short window to join the batch
+            if len(self._pending) < self.max_batch_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = self._pending[:self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size:]
+            self._full.clear()
+            if not self._pending:
+                self._wakeup.clear()
+
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if batch:
+                await self._encode_batch(batch)
+
+    async def _encode_batch(self, batch: List[Tuple[Any, asyncio.Future]]):
+        """Encode one batch on the worker thread and resolve its futures"""
+        try:
+            vectors = await self._loop.run_in_executor(
+                self._executor,
+                self.encode,
+                [text for text, _ in batch]
+            )
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        except Exception as e:
+            logger.error(f"Error encoding {self.name} batch: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+        metrics.observe(f"{self.name}_batch_size", len(batch))
@@ -0,0 +1,258 @@
+﻿"""
+Shared embedding server
+Serves embeddings (and reranker scores) over a local Unix socket so multiple
+API workers share one copy of each model
+
+Run with:
+    python -m app.core.rag.embedding_server --socket /tmp/bank-embeddings.sock
+
+Wire format (network byte order headers, little-endian float32 payload):
+    request:  op (uint8), count (uint32), then per text: length (uint32) + UTF-8 bytes
+    response: status (uint8), rows (uint32), dim (uint32), then rows * dim float32
+              on error status is 1, rows is the message length and the UTF-8 message follows
+
+    OP_RERANK sends query, text, query, text, ... and gets one score per pair (dim 1)
+"""
+import asyncio
+import os
+import socket
+import struct
+import threading
+from typing import List, Optional, Tuple
+import numpy as np
+from app.config import settings
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+OP_EMBED = 1
+OP_RERANK = 2
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+REQUEST_HEADER = struct.Struct("!BI")
+RESPONSE_HEADER = struct.Struct("!BII")
+LENGTH = struct.Struct("!I")
+VECTOR_DTYPE = np.dtype("<f4")
+
+
+def encode_request(texts: List[str], op: int = OP_EMBED) -> bytes:
+    """Serialize a request"""
+    parts = [REQUEST_HEADER.pack(op, len(texts))]
+    for text in texts:
+        data = text.encode("utf-8")
+        parts.append(LENGTH.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def encode_vectors(vectors: np.ndarray) -> bytes:
+    """Serialize a successful response"""
+    vectors = np.ascontiguousarray(vectors, dtype=VECTOR_DTYPE)
+    rows, dim = vectors.shape
+    return RESPONSE_HEADER.pack(STATUS_OK, rows, dim) + vectors.tobytes()
+
+
+def encode_error(message: str) -> bytes:
+    """Serialize an error response"""
+    data = message.encode("utf-8")
+    return RESPONSE_HEADER.pack(STATUS_ERROR, len(data), 0) + data
+
+
+def decode_vectors(payload: bytes, rows: int, dim: int) -> np.ndarray:
+    """Deserialize a vector payload without copying"""
+    return np.frombuffer(payload, dtype=VECTOR_DTYPE).reshape(rows, dim)
+
+
+class EmbeddingServerError(Exception):
+    """Raised when the embedding server reports an error"""
+
+
+class EmbeddingClient:
+    """Client for the embedding server (sync and async)"""
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        self.socket_path = socket_path
+        self.timeout = timeout or settings.EMBEDDING_SERVER_TIMEOUT
+        self._local = threading.local()
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._idle_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts over a blocking per-thread connection"""
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+
+        try:
+            sock.sendall(encode_request(texts))
+            status, rows, dim = RESPONSE_HEADER.unpack(self._recv_exactly(sock, RESPONSE_HEADER.size))
+            if status != STATUS_OK:
+                raise EmbeddingServerError(self._recv_exactly(sock, rows).decode("utf-8"))
+            return decode_vectors(self._recv_exactly(sock, rows * dim * VECTOR_DTYPE.itemsize), rows, dim)
+        except (OSError, struct.error):
+            sock.close()
+            self._local.sock = None
+            raise
+
+    async def aembed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts over a pooled asyncio connection (connect and exchange each bounded by the timeout)"""
+        return await self._request(OP_EMBED, texts)
+
+    async def arerank(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        """Cross-encoder scores of (query, text) pairs"""
+        texts = [text for pair in pairs for text in pair]
+        return (await self._request(OP_RERANK, texts))[:, 0]
+
+    async def _request(self, op: int, texts: List[str]) -> np.ndarray:
+        """One request/response exchange on a pooled connection"""
+        reader, writer = await self._acquire()
+        try:
+            status, rows, dim, payload = await asyncio.wait_for(
+                self._exchange(reader, writer, op, texts), self.timeout
+            )
+        except BaseException:
+            # Timeouts, disconnects and cancellation (e.g. a hybrid branch
+            # timing out) can leave unread bytes: never return it to the pool
+            writer.close()
+            raise
+        self._release(reader, writer)
+        if status != STATUS_OK:
+            raise EmbeddingServerError(payload.decode("utf-8"))
+        return decode_vectors(payload, rows, dim)
+
+    @staticmethod
+    async def _exchange(
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        op: int,
+        texts: List[str]
+    ) -> Tuple[int, int, int, bytes]:
+        """Send one request and read its full response (error message or vectors)"""
+        writer.write(encode_request(texts, op))
+        await writer.drain()
+        status, rows, dim = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+        size = rows if status != STATUS_OK else rows * dim * VECTOR_DTYPE.itemsize
+        return status, rows, dim, await reader.readexactly(size)
+
+    async def _acquire(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Reuse an idle connection or open a new one"""
+        loop = asyncio.get_running_loop()
+        if self._idle_loop is not loop:
+            self._idle, self._idle_loop = [], loop
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing():
+                return reader, writer
+        return await asyncio.wait_for(asyncio.open_unix_connection(self.socket_path), self.timeout)
+
+    def _release(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Return a healthy connection to the pool"""
+        self._idle.append((reader, writer))
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, size: int) -> bytearray:
+        """Read exactly size bytes from a socket"""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = sock.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Embedding server closed the connection")
+            received += count
+        return buffer
+
+
+class EmbeddingServer:
+    """Unix socket server wrapping a local EmbeddingService (and optionally a reranker)"""
+
+    def __init__(self, service, socket_path: str, reranker=None):
+        self.service = service
+        self.socket_path = socket_path
+        self.reranker = reranker
+
+    async def serve(self):
+        """Serve until cancelled"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        logger.info(f"Embedding server ({self.service.model_name}) listening on {self.socket_path}")
+        async with server:
+            await server.serve_forever()
+
+    async def _embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts; requests from all workers share the service's micro-batches"""
+        if not texts:
+            return np.empty((0, self.service.dimension), dtype=VECTOR_DTYPE)
+        return np.stack(await self.service.batcher.submit_many(texts))
+
+    async def _rerank(self, texts: List[str]) -> np.ndarray:
+        """Score (query, text) pairs; requests from all workers share the reranker's micro-batches"""
+        if self.reranker is None:
+            raise EmbeddingServerError("Reranking is not enabled on this server")
+        scores = await self.reranker.score_pairs(list(zip(texts[0::2], texts[1::2])))
+        return np.asarray(scores, dtype=VECTOR_DTYPE).reshape(-1, 1)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer requests on one connection until the client disconnects"""
+        try:
+            while True:
+                try:
+                    op, count = REQUEST_HEADER.unpack(await reader.readexactly(REQUEST_HEADER.size))
+                except asyncio.IncompleteReadError:
+                    break
+
+                texts = []
+                for _ in range(count):
+                    (length,) = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+                    texts.append((await reader.readexactly(length)).decode("utf-8"))
+
+                handler = {OP_EMBED: self._embed, OP_RERANK: self._rerank}.get(op)
+                if handler is None:
+                    writer.write(encode_error(f"Unknown op: {op}"))
+                else:
+                    try:
+                        writer.write(encode_vectors(await handler(texts)))
+                    except Exception as e:
+                        logger.error(f"Error serving request (op {op}): {e}")
+                        writer.write(encode_error(str(e)))
+                await writer.drain()
+        except Exception as e:
+            logger.error(f"Embedding server connection error: {e}")
+        finally:
+            writer.close()
+
+
+async def main():
+    """Start the embedding server"""
+    import argparse
+    from app.core.rag.embeddings import EmbeddingService, embedding_service
+    from app.core.rag.reranker import CrossEncoderReranker
+
+    parser = argparse.ArgumentParser(description="Serve embeddings over a Unix socket")
+    parser.add_argument(
+        "--socket",
+        type=str,
+        default=settings.EMBEDDING_SERVER_SOCKET or "/tmp/bank-embeddings.sock",
+        help="Unix socket path"
+    )
+    args = parser.parse_args()
+
+    # This process holds the shared model copy, so it must never be a client of itself
+    service = embedding_service
+    if service.remote is not None:
+        service = EmbeddingService(socket_path="")
+    reranker = None
+    if settings.RERANKER_ENABLED:
+        reranker = CrossEncoderReranker(socket_path="")
+        reranker.load()
+    await EmbeddingServer(service, args.socket, reranker).serve()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,56 +1,197 @@
 ﻿"""
 Embedding generation for RAG
-Converts text into vector representations
+Converts text into vector representations (contiguous float32 NumPy arrays)
 """
-from sentence_transformers import SentenceTransformer
-from typing import List
+from typing import Dict, List, Optional
 import numpy as np
 from app.config import settings
+from app.core.rag.embedding_batcher import EmbeddingBatcher
+from app.core.rag.embedding_server import EmbeddingClient
+from app.core.rag.vector_ops import as_float32, l2_normalize
+from app.utils.cache import LRUCache
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
 
+class EmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings
+    
+    Keys are (embedding model, whitespace/case-normalized text), so switching
+    EMBEDDING_MODEL never serves vectors from another model; entries of the
+    old model simply age out. Values are stored as compact float32 arrays.
+    """
+    
+    def __init__(self, model_name: str, max_entries: int = None, max_bytes: int = None):
+        self.model_name = model_name
+        self.cache = LRUCache(
+            name="embedding",
+            max_entries=max_entries or settings.EMBEDDING_CACHE_MAX_ENTRIES,
+            max_bytes=max_bytes or settings.EMBEDDING_CACHE_MAX_BYTES,
+            sizeof=lambda vector: vector.nbytes
+        )
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalize query text for cache lookups"""
+        return " ".join(text.lower().split())
+    
+    def get(self, model_name: str, text: str) -> Optional[np.ndarray]:
+        """Get cached embedding"""
+        return self.cache.get((model_name, self.normalize(text)))
+    
+    def set(self, model_name: str, text: str, embedding: np.ndarray) -> np.ndarray:
+        """
+        Store embedding as float32
+        
+        Stores a read-only copy (a row view would pin its whole batch in memory)
+        and returns it so callers can share the cached array.
+        """
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
+        self.cache.set((model_name, self.normalize(text)), embedding)
+        return embedding
+    
+    def stats(self) -> Dict:
+        """Get hit/miss/eviction counters"""
+        return {"model": self.model_name, **self.cache.stats()}
+
+
 class EmbeddingService:
     """Service for generating text embeddings"""
     
-    def __init__(self, model_name: str = None):
-        """Initialize embedding model"""
+    def __init__(self, model_name: str = None, socket_path: Optional[str] = None):
+        """
+        Initialize embedding model
+        
+        When an embedding server socket is configured the service is a thin
+        client and never loads the model (or torch) in this process.
+        """
         self.model_name = model_name or settings.EMBEDDING_MODEL
-        logger.info(f"Loading embedding model: {self.model_name}")
-        self.model = SentenceTransformer(self.model_name)
+        self.socket_path = settings.EMBEDDING_SERVER_SOCKET if socket_path is None else socket_path
+        
+        if self.socket_path:
+            logger.info(f"Using embedding server at {self.socket_path}")
+            self.model = None
+            self.remote = EmbeddingClient(self.socket_path)
+        else:
+            from sentence_transformers import SentenceTransformer
+            
+            logger.info(f"Loading embedding model: {self.model_name}")
+            self.model = SentenceTransformer(self.model_name)
+            self.remote = None
+        
         self.dimension = settings.EMBEDDING_DIMENSION
+        self.cache = EmbeddingCache(self.model_name)
+        self.batcher = EmbeddingBatcher(self._encode)
         
-    def embed_text(self, text: str) -> List[float]:
-        """Generate embedding for single text"""
+    def embed_text(self, text: str) -> np.ndarray:
+        """Generate embedding for single text (cached, read-only float32)"""
+        try:
+            cached = self.cache.get(self.model_name, text)
+            if cached is not None:
+                return cached
+            
+            if self.remote:
+                embedding = self.remote.embed([text])[0]
+            else:
+                embedding = self.model.encode(text, convert_to_numpy=True)
+            return self.cache.set(self.model_name, text, embedding)
+        except Exception as e:
+            logger.error(f"Error generating embedding: {e}")
+            raise
+    
+    async def aembed_text(self, text: str) -> np.ndarray:
+        """Generate embedding for single text without blocking the event loop"""
         try:
-            embedding = self.model.encode(text, convert_to_numpy=True)
-            return embedding.tolist()
+            cached = self.cache.get(self.model_name, text)
+            if cached is not None:
+                return cached
+            
+            if self.remote:
+                embedding = (await self.remote.aembed([text]))[0]
+            else:
+                embedding = await self.batcher.submit(text)
+            return self.cache.set(self.model_name, text, embedding)
         except Exception as e:
             logger.error(f"Error generating embedding: {e}")
             raise
     
-    def embed_batch(self, texts: List[str], batch_size: int = 32) -> List[List[float]]:
-        """Generate embeddings for multiple texts"""
+    async def aembed_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed several queries in one call without blocking the event loop
+
+        Cached texts are skipped; the rest go to the model as a single batch.
+        Returns a (len(texts), dim) float32 array.
+        """
+        try:
+            embeddings = [self.cache.get(self.model_name, text) for text in texts]
+            missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+            if missing:
+                pending = [texts[i] for i in missing]
+                if self.remote:
+                    encoded = await self.remote.aembed(pending)
+                else:
+                    encoded = await self.batcher.submit_many(pending)
+                for i, embedding in zip(missing, encoded):
+                    embeddings[i] = self.cache.set(self.model_name, texts[i], embedding)
+
+            return np.stack(embeddings)
+        except Exception as e:
+            logger.error(f"Error generating batch embeddings: {e}")
+            raise
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Encode a micro-batch (runs on the batcher's worker thread)"""
+        return self.model.encode(
+            texts,
+            batch_size=len(texts),
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+    
+    def embed_batch(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """Generate embeddings for multiple texts as a (len(texts), dim) float32 array"""
         try:
             logger.info(f"Generating embeddings for {len(texts)} texts")
+            if self.remote:
+                return as_float32(self.remote.embed(texts))
+            
             embeddings = self.model.encode(
                 texts,
                 batch_size=batch_size,
                 convert_to_numpy=True,
                 show_progress_bar=True
             )
-            return embeddings.tolist()
+            return as_float32(embeddings)
         except Exception as e:
             logger.error(f"Error generating batch embeddings: {e}")
             raise
     
-    def similarity(self, embedding1: List[float], embedding2: List[float]) -> float:
+    def similarity(self, embedding1: np.ndarray, embedding2: np.ndarray) -> float:
         """Calculate cosine similarity between embeddings"""
-        vec1 = np.array(embedding1)
-        vec2 = np.array(embedding2)
+        vec1 = as_float32(embedding1)
+        vec2 = as_float32(embedding2)
         similarity = np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
         return float(similarity)
+    
+    @staticmethod
+    def similarity_matrix(embeddings1: np.ndarray, embeddings2: np.ndarray) -> np.ndarray:
+        """
+        Calculate cosine similarity between every pair of rows
+        
+        Args:
+            embeddings1: (n, dim) array (or a single vector)
+            embeddings2: (m, dim) array (or a single vector)
+            
+        Returns:
+            (n, m) float32 similarity matrix
+        """
+        left = l2_normalize(np.atleast_2d(embeddings1))
+        right = l2_normalize(np.atleast_2d(embeddings2))
+        return left @ right.T
 
 
 # Global embedding service
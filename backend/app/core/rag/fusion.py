@@ -0,0 +1,49 @@
+﻿"""
+Rank fusion for combining several result lists
+"""
+from typing import Dict, List, Optional
+
+
+def reciprocal_rank_fusion(
+    result_lists: List[List[Dict]],
+    weights: Optional[List[float]] = None,
+    k: int = 60,
+    limit: Optional[int] = None
+) -> List[Dict]:
+    """
+    Combine ranked result lists with (weighted) reciprocal rank fusion
+    
+    Each document scores sum(weight / (k + rank)) over the lists it appears in.
+    Documents are matched by "id"; the first copy seen is kept and its fused
+    score is stored under "rrf_score".
+    
+    Args:
+        result_lists: Ranked lists of result dicts (best first)
+        weights: Optional per-list weights (default 1.0)
+        k: Rank damping constant
+        limit: Maximum results to return
+        
+    Returns:
+        Fused results, best first
+    """
+    weights = weights or [1.0] * len(result_lists)
+    fused: Dict[str, Dict] = {}
+    scores: Dict[str, float] = {}
+    
+    for results, weight in zip(result_lists, weights):
+        for rank, doc in enumerate(results, start=1):
+            doc_id = str(doc["id"])
+            if doc_id not in fused:
+                fused[doc_id] = doc
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank)
+    
+    ranked = sorted(fused, key=lambda doc_id: scores[doc_id], reverse=True)
+    if limit is not None:
+        ranked = ranked[:limit]
+    
+    documents = []
+    for doc_id in ranked:
+        doc = fused[doc_id]
+        doc["rrf_score"] = scores[doc_id]
+        documents.append(doc)
+    return documents
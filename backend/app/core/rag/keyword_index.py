@@ -0,0 +1,208 @@
+﻿"""
+BM25 keyword index over ingested chunks
+Catches exact-term queries (fee names, product names, "wire cutoff") that
+embeddings rank poorly; results share point ids with the vector store
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from heapq import nlargest
+from pathlib import Path
+from typing import Any, List, Dict, Optional
+from app.config import settings
+from app.core.rag.base_store import matches_filters
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it me my of on or "
+    "the this to was what when where which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase alphanumeric terms without stopwords"""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class KeywordIndex:
+    """
+    Inverted index with BM25 scoring
+
+    Persisted as JSON (metadata and term counts per point id; chunk texts live
+    in the vector store under the same ids) and updated incrementally by the
+    ingestion script, which defers saving to the end of a run; request handlers
+    reload it when the file changes on disk.
+    """
+
+    def __init__(self, path: Optional[str] = None, k1: Optional[float] = None, b: Optional[float] = None):
+        """Load the index file if it exists"""
+        self.path = Path(path or settings.KEYWORD_INDEX_PATH)
+        self.k1 = k1 if k1 is not None else settings.BM25_K1
+        self.b = b if b is not None else settings.BM25_B
+
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._dirty = False
+        self._load()
+
+    @property
+    def count(self) -> int:
+        return len(self.documents)
+
+    def add_documents(self, ids: List[str], texts: List[str], metadata: List[Dict], save: bool = True):
+        """
+        Upsert chunks by point id (re-ingested chunks replace their old terms)
+
+        With save=False the change stays in memory until save(), so a run over
+        many files writes the index once instead of once per file.
+        """
+        with self._lock:
+            self._maybe_reload()
+            for doc_id, text, meta in zip(ids, texts, metadata):
+                doc_id = str(doc_id)
+                if doc_id in self.documents:
+                    self._unindex(doc_id)
+                terms = dict(Counter(tokenize(text)))
+                self.documents[doc_id] = {"metadata": meta, "terms": terms}
+                self._index(doc_id, terms)
+            self._dirty = True
+            if save:
+                self._save()
+        logger.info(f"Indexed {len(ids)} chunks for keyword search ({self.count} total)")
+
+    def save(self):
+        """Write changes made with save=False"""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def delete_stale(self, source: str, keep_ids: List[str], save: bool = True) -> List[str]:
+        """Drop the source's chunks whose ids are not in keep_ids; returns their ids"""
+        keep = {str(doc_id) for doc_id in keep_ids}
+        with self._lock:
+            self._maybe_reload()
+            stale = [
+                doc_id for doc_id, doc in self.documents.items()
+                if doc["metadata"].get("source") == source and doc_id not in keep
+            ]
+            for doc_id in stale:
+                self._unindex(doc_id)
+                del self.documents[doc_id]
+            if stale:
+                self._dirty = True
+                if save:
+                    self._save()
+        if stale:
+            logger.info(f"Removed {len(stale)} stale chunks of {source} from the keyword index")
+        return stale
+
+    def search(self, query: str, limit: int = 10, filters: Optional[Dict[str, Any]] = None) -> List[Dict]:
+        """Top chunks by BM25 score (id, score and metadata; no text)"""
+        return self.search_batch([query], limit, filters)[0]
+
+    def search_batch(
+        self,
+        queries: List[str],
+        limit: int = 10,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict]]:
+        """BM25 search for several queries"""
+        with self._lock:
+            self._maybe_reload()
+            return [self._search(query, limit, filters) for query in queries]
+
+    def _search(self, query: str, limit: int, filters: Optional[Dict[str, Any]]) -> List[Dict]:
+        """Score documents sharing a term with the query (caller holds the lock)"""
+        if not self.documents or limit <= 0:
+            return []
+
+        count = len(self.documents)
+        avg_length = self._total_length / count
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        if filters:
+            scores = {
+                doc_id: score for doc_id, score in scores.items()
+                if matches_filters(self.documents[doc_id]["metadata"], filters)
+            }
+
+        return [
+            {"id": doc_id, "score": score, "metadata": dict(self.documents[doc_id]["metadata"])}
+            for doc_id, score in nlargest(limit, scores.items(), key=lambda item: item[1])
+        ]
+
+    def _index(self, doc_id: str, terms: Dict[str, int]):
+        """Add a document's terms to the postings"""
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.lengths[doc_id] = sum(terms.values())
+        self._total_length += self.lengths[doc_id]
+
+    def _unindex(self, doc_id: str):
+        """Remove a document's terms from the postings"""
+        for term in self.documents[doc_id]["terms"]:
+            postings = self.postings.get(term, {})
+            postings.pop(doc_id, None)
+            if not postings:
+                self.postings.pop(term, None)
+        self._total_length -= self.lengths.pop(doc_id, 0)
+
+    def _maybe_reload(self):
+        """Pick up chunks indexed by another process (e.g. the ingestion script)"""
+        if self._dirty:
+            return  # unsaved changes of this process win
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime:
+            self._load()
+
+    def _load(self):
+        """Read the index file and rebuild the postings"""
+        self.documents: Dict[str, Dict] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.lengths: Dict[str, int] = {}
+        self._total_length = 0
+        self._mtime = None
+
+        if not self.path.exists():
+            return
+
+        self._mtime = os.stat(self.path).st_mtime_ns
+        stored = json.loads(self.path.read_text(encoding="utf-8"))["documents"]
+        # Index files written before texts were dropped still carry them
+        self.documents = {
+            doc_id: {"metadata": doc["metadata"], "terms": doc["terms"]}
+            for doc_id, doc in stored.items()
+        }
+        for doc_id, doc in self.documents.items():
+            self._index(doc_id, doc["terms"])
+        logger.info(f"Loaded keyword index ({self.count} chunks)")
+
+    def _save(self):
+        """Write the index via a temp file and rename"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps({"documents": self.documents}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+        self._dirty = False
+
+
+# Global keyword index
+keyword_index = KeywordIndex()
@@ -0,0 +1,496 @@
+﻿"""
+In-process vector store backed by memory-mapped NumPy files
+Suited to small corpora and tests: no vector database service required
+"""
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, List, Dict, Optional
+import numpy as np
+from app.config import settings
+from app.core.rag.ann_index import IVFIndex
+from app.core.rag.base_store import VectorStore, make_point_id, matches_filters, normalize_filters
+from app.core.rag.vector_ops import as_float32, l2_normalize
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Cosine search over normalized float32 vectors
+
+    Exact by default; with LOCAL_VECTOR_INDEX=ivf an IVF index narrows the scan
+    once the collection reaches IVF_MIN_TRAIN_SIZE vectors.
+
+    Files under <LOCAL_VECTOR_PATH>/<collection>/:
+        vectors.f32   - row-major (count, dim) normalized vectors, memory-mapped
+        payloads.bin  - append-only UTF-8 JSON payloads (text + metadata); dead bytes
+                        are reclaimed only by compact()
+        spans.npy     - (count, 2) int64 payload [start, end) per row
+        fields.json   - value vocabulary of each indexed metadata field
+        field_*.npy   - int32 value code per row for each indexed field (-1 = missing)
+        manifest.json - dimension, count and point ids (written last)
+        ivf_*.npy     - IVF centroids and per-row list assignments (optional)
+    """
+
+    def __init__(self, path: Optional[str] = None, collection_name: Optional[str] = None):
+        """Open (or create) the local collection"""
+        self.collection_name = collection_name or settings.VECTOR_DB_COLLECTION
+        self.path = Path(path or settings.LOCAL_VECTOR_PATH) / self.collection_name
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dimension = settings.EMBEDDING_DIMENSION
+        self.index = IVFIndex(self.path, self.dimension) if settings.LOCAL_VECTOR_INDEX == "ivf" else None
+        self.indexed_fields = list(settings.VECTOR_PAYLOAD_INDEXES)
+
+        self._lock = threading.Lock()
+        self._manifest_mtime = None
+        self._load()
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    def add_documents(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadata: List[Dict],
+        ids: Optional[List[str]] = None
+    ) -> List[str]:
+        """Upsert documents; existing ids are overwritten in place"""
+        try:
+            vectors = l2_normalize(np.atleast_2d(as_float32(embeddings)))
+            if vectors.shape[1] != self.dimension:
+                raise ValueError(f"Expected {self.dimension}-d vectors, got {vectors.shape[1]}")
+
+            ids = ids or [make_point_id(text, meta) for text, meta in zip(texts, metadata)]
+            payloads = [
+                json.dumps({"text": text, **meta}, ensure_ascii=False).encode("utf-8")
+                for text, meta in zip(texts, metadata)
+            ]
+
+            with self._lock:
+                self._maybe_reload()
+                self._upsert(vectors, payloads, metadata, ids)
+
+            logger.info(f"Upserted {len(ids)} documents")
+            return ids
+        except Exception as e:
+            logger.error(f"Error adding documents: {e}")
+            raise
+
+    def search(
+        self,
+        query_embedding: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None
+    ) -> List[Dict]:
+        """
+        Search for similar documents
+        
+        filters restrict results by metadata (indexed fields use the per-row
+        code arrays); nprobe overrides IVF_NPROBE when the IVF index is active
+        """
+        return self.search_batch(np.atleast_2d(query_embedding), limit, score_threshold, filters, nprobe)[0]
+
+    def search_batch(
+        self,
+        query_embeddings: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        nprobe: Optional[int] = None
+    ) -> List[List[Dict]]:
+        """
+        Search several query vectors at once
+        
+        Exact scans score every query with a single matrix-matrix product;
+        IVF probes are per query since each query visits different lists.
+        """
+        try:
+            with self._lock:
+                self._maybe_reload()
+                vectors = self._vectors
+                index = self.index if self.index is not None and self.index.is_trained else None
+                rows = self._filter_rows(filters) if filters else None
+
+            queries = l2_normalize(np.atleast_2d(as_float32(query_embeddings)))
+            if not len(vectors) or limit <= 0:
+                return [[] for _ in queries]
+
+            # Selective filters are cheaper to scan exactly than to probe
+            if index is not None and (rows is None or len(rows) > settings.IVF_MIN_TRAIN_SIZE):
+                hits = []
+                for query in queries:
+                    candidates = np.sort(index.candidates(query, nprobe))
+                    if rows is not None:
+                        candidates = np.intersect1d(candidates, rows, assume_unique=True)
+                    scores = vectors[candidates] @ query
+                    hits.append([(candidates[i], scores[i]) for i in self._top_rows(scores, limit, score_threshold)])
+            else:
+                scanned = vectors if rows is None else vectors[rows]
+                scores = scanned @ queries.T
+                hits = []
+                for column in scores.T:
+                    top = self._top_rows(column, limit, score_threshold)
+                    hits.append([(i if rows is None else rows[i], column[i]) for i in top])
+
+            results = [[self._document(row, score) for row, score in query_hits] for query_hits in hits]
+
+            logger.info(f"Found {sum(len(documents) for documents in results)} documents for {len(queries)} queries")
+            return results
+        except Exception as e:
+            logger.error(f"Error searching: {e}")
+            return [[] for _ in np.atleast_2d(query_embeddings)]
+
+    def get_vectors(self, ids: List[str]) -> np.ndarray:
+        """Stored (normalized) vectors by point id"""
+        with self._lock:
+            self._maybe_reload()
+            vectors = self._vectors
+            rows = [self._row_of.get(str(doc_id), -1) for doc_id in ids]
+
+        matrix = np.zeros((len(ids), self.dimension), dtype=np.float32)
+        found = [i for i, row in enumerate(rows) if row >= 0]
+        if found:
+            matrix[found] = vectors[[rows[i] for i in found]]
+        return matrix
+
+    def get_documents(self, ids: List[str]) -> List[Optional[Dict]]:
+        """Stored payloads by point id"""
+        with self._lock:
+            self._maybe_reload()
+            rows = [self._row_of.get(str(doc_id)) for doc_id in ids]
+            payloads = [None if row is None else self._payload(row) for row in rows]
+
+        return [
+            None if payload is None else {"id": doc_id, "text": payload.pop("text", ""), "metadata": payload}
+            for doc_id, payload in zip(ids, payloads)
+        ]
+
+    def delete_stale(self, source: str, keep_ids: List[str]) -> List[str]:
+        """Delete the source's rows whose ids are not in keep_ids"""
+        keep = {str(doc_id) for doc_id in keep_ids}
+        with self._lock:
+            self._maybe_reload()
+            rows = np.array(
+                [row for row in self._filter_rows({"source": source}) if self.ids[row] not in keep],
+                dtype=np.int64
+            )
+            stale = [self.ids[row] for row in rows]
+            if stale:
+                self._delete_rows(rows)
+
+        if stale:
+            logger.info(f"Deleted {len(stale)} stale points of {source}")
+        return stale
+
+    @staticmethod
+    def _top_rows(scores: np.ndarray, limit: int, score_threshold: Optional[float]) -> np.ndarray:
+        """Rows of the highest scores (above threshold), best first"""
+        candidates = np.arange(len(scores))
+        if score_threshold is not None:
+            candidates = np.flatnonzero(scores >= score_threshold)
+        if len(candidates) > limit:
+            part = np.argpartition(-scores[candidates], limit - 1)[:limit]
+            candidates = candidates[part]
+        return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+    def _filter_rows(self, filters: Dict[str, Any]) -> np.ndarray:
+        """Rows whose metadata matches filters (caller holds the lock)"""
+        mask = np.ones(self.count, dtype=bool)
+        unindexed = {}
+        for field, values in normalize_filters(filters).items():
+            if field not in self._field_codes:
+                unindexed[field] = values
+                continue
+            vocab = self._field_vocab[field]
+            allowed = [vocab.index(str(v)) for v in values if str(v) in vocab]
+            mask &= np.isin(self._field_codes[field], allowed)
+
+        rows = np.flatnonzero(mask)
+        if unindexed:
+            # Fall back to reading payloads for fields without an index
+            rows = np.array(
+                [row for row in rows if matches_filters(self._payload(row), unindexed)],
+                dtype=np.int64
+            )
+        return rows
+
+    def _payload(self, row: int) -> Dict:
+        """Decode one row's payload"""
+        start, end = self._spans[row]
+        return json.loads(self._payloads[start:end].tobytes().decode("utf-8"))
+
+    def _document(self, row: int, score: float) -> Dict:
+        """Build a result dict from the payload sidecar"""
+        payload = self._payload(row)
+        return {
+            "id": self.ids[row],
+            "score": float(score),
+            "text": payload.pop("text", ""),
+            "metadata": payload
+        }
+
+    def _upsert(self, vectors: np.ndarray, payloads: List[bytes], metadata: List[Dict], ids: List[str]):
+        """
+        Write rows to the data files, then publish them via the manifest
+        
+        Vectors of existing ids are overwritten in place. A changed payload is
+        appended at the physical end of payloads.bin and the row's span
+        repointed (old payload bytes are left behind, so readers still on the
+        previous manifest keep valid spans); an unchanged one keeps its bytes,
+        so re-ingesting the same corpus does not grow payloads.bin.
+        """
+        count = self.count
+        row_of = dict(self._row_of)
+        rows, new_ids = [], []
+        for doc_id in ids:
+            if doc_id not in row_of:
+                row_of[doc_id] = count + len(new_ids)
+                new_ids.append(doc_id)
+            rows.append(row_of[doc_id])
+        rows = np.asarray(rows, dtype=np.int64)
+        new_count = count + len(new_ids)
+
+        # Last write wins for ids repeated within the batch
+        rows, last = np.unique(rows[::-1], return_index=True)
+        last = len(ids) - 1 - last
+        vectors = vectors[last]
+        payloads = [payloads[i] for i in last]
+        metadata = [metadata[i] for i in last]
+
+        with open(self._file("vectors.f32"), "r+b" if count else "wb") as f:
+            f.truncate(new_count * self.dimension * 4)
+        mapped = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r+",
+                           shape=(new_count, self.dimension))
+        mapped[rows] = vectors
+        mapped.flush()
+        del mapped
+
+        changed = [
+            i for i, row in enumerate(rows)
+            if row >= count or self._payloads[self._spans[row, 0]:self._spans[row, 1]].tobytes() != payloads[i]
+        ]
+        payload_end = self._payload_file_size()
+        if changed:
+            with open(self._file("payloads.bin"), "ab") as f:
+                f.seek(0, os.SEEK_END)
+                payload_end = f.tell()
+                f.write(b"".join(payloads[i] for i in changed))
+
+        lengths = np.fromiter((len(payloads[i]) for i in changed), dtype=np.int64, count=len(changed))
+        ends = payload_end + np.cumsum(lengths)
+        spans = np.concatenate([self._spans, np.zeros((len(new_ids), 2), dtype=np.int64)])
+        spans[rows[changed]] = np.stack([ends - lengths, ends], axis=1)
+        self._atomic_write("spans.npy", lambda f: np.save(f, spans))
+        self._write_field_codes(rows, metadata, new_count)
+
+        # Keep the persisted IVF index in step before readers see the new rows
+        if self.index is not None and self.index.is_trained:
+            overwritten = rows < count
+            self.index.update(rows[overwritten], vectors[overwritten])
+            self.index.add(vectors[~overwritten])
+            self.index.save()
+
+        manifest = {"dimension": self.dimension, "count": new_count, "ids": self.ids + new_ids}
+        self._atomic_write("manifest.json", lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+        self._load()
+
+        # Train once the corpus is big enough
+        if self.index is not None:
+            if not self.index.is_trained and self.count >= settings.IVF_MIN_TRAIN_SIZE:
+                self.index.train(self._vectors)
+            self.index.save()
+
+    def _delete_rows(self, rows: np.ndarray):
+        """
+        Compact the remaining rows into new data files, then publish them via the manifest
+
+        Rows after a deleted one shift down; the deleted payload bytes are left
+        behind until compact().
+        """
+        kept = np.setdiff1d(np.arange(self.count), rows)
+        vectors = np.ascontiguousarray(self._vectors[kept])
+        spans = self._spans[kept]
+        self._atomic_write("vectors.f32", lambda f: f.write(vectors.tobytes()))
+        self._atomic_write("spans.npy", lambda f: np.save(f, spans))
+        for field, codes in self._field_codes.items():
+            self._atomic_write(f"field_{field}.npy", lambda f, codes=codes[kept]: np.save(f, codes))
+
+        if self.index is not None and self.index.is_trained:
+            self.index.remove(rows)
+            self.index.save()
+
+        manifest = {"dimension": self.dimension, "count": len(kept), "ids": [self.ids[row] for row in kept]}
+        self._atomic_write("manifest.json", lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+        self._load()
+
+    def compact(self, min_dead_ratio: Optional[float] = None) -> int:
+        """
+        Rewrite payloads.bin without bytes no row points to
+        
+        Only runs once at least min_dead_ratio (default LOCAL_VECTOR_COMPACT_RATIO)
+        of the file is dead. The new file replaces the old one by rename, so
+        readers that memory-mapped the old file keep reading it. Returns the
+        number of bytes reclaimed.
+        """
+        min_dead_ratio = settings.LOCAL_VECTOR_COMPACT_RATIO if min_dead_ratio is None else min_dead_ratio
+        with self._lock:
+            self._maybe_reload()
+            size = self._payload_file_size()
+            lengths = self._spans[:, 1] - self._spans[:, 0]
+            dead = size - int(lengths.sum())
+            if dead <= 0 or dead < min_dead_ratio * size:
+                return 0
+            
+            payloads = b"".join(self._payloads[start:end].tobytes() for start, end in self._spans)
+            ends = np.cumsum(lengths)
+            spans = np.stack([ends - lengths, ends], axis=1).astype(np.int64)
+            manifest = {"dimension": self.dimension, "count": self.count, "ids": self.ids}
+            self._atomic_write("payloads.bin", lambda f: f.write(payloads))
+            self._atomic_write("spans.npy", lambda f: np.save(f, spans))
+            self._atomic_write("manifest.json", lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+            self._load()
+        
+        logger.info(f"Compacted payloads of {self.collection_name}, reclaimed {dead} bytes")
+        return dead
+    
+    def rebuild_index(self):
+        """Retrain the IVF index from scratch (e.g. after heavy ingestion drift)"""
+        if self.index is None:
+            return
+        with self._lock:
+            self._maybe_reload()
+            if self.count:
+                self.index.train(self._vectors)
+                self.index.save()
+
+    def _write_field_codes(self, rows: np.ndarray, metadata: List[Dict], count: int):
+        """Update and persist keyword codes of indexed metadata fields"""
+        vocabs = {field: list(self._field_vocab.get(field, [])) for field in self.indexed_fields}
+        for field in self.indexed_fields:
+            codes = np.full(count, -1, dtype=np.int32)
+            existing = self._field_codes.get(field)
+            if existing is not None:
+                codes[:len(existing)] = existing
+
+            vocab = vocabs[field]
+            lookup = {value: code for code, value in enumerate(vocab)}
+            for row, meta in zip(rows, metadata):
+                value = meta.get(field)
+                if value is None:
+                    codes[row] = -1
+                    continue
+                value = str(value)
+                if value not in lookup:
+                    lookup[value] = len(vocab)
+                    vocab.append(value)
+                codes[row] = lookup[value]
+            self._atomic_write(f"field_{field}.npy", lambda f: np.save(f, codes))
+
+        self._atomic_write("fields.json", lambda f: f.write(json.dumps(vocabs).encode("utf-8")))
+
+    def _load_field_codes(self, count: int):
+        """Load indexed field codes, rebuilding them from payloads if absent"""
+        self._field_vocab, self._field_codes = {}, {}
+        fields_path = self._file("fields.json")
+        vocabs = json.loads(fields_path.read_text(encoding="utf-8")) if fields_path.exists() else {}
+
+        missing = []
+        for field in self.indexed_fields:
+            codes_path = self._file(f"field_{field}.npy")
+            codes = np.load(codes_path)[:count] if field in vocabs and codes_path.exists() else None
+            if codes is not None and len(codes) == count:
+                self._field_vocab[field] = vocabs[field]
+                self._field_codes[field] = codes
+            else:
+                missing.append(field)
+
+        if missing and count:
+            logger.info(f"Building payload index for {missing}")
+            metadata = [self._payload(row) for row in range(count)]
+            self._write_field_codes(np.arange(count), metadata, count)
+            self._load_field_codes(count)
+
+    def _maybe_reload(self):
+        """Pick up rows written by another process (e.g. the ingestion script)"""
+        try:
+            mtime = os.stat(self._file("manifest.json")).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._manifest_mtime:
+            self._load()
+
+    def _load(self):
+        """Memory-map the collection files"""
+        manifest_path = self._file("manifest.json")
+        if not manifest_path.exists():
+            self.ids = []
+            self._row_of = {}
+            self._vectors = np.empty((0, self.dimension), dtype=np.float32)
+            self._payloads = np.empty(0, dtype=np.uint8)
+            self._spans = np.zeros((0, 2), dtype=np.int64)
+            self._field_vocab, self._field_codes = {}, {}
+            self._manifest_mtime = None
+            return
+
+        self._manifest_mtime = os.stat(manifest_path).st_mtime_ns
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        if manifest["dimension"] != self.dimension:
+            raise ValueError(
+                f"Collection {self.collection_name} has {manifest['dimension']}-d vectors, "
+                f"EMBEDDING_DIMENSION is {self.dimension}"
+            )
+
+        count = manifest["count"]
+        self.ids = manifest["ids"][:count]
+        self._row_of = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self._spans = np.load(self._file("spans.npy"))[:count]
+        if count:
+            self._vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r",
+                                      shape=(count, self.dimension))
+            self._payloads = np.memmap(self._file("payloads.bin"), dtype=np.uint8, mode="r",
+                                       shape=(int(self._spans[:, 1].max()),))
+        else:
+            self._vectors = np.empty((0, self.dimension), dtype=np.float32)
+            self._payloads = np.empty(0, dtype=np.uint8)
+
+        self._load_field_codes(count)
+        if self.index is not None:
+            self._sync_index()
+
+        logger.info(f"Loaded local collection {self.collection_name} ({count} vectors)")
+
+    def _sync_index(self):
+        """Load the persisted IVF index and cover rows it has not seen yet"""
+        self.index.load()
+        if not self.index.is_trained:
+            return
+
+        assigned = len(self.index.assignments)
+        if assigned > self.count:
+            self.index.truncate(self.count)
+        elif assigned < self.count:
+            self.index.add(self._vectors[assigned:])
+
+    def _payload_file_size(self) -> int:
+        """Physical size of payloads.bin (may exceed the spans after deletes)"""
+        try:
+            return os.stat(self._file("payloads.bin")).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _file(self, name: str) -> Path:
+        return self.path / name
+
+    def _atomic_write(self, name: str, write):
+        """Write a file via a temp file and rename"""
+        tmp_path = self._file(name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, self._file(name))
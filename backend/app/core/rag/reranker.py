@@ -1 +1,145 @@
-# Reranking results
\ No newline at end of file
+﻿"""
+Reranking results
+Cross-encoder scoring of (query, chunk) pairs within a per-request time budget
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from app.config import settings
+from app.core.rag.embedding_batcher import EmbeddingBatcher
+from app.core.rag.embedding_server import EmbeddingClient
+from app.utils.cache import LRUCache
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+
+class CrossEncoderReranker:
+    """
+    Rerank retrieval candidates with a CPU cross-encoder
+
+    Uncached pairs of concurrent requests are micro-batched into shared
+    forward passes on a dedicated thread; a request that runs out of budget
+    drops its pairs from batches that have not started. Pair scores are cached
+    by hash, so a pass that misses the budget still warms the cache for the
+    next identical request.
+
+    When an embedding server socket is configured the pairs are scored by the
+    server (one model for all workers) and the model is never loaded here;
+    otherwise it is loaded at startup by warm(), or by the first rerank before
+    its budget starts, so loading never pushes a request past the budget.
+    """
+
+    def __init__(
+        self,
+        model_name: Optional[str] = None,
+        budget_ms: Optional[float] = None,
+        socket_path: Optional[str] = None
+    ):
+        self.model_name = model_name or settings.RERANKER_MODEL
+        self.budget = (budget_ms if budget_ms is not None else settings.RERANKER_BUDGET_MS) / 1000
+        self.socket_path = settings.EMBEDDING_SERVER_SOCKET if socket_path is None else socket_path
+        self.cache = LRUCache(name="rerank", max_entries=settings.RERANKER_CACHE_MAX_ENTRIES)
+        self.remote = EmbeddingClient(self.socket_path) if self.socket_path else None
+        self.batcher = EmbeddingBatcher(
+            self._predict,
+            max_batch_size=settings.RERANKER_BATCH_MAX_SIZE,
+            max_wait_ms=settings.RERANKER_BATCH_WAIT_MS,
+            name="reranker"
+        )
+        self.model = None
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """Load the cross-encoder once (blocking)"""
+        with self._load_lock:
+            if self.model is None:
+                from sentence_transformers import CrossEncoder
+
+                logger.info(f"Loading reranker model: {self.model_name}")
+                self.model = CrossEncoder(self.model_name, max_length=settings.RERANKER_MAX_LENGTH)
+        return self.model
+
+    async def warm(self):
+        """Load the local model off the event loop (no-op when scoring remotely or disabled)"""
+        if settings.RERANKER_ENABLED and not self.remote and self.model is None:
+            await asyncio.to_thread(self.load)
+
+    async def rerank(self, query: str, documents: List[Dict], top_k: int) -> List[Dict]:
+        """
+        Order documents by cross-encoder score and keep top_k
+
+        documents arrive in retrieval (fused) order; that order is kept if
+        reranking is disabled, fails or exceeds the budget.
+        """
+        if not settings.RERANKER_ENABLED or len(documents) <= 1:
+            return documents[:top_k]
+
+        try:
+            await self.warm()
+        except Exception as e:
+            logger.error(f"Error loading reranker: {e}")
+            return documents[:top_k]
+
+        start = time.perf_counter()
+        try:
+            scores = await asyncio.wait_for(
+                self.score_pairs([(query, doc["text"]) for doc in documents]),
+                timeout=self.budget
+            )
+        except asyncio.TimeoutError:
+            metrics.increment("reranker_timeouts")
+            logger.warning(f"Reranker exceeded {self.budget * 1000:.0f}ms budget, keeping retrieval order")
+            return documents[:top_k]
+        except Exception as e:
+            logger.error(f"Error reranking: {e}")
+            return documents[:top_k]
+        finally:
+            metrics.observe("reranker_latency_ms", (time.perf_counter() - start) * 1000)
+
+        return self._order(documents, scores, top_k)
+
+    async def score_pairs(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        """Scores of (query, text) pairs; cache misses share model passes with concurrent requests"""
+        keys = [self._pair_key(query, text) for query, text in pairs]
+        scores = [self.cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        if missing:
+            pending = [pairs[i] for i in missing]
+            if self.remote:
+                predicted = await self.remote.arerank(pending)
+            else:
+                predicted = await self.batcher.submit_many(pending)
+            for i, score in zip(missing, predicted):
+                scores[i] = float(score)
+                self.cache.set(keys[i], scores[i])
+        return scores
+
+    def _predict(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        """Score one micro-batch (runs on the batcher's worker thread)"""
+        scores = self.load().predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+        # Cache here too, so a batch whose requests timed out still warms the cache
+        for (query, text), score in zip(pairs, scores):
+            self.cache.set(self._pair_key(query, text), float(score))
+        return scores
+
+    @staticmethod
+    def _order(documents: List[Dict], scores: List[float], top_k: int) -> List[Dict]:
+        """Attach scores and keep the top_k highest"""
+        for doc, score in zip(documents, scores):
+            doc["rerank_score"] = score
+        return sorted(documents, key=lambda doc: doc["rerank_score"], reverse=True)[:top_k]
+
+    def _pair_key(self, query: str, text: str) -> str:
+        """Hash of model, normalized query and chunk text"""
+        normalized = " ".join(query.lower().split())
+        return hashlib.sha1(f"{self.model_name}\x00{normalized}\x00{text}".encode("utf-8")).hexdigest()
+
+
+# Global reranker
+reranker = CrossEncoderReranker()
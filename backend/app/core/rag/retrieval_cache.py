@@ -0,0 +1,123 @@
+﻿"""
+Cache of final ranked retrieval results
+Entries carry the corpus version they were computed against and are stale as
+soon as ingestion bumps it
+"""
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, List, Dict, Optional
+from app.config import settings
+from app.core.rag.base_store import normalize_filters
+from app.utils.cache import LRUCache, corpus_version, redis_client
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+
+class RetrievalCache:
+    """
+    Two-level (in-process LRU, optional Redis) cache of ranked chunks
+
+    Keyed by normalized query, query variants, top_k and filters. Reports
+    retrieval_cache_hits / _misses / _stale counters, a hit-rate gauge and
+    the age of served entries. The Redis client is synchronous, so its calls
+    run in a worker thread to keep the event loop free.
+    """
+
+    def __init__(self):
+        self.enabled = settings.RETRIEVAL_CACHE_ENABLED
+        self.ttl = settings.RETRIEVAL_CACHE_TTL
+        self.memory = LRUCache(
+            name="retrieval_memory",
+            max_entries=settings.RETRIEVAL_CACHE_MAX_ENTRIES,
+            ttl=self.ttl
+        )
+        self.redis = redis_client if settings.RETRIEVAL_CACHE_REDIS else None
+        self.versions = corpus_version
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalize query text for cache lookups"""
+        return " ".join(text.lower().split())
+
+    def key(
+        self,
+        query: str,
+        top_k: int,
+        filters: Optional[Dict[str, Any]] = None,
+        query_variants: Optional[List[str]] = None
+    ) -> str:
+        """Cache key of a retrieval request"""
+        key_data = json.dumps({
+            "query": self.normalize(query),
+            "variants": [self.normalize(v) for v in query_variants or []],
+            "top_k": top_k,
+            "filters": {field: sorted(map(str, values)) for field, values in normalize_filters(filters).items()}
+        }, sort_keys=True)
+        return "retrieval:" + hashlib.sha1(key_data.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[List[Dict]]:
+        """Cached results if computed against the current corpus version"""
+        if not self.enabled:
+            return None
+
+        entry = self.memory.get(key)
+        if entry is None and self.redis:
+            try:
+                cached = await asyncio.to_thread(self.redis.get, key)
+                if cached:
+                    entry = json.loads(cached)
+                    self.memory.set(key, entry)
+            except Exception as e:
+                logger.error(f"Retrieval cache error: {e}")
+
+        version = await self.versions.aget()
+        metrics.set_gauge("corpus_version", version)
+        if entry is not None and entry["version"] != version:
+            metrics.increment("retrieval_cache_stale")
+            self.memory.delete(key)
+            entry = None
+
+        if entry is None:
+            self._record(hit=False)
+            return None
+
+        self._record(hit=True)
+        metrics.observe("retrieval_cache_age_s", time.time() - entry["created"])
+        return [dict(doc) for doc in entry["results"]]
+
+    async def set(self, key: str, results: List[Dict]):
+        """Store results tagged with the current corpus version"""
+        if not self.enabled:
+            return
+
+        entry = {
+            "version": await self.versions.aget(),
+            "created": time.time(),
+            "results": [dict(doc) for doc in results]
+        }
+        self.memory.set(key, entry)
+        if self.redis:
+            try:
+                await asyncio.to_thread(self.redis.setex, key, self.ttl, json.dumps(entry, default=str))
+            except Exception as e:
+                logger.error(f"Retrieval cache error: {e}")
+
+    def _record(self, hit: bool):
+        """Update hit/miss counters and the hit-rate gauge"""
+        if hit:
+            self.hits += 1
+            metrics.increment("retrieval_cache_hits")
+        else:
+            self.misses += 1
+            metrics.increment("retrieval_cache_misses")
+        metrics.set_gauge("retrieval_cache_hit_rate", round(self.hits / (self.hits + self.misses), 4))
+
+
+# Global retrieval cache
+retrieval_cache = RetrievalCache()
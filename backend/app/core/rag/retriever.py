@@ -1,11 +1,22 @@
 ﻿"""
 Hybrid retrieval system
 """
-from typing import List, Dict, Optional
+import asyncio
+from typing import Any, List, Dict, Optional
+import numpy as np
+from app.core.rag.chunking import chunker
+from app.core.rag.diversity import mmr_select
 from app.core.rag.embeddings import embedding_service
+from app.core.rag.fusion import reciprocal_rank_fusion
+from app.core.rag.keyword_index import keyword_index
+from app.core.rag.reranker import reranker
+from app.core.rag.retrieval_cache import retrieval_cache
+from app.core.rag.sentence_store import sentence_store
+from app.core.rag.vector_ops import l2_normalize
 from app.core.rag.vector_store import vector_store
 from app.config import settings
 from app.utils.logger import get_logger
+from app.utils.metrics import metrics
 
 logger = get_logger(__name__)
 
@@ -16,46 +27,173 @@ class HybridRetriever:
     def __init__(self):
         self.embedding_service = embedding_service
         self.vector_store = vector_store
+        self.keyword_index = keyword_index
+        self.reranker = reranker
+        self.cache = retrieval_cache
+        self.sentence_store = sentence_store
         self.top_k = settings.TOP_K_RESULTS
+        self.rerank_top_k = settings.RERANK_TOP_K
     
-    async def retrieve(self, query: str, top_k: Optional[int] = None) -> List[Dict]:
-        """Retrieve relevant documents"""
+    async def retrieve(
+        self,
+        query: str,
+        top_k: Optional[int] = None,
+        filters: Optional[Dict[str, Any]] = None,
+        query_variants: Optional[List[str]] = None
+    ) -> List[Dict]:
+        """
+        Retrieve relevant documents
+        
+        filters narrow the vector search by metadata, e.g. {"doc_type": "faq"}
+        or {"source": ["loans.txt", "savings.txt"]}
+        
+        query_variants (e.g. the query joined with the previous question) are
+        searched alongside the raw query. Every variant gets a vector and a BM25
+        result list; all lists are fused with weighted RRF, the TOP_K_RESULTS
+        best candidates reranked by the cross-encoder, and top_k of them
+        (RERANK_TOP_K by default) picked by MMR without near-duplicates.
+        Each chunk is finally cut down to its sentences closest to the query.
+        """
         try:
-            top_k = top_k or self.top_k
-            logger.info(f"Retrieving documents for: '{query}'")
+            top_k = top_k or self.rerank_top_k
+            width = max(self.top_k, top_k)
+            queries = [query] + [v for v in query_variants or [] if v != query]
             
-            # Generate query embedding
-            query_embedding = self.embedding_service.embed_text(query)
+            # Ranked results are reusable until ingestion bumps the corpus version
+            cache_key = self.cache.key(query, top_k, filters, queries[1:])
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                return cached
             
-            # Vector search
-            results = self.vector_store.search(
-                query_embedding=query_embedding,
-                limit=top_k * 2,
-                score_threshold=settings.SIMILARITY_THRESHOLD
-            )
+            logger.info(f"Retrieving documents for: {queries}")
             
-            if not results:
-                return []
+            # Embed all variants in one batch (micro-batched off the event loop)
+            query_embeddings = await self.embedding_service.aembed_batch(queries)
             
-            # Simple reranking
-            results = self._rerank(query, results)
-            return results[:top_k]
+            # One batched vector search round trip for every variant,
+            # BM25 over the in-memory inverted index alongside it
+            vector_lists, keyword_lists = await asyncio.gather(
+                self.vector_store.asearch_batch(
+                    query_embeddings=query_embeddings,
+                    limit=width,
+                    score_threshold=settings.SIMILARITY_THRESHOLD,
+                    filters=filters
+                ),
+                asyncio.to_thread(self.keyword_index.search_batch, queries, width, filters)
+            )
+            
+            candidates = await self._hydrate(self._fuse(vector_lists, keyword_lists, width))
+            ranked = await self.reranker.rerank(query, candidates, width)
+            results = await self._diversify(ranked, top_k)
+            results = self._compress(query_embeddings, results)
+            await self.cache.set(cache_key, results)
+            return results
             
         except Exception as e:
             logger.error(f"Error retrieving: {e}")
             return []
     
-    def _rerank(self, query: str, documents: List[Dict]) -> List[Dict]:
-        """Rerank documents"""
-        query_terms = set(query.lower().split())
+    def _fuse(
+        self,
+        vector_lists: List[List[Dict]],
+        keyword_lists: List[List[Dict]],
+        top_k: int
+    ) -> List[Dict]:
+        """Weighted RRF of vector and keyword results (vector copies win on overlap)"""
+        weights = (
+            [settings.HYBRID_VECTOR_WEIGHT] * len(vector_lists) +
+            [settings.HYBRID_KEYWORD_WEIGHT] * len(keyword_lists)
+        )
+        return reciprocal_rank_fusion(
+            vector_lists + keyword_lists,
+            weights=weights,
+            k=settings.RRF_K,
+            limit=top_k
+        )
+
+    
+    async def _hydrate(self, documents: List[Dict]) -> List[Dict]:
+        """Fetch the texts of keyword-only hits (the BM25 index stores none) from the vector store"""
+        missing = [doc for doc in documents if "text" not in doc]
+        if not missing:
+            return documents
+        
+        stored = await self.vector_store.aget_documents([doc["id"] for doc in missing])
+        for doc, payload in zip(missing, stored):
+            if payload is not None:
+                doc["text"] = payload["text"]
+        
+        # Chunks indexed for BM25 but missing from the vector store cannot be used
+        return [doc for doc in documents if "text" in doc]
+    
+    async def _diversify(self, documents: List[Dict], top_k: int) -> List[Dict]:
+        """MMR over the candidates' stored vectors, dropping overlapping chunks"""
+        if not settings.MMR_ENABLED or len(documents) <= 1:
+            return documents[:top_k]
+        
+        try:
+            vectors = await self.vector_store.aget_vectors([doc["id"] for doc in documents])
+        except Exception as e:
+            logger.error(f"Error fetching vectors for MMR: {e}")
+            return documents[:top_k]
+        
+        # Reranker scores when available, otherwise the fused rank scores
+        key = "rerank_score" if all("rerank_score" in doc for doc in documents) else "rrf_score"
+        picks = mmr_select(
+            vectors,
+            [doc.get(key, 0.0) for doc in documents],
+            top_k,
+            lambda_mult=settings.MMR_LAMBDA,
+            duplicate_threshold=settings.DUPLICATE_THRESHOLD
+        )
+        
+        # Slots left empty because every remaining candidate duplicated a pick
+        dropped = min(top_k, len(documents)) - len(picks)
+        if dropped:
+            metrics.increment("retrieval_duplicates_dropped", dropped)
+        return [documents[i] for i in picks]
+
+    
+    def _compress(self, query_embeddings: np.ndarray, documents: List[Dict]) -> List[Dict]:
+        """
+        Keep each chunk's sentences most similar to the query
         
-        for doc in documents:
-            text_lower = doc["text"].lower()
-            term_matches = sum(1 for term in query_terms if term in text_lower)
-            term_boost = term_matches / len(query_terms) if query_terms else 0
-            doc["score"] = doc["score"] * 0.7 + term_boost * 0.3
+        All stored sentence vectors of the results are scored against every
+        query variant in one matrix product. Up to COMPRESSION_MAX_SENTENCES
+        sentences at or above COMPRESSION_MIN_SIMILARITY are kept per chunk
+        (at least the best one), in their original order; the full chunk stays
+        under "full_text". Chunks without stored sentences are left whole.
+        """
+        if not settings.CONTEXT_COMPRESSION_ENABLED or not documents:
+            return documents
+        
+        vectors, spans = self.sentence_store.lookup([doc["id"] for doc in documents])
+        sentences = [chunker._split_sentences(doc["text"]) for doc in documents]
+        usable = [
+            i for i, span in enumerate(spans)
+            if span is not None and span[1] - span[0] == len(sentences[i])
+        ]
+        if not usable:
+            return documents
+        
+        rows = np.concatenate([np.arange(*spans[i]) for i in usable])
+        scores = (np.asarray(vectors[rows], dtype=np.float32) @ l2_normalize(query_embeddings).T).max(axis=1)
+        
+        original, kept, offset = 0, 0, 0
+        for i in usable:
+            doc, doc_scores = documents[i], scores[offset:offset + len(sentences[i])]
+            offset += len(sentences[i])
+            
+            best = np.argsort(-doc_scores, kind="stable")[:settings.COMPRESSION_MAX_SENTENCES]
+            best = [j for j in best if doc_scores[j] >= settings.COMPRESSION_MIN_SIMILARITY] or best[:1]
+            compressed = " ".join(sentences[i][j] for j in sorted(best))
+            
+            original += len(doc["text"])
+            kept += len(compressed)
+            doc["full_text"] = doc["text"]
+            doc["text"] = compressed
         
-        documents.sort(key=lambda x: x["score"], reverse=True)
+        metrics.observe("context_compression_ratio", kept / max(original, 1))
         return documents
 
 
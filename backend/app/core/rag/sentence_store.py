@@ -0,0 +1,143 @@
+﻿"""
+Per-sentence embeddings of ingested chunks
+Lets the retriever keep only the sentences of a chunk that match the query
+"""
+import json
+import os
+import threading
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple
+import numpy as np
+from app.config import settings
+from app.core.rag.vector_ops import as_float32, l2_normalize
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class SentenceStore:
+    """
+    Append-only store of normalized sentence vectors, grouped by chunk id
+
+    Files under SENTENCE_STORE_PATH:
+        vectors.f16   - (count, dim) float16 normalized vectors, memory-mapped
+        manifest.json - dimension, count and [start, end) rows per chunk id (written last)
+
+    Rows follow DocumentChunker._split_sentences(chunk text), so sentence texts
+    are not stored; chunk ids are content-derived, so a known id is never rewritten.
+    Removing a chunk only drops its span; its rows are left behind.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """Open (or create) the store"""
+        self.path = Path(path or settings.SENTENCE_STORE_PATH)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.dimension = settings.EMBEDDING_DIMENSION
+
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._load()
+
+    def add(self, chunk_ids: List[str], sentence_counts: List[int], embeddings: np.ndarray):
+        """
+        Append sentence vectors of new chunks
+
+        Args:
+            chunk_ids: Point ids of the chunks
+            sentence_counts: Number of sentences of each chunk
+            embeddings: (sum(sentence_counts), dim) sentence vectors in chunk order
+        """
+        vectors = l2_normalize(np.atleast_2d(as_float32(embeddings))).astype(np.float16)
+        bounds = np.concatenate([[0], np.cumsum(sentence_counts)])
+
+        with self._lock:
+            self._maybe_reload()
+            count = self.count
+            new_rows, spans, added = [], dict(self.spans), 0
+            for i, chunk_id in enumerate(chunk_ids):
+                chunk_id = str(chunk_id)
+                if chunk_id in spans or not sentence_counts[i]:
+                    continue
+                new_rows.append(vectors[bounds[i]:bounds[i + 1]])
+                spans[chunk_id] = [count + added, count + added + sentence_counts[i]]
+                added += sentence_counts[i]
+
+            if not new_rows:
+                return
+
+            # Data first, manifest last: readers only see fully written rows
+            with open(self._file("vectors.f16"), "r+b" if count else "wb") as f:
+                f.truncate(count * self.dimension * 2)
+                f.seek(0, os.SEEK_END)
+                f.write(np.concatenate(new_rows).tobytes())
+            self._write_manifest(count + added, spans)
+
+        logger.info(f"Stored {added} sentence vectors for {len(new_rows)} chunks")
+
+    def remove(self, chunk_ids: List[str]):
+        """Forget the sentences of deleted chunks"""
+        removed_ids = {str(chunk_id) for chunk_id in chunk_ids}
+        with self._lock:
+            self._maybe_reload()
+            spans = {chunk_id: span for chunk_id, span in self.spans.items() if chunk_id not in removed_ids}
+            if len(spans) == len(self.spans):
+                return
+            removed = len(self.spans) - len(spans)
+            self._write_manifest(self.count, spans)
+
+        logger.info(f"Removed sentence vectors of {removed} chunks")
+
+    def lookup(self, chunk_ids: List[str]) -> Tuple[np.ndarray, List[Optional[Tuple[int, int]]]]:
+        """Vector matrix and [start, end) rows of each chunk id (None if unknown)"""
+        with self._lock:
+            self._maybe_reload()
+            spans = [self.spans.get(str(chunk_id)) for chunk_id in chunk_ids]
+            return self._vectors, [tuple(span) if span else None for span in spans]
+
+    @property
+    def count(self) -> int:
+        return len(self._vectors)
+
+    def _maybe_reload(self):
+        """Pick up sentences stored by another process (e.g. the ingestion script)"""
+        try:
+            mtime = os.stat(self._file("manifest.json")).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime:
+            self._load()
+
+    def _load(self):
+        """Memory-map the vectors"""
+        manifest_path = self._file("manifest.json")
+        self.spans: Dict[str, List[int]] = {}
+        self._vectors = np.empty((0, self.dimension), dtype=np.float16)
+        self._mtime = None
+        if not manifest_path.exists():
+            return
+
+        self._mtime = os.stat(manifest_path).st_mtime_ns
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        if manifest["dimension"] != self.dimension:
+            logger.warning("Ignoring sentence store built for a different embedding dimension")
+            return
+
+        self.spans = manifest["chunks"]
+        if manifest["count"]:
+            self._vectors = np.memmap(self._file("vectors.f16"), dtype=np.float16, mode="r",
+                                      shape=(manifest["count"], self.dimension))
+
+    def _write_manifest(self, count: int, spans: Dict[str, List[int]]):
+        """Publish rows and spans (caller holds the lock)"""
+        manifest = {"dimension": self.dimension, "count": count, "chunks": spans}
+        tmp_path = self._file("manifest.json.tmp")
+        tmp_path.write_text(json.dumps(manifest), encoding="utf-8")
+        os.replace(tmp_path, self._file("manifest.json"))
+        self._load()
+
+    def _file(self, name: str) -> Path:
+        return self.path / name
+
+
+# Global sentence store
+sentence_store = SentenceStore()
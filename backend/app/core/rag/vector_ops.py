@@ -0,0 +1,16 @@
+﻿"""
+Vector math helpers shared by embeddings and vector store backends
+"""
+import numpy as np
+
+
+def as_float32(vectors) -> np.ndarray:
+    """View vectors as a contiguous float32 array, copying only if needed"""
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+
+def l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize a vector or each row of a matrix"""
+    vectors = as_float32(vectors)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
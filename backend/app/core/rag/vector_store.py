@@ -1,23 +1,40 @@
 ﻿"""
-Vector database operations using Qdrant
+Vector database operations
+Qdrant by default, or an in-process memory-mapped index (VECTOR_BACKEND=local)
 """
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
-from typing import List, Dict, Optional
-from uuid import uuid4
+import asyncio
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import (
+    Distance,
+    FieldCondition,
+    Filter,
+    MatchAny,
+    MatchValue,
+    PayloadSchemaType,
+    PointIdsList,
+    PointStruct,
+    QueryRequest,
+    VectorParams
+)
+from typing import Any, List, Dict, Optional
+import numpy as np
 from app.config import settings
+from app.core.rag.base_store import VectorStore, make_point_id, normalize_filters
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
 
-class VectorStore:
-    """Vector database client for document storage"""
+class QdrantVectorStore(VectorStore):
+    """Qdrant-backed vector store"""
     
     def __init__(self):
-        """Initialize Qdrant client"""
+        """Initialize Qdrant clients (async client for request handlers if enabled)"""
         self.client = QdrantClient(url=settings.VECTOR_DB_URL)
+        self.async_client = AsyncQdrantClient(url=settings.VECTOR_DB_URL) if settings.QDRANT_ASYNC else None
         self.collection_name = settings.VECTOR_DB_COLLECTION
+        self.batch_size = settings.VECTOR_UPSERT_BATCH_SIZE
+        self.parallelism = settings.VECTOR_UPSERT_PARALLELISM
         self._ensure_collection()
     
     def _ensure_collection(self):
@@ -35,72 +52,332 @@ class VectorStore:
                         distance=Distance.COSINE
                     )
                 )
+            
+            # Keyword indexes let filtered searches skip non-matching points
+            for field in settings.VECTOR_PAYLOAD_INDEXES:
+                self.client.create_payload_index(
+                    collection_name=self.collection_name,
+                    field_name=field,
+                    field_schema=PayloadSchemaType.KEYWORD
+                )
         except Exception as e:
             logger.error(f"Error ensuring collection: {e}")
     
     def add_documents(
         self,
         texts: List[str],
-        embeddings: List[List[float]],
-        metadata: List[Dict]
+        embeddings: np.ndarray,
+        metadata: List[Dict],
+        ids: Optional[List[str]] = None
     ) -> List[str]:
-        """Add documents to vector store"""
+        """Upsert documents in batches of VECTOR_UPSERT_BATCH_SIZE"""
         try:
-            points = []
-            ids = []
-            
-            for text, embedding, meta in zip(texts, embeddings, metadata):
-                doc_id = str(uuid4())
-                ids.append(doc_id)
-                points.append(
-                    PointStruct(
-                        id=doc_id,
-                        vector=embedding,
-                        payload={"text": text, **meta}
-                    )
+            ids, batches = self._build_batches(texts, embeddings, metadata, ids)
+            for batch in batches:
+                self.client.upsert(
+                    collection_name=self.collection_name,
+                    points=batch,
+                    wait=True
                 )
+            logger.info(f"Upserted {len(ids)} documents in {len(batches)} batches")
+            return ids
+        except Exception as e:
+            logger.error(f"Error adding documents: {e}")
+            raise
+    
+    async def aadd_documents(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadata: List[Dict],
+        ids: Optional[List[str]] = None
+    ) -> List[str]:
+        """Upsert documents with up to VECTOR_UPSERT_PARALLELISM batches in flight"""
+        try:
+            ids, batches = self._build_batches(texts, embeddings, metadata, ids)
+            semaphore = asyncio.Semaphore(self.parallelism)
             
-            self.client.upsert(
-                collection_name=self.collection_name,
-                points=points
-            )
-            logger.info(f"Added {len(points)} documents")
+            async def upsert(batch: List[PointStruct]):
+                async with semaphore:
+                    if self.async_client:
+                        await self.async_client.upsert(
+                            collection_name=self.collection_name,
+                            points=batch,
+                            wait=True
+                        )
+                    else:
+                        await asyncio.to_thread(
+                            self.client.upsert,
+                            collection_name=self.collection_name,
+                            points=batch,
+                            wait=True
+                        )
+            
+            await asyncio.gather(*(upsert(batch) for batch in batches))
+            logger.info(f"Upserted {len(ids)} documents in {len(batches)} batches")
             return ids
         except Exception as e:
             logger.error(f"Error adding documents: {e}")
             raise
     
+    def _build_batches(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadata: List[Dict],
+        ids: Optional[List[str]]
+    ):
+        """Build points with deterministic ids, split into upsert batches"""
+        ids = ids or [make_point_id(text, meta) for text, meta in zip(texts, metadata)]
+        points = [
+            PointStruct(
+                id=doc_id,
+                vector=embedding.tolist(),  # wire boundary
+                payload={"text": text, **meta}
+            )
+            for doc_id, text, embedding, meta in zip(ids, texts, embeddings, metadata)
+        ]
+        batches = [points[i:i + self.batch_size] for i in range(0, len(points), self.batch_size)]
+        return ids, batches
+    
     def search(
         self,
-        query_embedding: List[float],
+        query_embedding: np.ndarray,
         limit: int = 10,
-        score_threshold: Optional[float] = None
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None
     ) -> List[Dict]:
         """Search for similar documents"""
         try:
             results = self.client.query_points(
                 collection_name=self.collection_name,
-                query=query_embedding,
+                query=query_embedding.tolist(),  # wire boundary
+                query_filter=self._build_filter(filters),
                 limit=limit,
                 score_threshold=score_threshold
             )
-            
-            documents = []
-            for result in results.points:
-                doc = {
-                    "id": result.id,
-                    "score": result.score,
-                    "text": result.payload.get("text", ""),
-                    "metadata": {k: v for k, v in result.payload.items() if k != "text"}
-                }
-                documents.append(doc)
-            
-            logger.info(f"Found {len(documents)} documents")
-            return documents
+            return self._to_documents(results.points)
+        except Exception as e:
+            logger.error(f"Error searching: {e}")
+            return []
+    
+    async def asearch(
+        self,
+        query_embedding: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[Dict]:
+        """Search without blocking the event loop"""
+        if not self.async_client:
+            return await super().asearch(query_embedding, limit, score_threshold, filters)
+        try:
+            results = await self.async_client.query_points(
+                collection_name=self.collection_name,
+                query=query_embedding.tolist(),  # wire boundary
+                query_filter=self._build_filter(filters),
+                limit=limit,
+                score_threshold=score_threshold
+            )
+            return self._to_documents(results.points)
         except Exception as e:
             logger.error(f"Error searching: {e}")
             return []
+    
+    def search_batch(
+        self,
+        query_embeddings: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict]]:
+        """Search several query vectors with one query_batch_points call"""
+        try:
+            responses = self.client.query_batch_points(
+                collection_name=self.collection_name,
+                requests=self._batch_requests(query_embeddings, limit, score_threshold, filters)
+            )
+            return [self._to_documents(response.points) for response in responses]
+        except Exception as e:
+            logger.error(f"Error batch searching: {e}")
+            return [[] for _ in query_embeddings]
+    
+    async def asearch_batch(
+        self,
+        query_embeddings: np.ndarray,
+        limit: int = 10,
+        score_threshold: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None
+    ) -> List[List[Dict]]:
+        """Batch search without blocking the event loop"""
+        if not self.async_client:
+            return await super().asearch_batch(query_embeddings, limit, score_threshold, filters)
+        try:
+            responses = await self.async_client.query_batch_points(
+                collection_name=self.collection_name,
+                requests=self._batch_requests(query_embeddings, limit, score_threshold, filters)
+            )
+            return [self._to_documents(response.points) for response in responses]
+        except Exception as e:
+            logger.error(f"Error batch searching: {e}")
+            return [[] for _ in query_embeddings]
+    
+    def _batch_requests(
+        self,
+        query_embeddings: np.ndarray,
+        limit: int,
+        score_threshold: Optional[float],
+        filters: Optional[Dict[str, Any]]
+    ) -> List[QueryRequest]:
+        """Build one query request per vector"""
+        query_filter = self._build_filter(filters)
+        return [
+            QueryRequest(
+                query=query.tolist(),  # wire boundary
+                filter=query_filter,
+                limit=limit,
+                score_threshold=score_threshold,
+                with_payload=True
+            )
+            for query in query_embeddings
+        ]
+    
+    def get_vectors(self, ids: List[str]) -> np.ndarray:
+        """Fetch stored vectors by point id"""
+        records = self.client.retrieve(
+            collection_name=self.collection_name,
+            ids=list(ids),
+            with_payload=False,
+            with_vectors=True
+        )
+        return self._to_matrix(ids, records)
+    
+    async def aget_vectors(self, ids: List[str]) -> np.ndarray:
+        """Fetch stored vectors without blocking the event loop"""
+        if not self.async_client:
+            return await super().aget_vectors(ids)
+        records = await self.async_client.retrieve(
+            collection_name=self.collection_name,
+            ids=list(ids),
+            with_payload=False,
+            with_vectors=True
+        )
+        return self._to_matrix(ids, records)
+    
+    def delete_stale(self, source: str, keep_ids: List[str]) -> List[str]:
+        """Scroll the source's point ids and delete those not in keep_ids"""
+        keep = {str(doc_id) for doc_id in keep_ids}
+        stale, offset = [], None
+        while True:
+            records, offset = self.client.scroll(
+                collection_name=self.collection_name,
+                scroll_filter=self._build_filter({"source": source}),
+                limit=self.batch_size,
+                offset=offset,
+                with_payload=False,
+                with_vectors=False
+            )
+            stale.extend(str(record.id) for record in records if str(record.id) not in keep)
+            if offset is None:
+                break
+        
+        if stale:
+            self.client.delete(
+                collection_name=self.collection_name,
+                points_selector=PointIdsList(points=stale),
+                wait=True
+            )
+            logger.info(f"Deleted {len(stale)} stale points of {source}")
+        return stale
+    
+    def get_documents(self, ids: List[str]) -> List[Optional[Dict]]:
+        """Fetch stored payloads by point id"""
+        records = self.client.retrieve(
+            collection_name=self.collection_name,
+            ids=list(ids),
+            with_payload=True,
+            with_vectors=False
+        )
+        return self._to_payloads(ids, records)
+    
+    async def aget_documents(self, ids: List[str]) -> List[Optional[Dict]]:
+        """Fetch stored payloads without blocking the event loop"""
+        if not self.async_client:
+            return await super().aget_documents(ids)
+        records = await self.async_client.retrieve(
+            collection_name=self.collection_name,
+            ids=list(ids),
+            with_payload=True,
+            with_vectors=False
+        )
+        return self._to_payloads(ids, records)
+    
+    @staticmethod
+    def _to_payloads(ids: List[str], records) -> List[Optional[Dict]]:
+        """Order retrieved payloads like ids (None for missing points)"""
+        payloads = {str(record.id): record.payload for record in records}
+        documents = []
+        for doc_id in ids:
+            payload = payloads.get(str(doc_id))
+            documents.append(None if payload is None else {
+                "id": doc_id,
+                "text": payload.get("text", ""),
+                "metadata": {k: v for k, v in payload.items() if k != "text"}
+            })
+        return documents
+    
+    @staticmethod
+    def _to_matrix(ids: List[str], records) -> np.ndarray:
+        """Order retrieved vectors like ids (zero rows for missing points)"""
+        vectors = {str(record.id): record.vector for record in records}
+        matrix = np.zeros((len(ids), settings.EMBEDDING_DIMENSION), dtype=np.float32)
+        for row, doc_id in enumerate(ids):
+            if str(doc_id) in vectors:
+                matrix[row] = vectors[str(doc_id)]
+        return matrix
+    
+    async def close(self):
+        """Close the async client"""
+        if self.async_client:
+            await self.async_client.close()
+    
+    @staticmethod
+    def _build_filter(filters: Optional[Dict[str, Any]]) -> Optional[Filter]:
+        """Translate metadata filters into a Qdrant filter"""
+        conditions = [
+            FieldCondition(
+                key=field,
+                match=MatchValue(value=values[0]) if len(values) == 1 else MatchAny(any=values)
+            )
+            for field, values in normalize_filters(filters).items()
+        ]
+        return Filter(must=conditions) if conditions else None
+    
+    def _to_documents(self, points) -> List[Dict]:
+        """Convert scored points to result dicts"""
+        documents = []
+        for result in points:
+            doc = {
+                "id": result.id,
+                "score": result.score,
+                "text": result.payload.get("text", ""),
+                "metadata": {k: v for k, v in result.payload.items() if k != "text"}
+            }
+            documents.append(doc)
+        
+        logger.info(f"Found {len(documents)} documents")
+        return documents
+
+
+def create_vector_store() -> VectorStore:
+    """Create the backend selected by VECTOR_BACKEND"""
+    if settings.VECTOR_BACKEND == "local":
+        from app.core.rag.local_vector_store import LocalVectorStore
+        return LocalVectorStore()
+    if settings.VECTOR_BACKEND != "qdrant":
+        raise ValueError(f"Unknown vector backend: {settings.VECTOR_BACKEND}")
+    return QdrantVectorStore()
 
 
 # Global vector store instance
-vector_store = VectorStore()
\ No newline at end of file
+vector_store = create_vector_store()
\ No newline at end of file
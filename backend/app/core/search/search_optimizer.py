@@ -1 +1,70 @@
-# Query rewriting and optimization
\ No newline at end of file
+﻿"""
+Query rewriting and optimization
+"""
+import re
+from typing import Dict, List
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class QueryOptimizer:
+    """Builds retrieval query variants from a user message and its history"""
+    
+    def __init__(self):
+        self.followup_max_words = 5
+        self.abbreviations = {
+            "apr": "annual percentage rate",
+            "apy": "annual percentage yield",
+            "atm": "automated teller machine",
+            "ach": "automated clearing house",
+            "cd": "certificate of deposit",
+            "fdic": "federal deposit insurance corporation",
+            "heloc": "home equity line of credit",
+            "nsf": "non-sufficient funds",
+            "kyc": "know your customer"
+        }
+    
+    def with_history(self, query: str, history: List[Dict]) -> str:
+        """Prefix short follow-up questions with the previous user message"""
+        if not history or len(history) < 2:
+            return query
+        
+        # Get the last user question
+        last_user_msg = None
+        for msg in reversed(history):
+            if msg.get("role") == "user":
+                last_user_msg = msg.get("content", "")
+                break
+        
+        # If current query is short/vague, combine with previous context
+        if last_user_msg and len(query.split()) <= self.followup_max_words:
+            enhanced = f"{last_user_msg} {query}"
+            logger.info(f"Enhanced query: {enhanced}")
+            return enhanced
+        return query
+    
+    def expand_abbreviations(self, query: str) -> str:
+        """Spell out common banking abbreviations"""
+        def expand(match: re.Match) -> str:
+            word = match.group(0)
+            return self.abbreviations.get(word.lower(), word)
+        
+        return re.sub(r"\b[A-Za-z]+\b", expand, query)
+    
+    def variants(self, query: str, history: List[Dict]) -> List[str]:
+        """Raw query first, then the history-augmented query and rewrites (deduplicated)"""
+        augmented = self.with_history(query, history)
+        candidates = [query, augmented, self.expand_abbreviations(augmented)]
+        
+        variants, seen = [], set()
+        for candidate in candidates:
+            key = " ".join(candidate.lower().split())
+            if key not in seen:
+                seen.add(key)
+                variants.append(candidate)
+        return variants
+
+
+# Global optimizer
+query_optimizer = QueryOptimizer()
@@ -2,11 +2,13 @@
 Tavily Search Client
 Handles web search queries via Tavily API
 """
+import asyncio
 from tavily import TavilyClient
 from typing import List, Dict, Optional
 from app.config import settings
 from app.utils.logger import get_logger
 from app.utils.cache import cache_result
+from app.utils.singleflight import SingleFlight
 
 logger = get_logger(__name__)
 
@@ -19,6 +21,7 @@ class TavilySearchClient:
         self.api_key = api_key or settings.TAVILY_API_KEY
         self.client = TavilyClient(api_key=self.api_key)
         self.max_results = settings.TAVILY_MAX_RESULTS
+        self.singleflight = SingleFlight("search")
     
     @cache_result(ttl=settings.SEARCH_CACHE_TTL)
     async def search(
@@ -47,12 +50,24 @@ class TavilySearchClient:
             
             logger.info(f"Searching Tavily: '{query}'")
             
-            response = self.client.search(
-                query=query,
-                max_results=max_results,
-                search_depth=search_depth,
-                include_domains=include_domains,
-                exclude_domains=exclude_domains
+            # Tavily SDK is blocking; keep it off the event loop. Identical
+            # searches still in flight (not yet in the Redis cache) share one call.
+            options = {
+                "query": query,
+                "max_results": max_results,
+                "search_depth": search_depth,
+                "include_domains": include_domains,
+                "exclude_domains": exclude_domains
+            }
+            response = await self.singleflight.do(
+                self.singleflight.key(
+                    " ".join(query.lower().split()),
+                    max_results,
+                    search_depth,
+                    include_domains,
+                    exclude_domains
+                ),
+                lambda: asyncio.to_thread(self.client.search, **options)
             )
             
             results = response.get("results", [])
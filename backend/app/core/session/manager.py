@@ -22,6 +22,7 @@ class SessionManager:
             logger.warning(f"Redis not available: {e}. Using in-memory storage.")
             self.redis_client = None
             self.memory_storage = {}
+            self.memory_summaries = {}
     
     def add_message(self, session_id: str, role: str, content: str):
        """Add a message to conversation history"""
@@ -33,6 +34,8 @@ class SessionManager:
                message = {"role": role, "content": content}
                self.redis_client.rpush(key, json.dumps(message))
                self.redis_client.expire(key, 3600)
+               # Keep the rolling summary alive as long as the history it summarizes
+               self.redis_client.expire(f"{key}:summary", 3600)
                print(f"[DEBUG] Stored in Redis - Key: {key}")
            else:
                print(f"[DEBUG] Redis not available, using memory")
@@ -65,14 +68,63 @@ class SessionManager:
             print(f"[DEBUG ERROR] {e}")
             return []
     
+    def count_messages(self, session_id: str) -> int:
+        """Number of stored messages"""
+        try:
+            if self.redis_client:
+                return self.redis_client.llen(f"session:{session_id}")
+            return len(self.memory_storage.get(session_id, []))
+        except Exception as e:
+            logger.error(f"Error counting messages: {e}")
+            return 0
+    
+    def get_messages(self, session_id: str, start: int, end: int) -> List[Dict]:
+        """Messages [start, end) in chronological order"""
+        try:
+            if end <= start:
+                return []
+            if self.redis_client:
+                messages = self.redis_client.lrange(f"session:{session_id}", start, end - 1)
+                return [json.loads(msg) for msg in messages]
+            return self.memory_storage.get(session_id, [])[start:end]
+        except Exception as e:
+            logger.error(f"Error getting messages: {e}")
+            return []
+    
+    def get_summary(self, session_id: str) -> Dict:
+        """Rolling summary and how many leading messages it covers"""
+        empty = {"summary": "", "summarized": 0}
+        try:
+            if self.redis_client:
+                stored = self.redis_client.get(f"session:{session_id}:summary")
+                return json.loads(stored) if stored else empty
+            return self.memory_summaries.get(session_id, empty)
+        except Exception as e:
+            logger.error(f"Error getting summary: {e}")
+            return empty
+    
+    def set_summary(self, session_id: str, summary: str, summarized: int):
+        """Store the rolling summary (ignored if it covers fewer messages than the stored one)"""
+        try:
+            if summarized <= self.get_summary(session_id)["summarized"]:
+                return
+            entry = {"summary": summary, "summarized": summarized}
+            if self.redis_client:
+                self.redis_client.setex(f"session:{session_id}:summary", 3600, json.dumps(entry))
+            else:
+                self.memory_summaries[session_id] = entry
+        except Exception as e:
+            logger.error(f"Error storing summary: {e}")
+    
     def clear_session(self, session_id: str):
         """Clear a session"""
         try:
             if self.redis_client:
-                self.redis_client.delete(f"session:{session_id}")
+                self.redis_client.delete(f"session:{session_id}", f"session:{session_id}:summary")
             else:
                 if session_id in self.memory_storage:
                     del self.memory_storage[session_id]
+                self.memory_summaries.pop(session_id, None)
         except Exception as e:
             logger.error(f"Error clearing session: {e}")
 
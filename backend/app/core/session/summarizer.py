@@ -0,0 +1,100 @@
+﻿"""
+Rolling conversation summary
+Folds older turns of a session into a short summary so prompts carry the
+summary plus the recent turns instead of an ever-growing history
+"""
+from typing import Dict, List, Optional, Set
+from app.config import settings
+from app.core.llm.groq_client import groq_client
+from app.core.llm.rate_limiter import LLMOverloadedError, Priority
+from app.core.llm.prompt_templates import format_summary_prompt
+from app.core.session.manager import session_manager
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+
+class ConversationSummarizer:
+    """Maintains each session's rolling summary (run after the response is sent)"""
+    
+    def __init__(self):
+        self.llm = groq_client
+        self.session_manager = session_manager
+        self.window = settings.SUMMARY_WINDOW_MESSAGES
+        self.keep = settings.SUMMARY_KEEP_MESSAGES
+        self._running: Set[str] = set()
+    
+    def build_history(self, session_id: str, max_messages: Optional[int] = None) -> List[Dict]:
+        """
+        Prompt history: the summary (as a system message) plus every message it
+        does not cover yet
+        
+        Unsummarized messages are never dropped; the context packer bounds
+        their tokens. max_messages (default: the window) only caps the history
+        when summaries are disabled; past it, a fold failed or is still pending.
+        """
+        max_messages = max_messages or self.window
+        if not settings.SUMMARY_ENABLED:
+            return self.session_manager.get_history(session_id, last_n=max_messages)
+        
+        total = self.session_manager.count_messages(session_id)
+        stored = self.session_manager.get_summary(session_id)
+        if total - stored["summarized"] > max_messages:
+            metrics.increment("conversation_summary_backlog")
+            logger.warning(
+                f"Session {session_id}: {total - stored['summarized']} unsummarized messages "
+                f"exceed the window of {max_messages}"
+            )
+        history = self.session_manager.get_messages(session_id, stored["summarized"], total)
+        
+        if stored["summary"]:
+            history.insert(0, {
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {stored['summary']}"
+            })
+        return history
+    
+    async def update(self, session_id: str):
+        """
+        Fold all but the last SUMMARY_KEEP_MESSAGES into the summary once the
+        unsummarized messages outgrow the prompt window
+
+        Until then the prompt carries them verbatim, so folding earlier would
+        only spend a background call per turn; waiting folds several turns at once.
+        """
+        if not settings.SUMMARY_ENABLED:
+            return
+        
+        if session_id in self._running:
+            return  # a fold for this session is already running
+        
+        self._running.add(session_id)
+        try:
+            total = self.session_manager.count_messages(session_id)
+            stored = self.session_manager.get_summary(session_id)
+            if total - stored["summarized"] <= self.window:
+                return
+            end = total - self.keep
+            
+            messages = self.session_manager.get_messages(session_id, stored["summarized"], end)
+            summary = await self.llm.generate(
+                [{"role": "user", "content": format_summary_prompt(stored["summary"], messages)}],
+                temperature=0.2,
+                max_tokens=settings.SUMMARY_MAX_TOKENS,
+                priority=Priority.BACKGROUND
+            )
+            self.session_manager.set_summary(session_id, summary.strip(), end)
+            metrics.increment("conversation_summaries")
+            logger.info(f"Session {session_id}: summarized {end} messages")
+        except LLMOverloadedError:
+            # The next turn retries the fold; history stays complete meanwhile
+            logger.info(f"Session {session_id}: summary deferred, LLM busy")
+        except Exception as e:
+            logger.error(f"Error summarizing session {session_id}: {e}")
+        finally:
+            self._running.discard(session_id)
+
+
+# Global summarizer
+conversation_summarizer = ConversationSummarizer()
@@ -6,6 +6,9 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.config import settings
 from app.api.v1.routes import chat, health
+from app.core.llm.groq_client import groq_client
+from app.core.rag.reranker import reranker
+from app.core.rag.vector_store import vector_store
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -37,12 +40,16 @@ async def startup_event():
     logger.info(f"Starting {settings.APP_NAME}")
     logger.info(f"Environment: {settings.ENV}")
     logger.info(f"Debug mode: {settings.DEBUG}")
+    # Load the cross-encoder now rather than inside the first request's budget
+    await reranker.warm()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Run on application shutdown"""
     logger.info("Shutting down application")
+    await groq_client.close()
+    await vector_store.close()
 
 
 # Include routers
@@ -45,6 +45,7 @@ class ChatResponse(BaseModel):
     method: str = Field(..., description="Method used: rag, search, hybrid, escalation")
     session_id: str = Field(..., description="Session ID")
     escalate: bool = Field(default=False, description="Whether to escalate to human")
+    metadata: Dict[str, Any] = Field(default_factory=dict, description="Processing details, e.g. per-branch latency")
     timestamp: datetime = Field(default_factory=datetime.now)
     
     class Config:
@@ -1,12 +1,15 @@
 ﻿"""
 Chat service - passes conversation history to LLM naturally
 """
-from typing import Dict, Optional
+import time
+from typing import AsyncIterator, Dict, Optional
 from uuid import uuid4
 from app.core.orchestrator.agent import banking_agent
 from app.core.session.manager import session_manager
+from app.core.session.summarizer import conversation_summarizer
 from app.models.chat import ChatResponse, Source
 from app.utils.logger import get_logger
+from app.utils.metrics import metrics
 
 logger = get_logger(__name__)
 
@@ -17,6 +20,7 @@ class ChatService:
     def __init__(self):
         self.agent = banking_agent
         self.session_manager = session_manager
+        self.summarizer = conversation_summarizer
     
     async def process_message(
         self,
@@ -30,8 +34,8 @@ class ChatService:
                 session_id = str(uuid4())
                 logger.info(f"New session: {session_id}")
             
-            # Get conversation history
-            history = self.session_manager.get_history(session_id, last_n=6)
+            # Get conversation history (rolling summary + recent messages)
+            history = self.summarizer.build_history(session_id)
             
             # Pass history to agent (it will format for LLM)
             result = await self.agent.process_query(
@@ -51,7 +55,8 @@ class ChatService:
                 sources=sources,
                 method=result.get("method", "unknown"),
                 session_id=session_id,
-                escalate=result.get("escalate", False)
+                escalate=result.get("escalate", False),
+                metadata=result.get("metadata", {})
             )
             
             logger.info(f"Session {session_id}, method: {response.method}")
@@ -61,6 +66,60 @@ class ChatService:
             logger.error(f"Error: {e}")
             raise
     
+    async def stream_message(
+        self,
+        message: str,
+        session_id: Optional[str] = None,
+        context: Optional[Dict] = None
+    ) -> AsyncIterator[Dict]:
+        """
+        Process user message and stream the answer
+        
+        Yields the agent's events ("meta" first, then "token"s) followed by a
+        "done" event. The exchange is stored once the stream completes.
+        """
+        if not session_id:
+            session_id = str(uuid4())
+            logger.info(f"New session: {session_id}")
+        
+        start = time.perf_counter()
+        ttft_ms = None
+        answer_parts = []
+        
+        history = self.summarizer.build_history(session_id)
+        
+        async for event in self.agent.stream_query(query=message, conversation_history=history):
+            if event["type"] == "meta":
+                event["session_id"] = session_id
+            elif event["type"] == "token":
+                if ttft_ms is None:
+                    ttft_ms = (time.perf_counter() - start) * 1000
+                    metrics.observe("chat_stream_ttft_ms", ttft_ms)
+                answer_parts.append(event["content"])
+            elif event["type"] == "error":
+                yield event
+                return
+            yield event
+        
+        answer = "".join(answer_parts)
+        self.session_manager.add_message(session_id, "user", message)
+        self.session_manager.add_message(session_id, "assistant", answer)
+        
+        total_ms = (time.perf_counter() - start) * 1000
+        metrics.observe("chat_stream_total_ms", total_ms)
+        logger.info(f"Session {session_id}, streamed {len(answer)} chars, TTFT {ttft_ms or 0:.0f}ms")
+        
+        yield {
+            "type": "done",
+            "session_id": session_id,
+            "ttft_ms": round(ttft_ms, 1) if ttft_ms is not None else None,
+            "total_ms": round(total_ms, 1)
+        }
+    
+    async def summarize_session(self, session_id: str):
+        """Fold older turns into the session summary (run as a background task)"""
+        await self.summarizer.update(session_id)
+    
     def get_session_history(self, session_id: str):
         return self.session_manager.get_history(session_id, last_n=50)
     
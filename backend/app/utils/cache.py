@@ -1,13 +1,20 @@
 ﻿"""
-Caching utilities using Redis
+Caching utilities using Redis and in-process LRU caches
 """
+import asyncio
 import json
 import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
-from typing import Optional, Any, Callable
+from pathlib import Path
+from typing import Optional, Any, Callable, Dict, Hashable
 import redis
 from app.config import settings
 from app.utils.logger import get_logger
+from app.utils.metrics import metrics
 
 logger = get_logger(__name__)
 
@@ -69,3 +76,206 @@ def clear_cache(pattern: str = "*"):
     if redis_client:
         for key in redis_client.scan_iter(pattern):
             redis_client.delete(key)
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache
+    
+    Bounded by entry count and, when a sizeof function is given, by total
+    bytes. Hits, misses and evictions are reported to the metrics registry
+    as "<name>_cache_*" counters.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 1024,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None,
+        sizeof: Optional[Callable[[Any], int]] = None
+    ):
+        """
+        Args:
+            name: Cache name used as metrics prefix
+            max_entries: Maximum number of entries
+            max_bytes: Maximum total size of values (requires sizeof)
+            ttl: Optional time to live in seconds
+            sizeof: Function returning the size of a value in bytes
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a value and mark it most recently used"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                metrics.increment(f"{self.name}_cache_misses")
+                return default
+            
+            self._data.move_to_end(key)
+            self.hits += 1
+            metrics.increment(f"{self.name}_cache_hits")
+            return entry[0]
+    
+    def set(self, key: Hashable, value: Any):
+        """Store a value, evicting least recently used entries over the limits"""
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, expires)
+            self.total_bytes += size
+            
+            while len(self._data) > self.max_entries or (
+                self.max_bytes is not None and self.total_bytes > self.max_bytes
+            ):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+                metrics.increment(f"{self.name}_cache_evictions")
+    
+    def delete(self, key: Hashable):
+        """Remove a value if present"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+    
+    def clear(self):
+        """Remove all values"""
+        with self._lock:
+            self._data.clear()
+            self.total_bytes = 0
+    
+    def stats(self) -> Dict:
+        """Get cache statistics"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None
+        }
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def _remove(self, key: Hashable):
+        """Drop an entry (caller holds the lock)"""
+        _, size, _ = self._data.pop(key)
+        self.total_bytes -= size
+
+
+class CorpusVersion:
+    """
+    Monotonic version number of the indexed corpus
+    
+    Bumped by the ingestion script after every run. Caches store the version
+    with each entry and treat entries from an older version as stale, so a
+    reindex invalidates them without scanning keys. The number lives in a
+    file next to the processed data and is mirrored to Redis when available
+    so other hosts see it too.
+    
+    The current version is the larger of the Redis and file values, so a
+    bump whose Redis publish failed still invalidates caches on this host.
+    
+    get() is called on every cache lookup, so the resolved version is kept
+    in-process for CORPUS_VERSION_REFRESH seconds; Redis is read at most once
+    per interval and skipped for CORPUS_VERSION_REDIS_BACKOFF after a failure.
+    The bumping process sees its new version at once; every other process
+    may serve entries of the previous version for up to that interval.
+    """
+    
+    def __init__(self, path: Optional[str] = None, redis_key: str = "corpus:version"):
+        self.path = Path(path or settings.CORPUS_VERSION_PATH)
+        self.redis_key = redis_key
+        self.refresh = settings.CORPUS_VERSION_REFRESH
+        self._version = 0
+        self._mtime = None
+        self._current: Optional[int] = None
+        self._checked = 0.0
+        self._redis_retry_at = 0.0
+        self._lock = threading.Lock()
+    
+    def get(self) -> int:
+        """Current version (newest of Redis and the version file), refreshed every CORPUS_VERSION_REFRESH seconds"""
+        now = time.monotonic()
+        if self._current is not None and now - self._checked < self.refresh:
+            return self._current
+        self._current = max(self._read_redis() or 0, self._read_file())
+        self._checked = now
+        return self._current
+    
+    async def aget(self) -> int:
+        """get() for the event loop: a due refresh reads Redis and the file in a worker thread"""
+        if self._current is not None and time.monotonic() - self._checked < self.refresh:
+            return self._current
+        return await asyncio.to_thread(self.get)
+    
+    def bump(self) -> int:
+        """Increment the version after the corpus changed"""
+        with self._lock:
+            version = max(self._read_file(), self._read_redis() or 0) + 1
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(str(version), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+            if redis_client:
+                try:
+                    redis_client.set(self.redis_key, version)
+                except Exception as e:
+                    logger.warning(f"Could not publish corpus version to Redis: {e}")
+            self._current = version
+            self._checked = time.monotonic()
+        
+        metrics.set_gauge("corpus_version", version)
+        logger.info(f"Corpus version bumped to {version}")
+        return version
+    
+    def _read_file(self) -> int:
+        """Read the version file, re-parsing only when it changed"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+        if mtime != self._mtime:
+            self._version = int(self.path.read_text(encoding="utf-8").strip() or 0)
+            self._mtime = mtime
+        return self._version
+    
+    def _read_redis(self) -> Optional[int]:
+        """Version stored in Redis (None if unset or unavailable)"""
+        if not redis_client or time.monotonic() < self._redis_retry_at:
+            return None
+        try:
+            value = redis_client.get(self.redis_key)
+            return int(value) if value is not None else None
+        except Exception as e:
+            logger.debug(f"Could not read corpus version from Redis: {e}")
+            self._redis_retry_at = time.monotonic() + settings.CORPUS_VERSION_REDIS_BACKOFF
+            return None
+
+
+# Global corpus version
+corpus_version = CorpusVersion()
@@ -0,0 +1,84 @@
+﻿"""
+In-process metrics
+Counters, gauges and rolling latency histograms for runtime observability
+"""
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+
+class Histogram:
+    """Rolling window of observations with percentile summaries"""
+
+    def __init__(self, window: int = 1000):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        """Record an observation"""
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Get the q-th percentile (0-100) of the rolling window"""
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def summary(self) -> Dict:
+        """Summarize the window"""
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 2) if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99)
+        }
+
+
+class MetricsRegistry:
+    """Thread-safe registry of named metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def increment(self, name: str, value: float = 1):
+        """Increment a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        """Set a gauge to its current value"""
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        """Record a histogram observation"""
+        with self._lock:
+            self.histogram(name).observe(value)
+
+    def histogram(self, name: str) -> Histogram:
+        """Get (or create) a histogram"""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def snapshot(self) -> Dict:
+        """Get all current metric values"""
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {name: h.summary() for name, h in self.histograms.items()}
+            }
+
+
+# Global metrics registry
+metrics = MetricsRegistry()
@@ -0,0 +1,128 @@
+﻿"""
+Single-flight call coalescing
+Concurrent calls with the same key share one execution; with Redis enabled,
+workers also wait for a call another worker already has in flight
+"""
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+from app.config import settings
+from app.utils.cache import redis_client
+from app.utils.logger import get_logger
+from app.utils.metrics import metrics
+
+logger = get_logger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight async calls
+
+    The first caller for a key runs the call as a task; callers arriving while
+    it runs await the same task (cancelling one caller does not cancel the call
+    for the others). Reports <name>_singleflight_calls / _shared counters and a
+    _dedup_ratio gauge (share of calls served by another caller's execution).
+    """
+
+    def __init__(self, name: str, use_redis: Optional[bool] = None):
+        self.name = name
+        self.redis = redis_client if (settings.SINGLEFLIGHT_REDIS if use_redis is None else use_redis) else None
+        self.lock_ttl = settings.SINGLEFLIGHT_LOCK_TTL
+        self.result_ttl = settings.SINGLEFLIGHT_RESULT_TTL
+        self.poll_interval = settings.SINGLEFLIGHT_POLL_INTERVAL
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.calls = 0
+        self.shared = 0
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """Canonical hash of a request (JSON-serializable parts)"""
+        key_data = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Run func, or await the execution already in flight for key"""
+        if not settings.SINGLEFLIGHT_ENABLED:
+            return await func()
+
+        task = self._inflight.get(key)
+        self._record(shared=task is not None)
+        if task is None:
+            task = asyncio.ensure_future(self._run(key, func))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _run(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Execute once in this process, coordinating with other workers through Redis
+
+        The Redis client is synchronous, so every command runs in a worker
+        thread to keep the event loop free while polling.
+        """
+        if not self.redis:
+            return await func()
+
+        lock_key = f"singleflight:{self.name}:lock:{key}"
+        result_key = f"singleflight:{self.name}:result:{key}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_ttl
+
+        while True:
+            try:
+                # Check for a just-published result first: the leader drops its lock right after
+                cached = await asyncio.to_thread(self.redis.get, result_key)
+                if cached:
+                    metrics.increment(f"{self.name}_singleflight_remote_shared")
+                    self._record_shared()
+                    return json.loads(cached)
+                if await asyncio.to_thread(
+                    self.redis.set, lock_key, token, nx=True, px=int(self.lock_ttl * 1000)
+                ):
+                    break  # this worker leads
+            except Exception as e:
+                logger.error(f"Single-flight coordination error: {e}")
+                return await func()
+            if time.monotonic() >= deadline:
+                # The leader died or is too slow; run it ourselves
+                return await func()
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            result = await func()
+            try:
+                await asyncio.to_thread(
+                    self.redis.set, result_key, json.dumps(result), px=int(self.result_ttl * 1000)
+                )
+            except Exception as e:
+                logger.error(f"Single-flight coordination error: {e}")
+            return result
+        finally:
+            try:
+                await asyncio.to_thread(self._release, lock_key, token)
+            except Exception as e:
+                logger.error(f"Single-flight coordination error: {e}")
+
+    def _release(self, lock_key: str, token: str):
+        """Drop the lock if this worker still holds it"""
+        if self.redis.get(lock_key) == token:
+            self.redis.delete(lock_key)
+
+    def _record(self, shared: bool):
+        self.calls += 1
+        metrics.increment(f"{self.name}_singleflight_calls")
+        if shared:
+            self._record_shared()
+        else:
+            self._update_ratio()
+
+    def _record_shared(self):
+        self.shared += 1
+        metrics.increment(f"{self.name}_singleflight_shared")
+        self._update_ratio()
+
+    def _update_ratio(self):
+        metrics.set_gauge(f"{self.name}_singleflight_dedup_ratio", round(self.shared / self.calls, 4))
@@ -1 +1,28 @@
-# Input validation utilities
\ No newline at end of file
+﻿"""
+Input validation utilities
+"""
+import re
+from typing import List
+
+PERSONAL_DATA_PATTERNS: List[re.Pattern] = [
+    re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"),  # email address
+    re.compile(r"\b\d{3}-\d{2}-\d{4}\b"),  # SSN
+    re.compile(r"\b(?:\d[ -]?){8,19}\b"),  # account / card / routing numbers
+    re.compile(r"(?:\+?1[ .-]?)?\(?\d{3}\)?[ .-]?\d{3}[ .-]?\d{4}\b"),  # phone number
+    re.compile(r"\b(?i:my name is|i am|i'm) [A-Z][a-z]+"),  # self-identification
+    re.compile(
+        r"\bmy (?:account|balance|card|loan|mortgage|transactions?|statement|payment|"
+        r"deposit|transfer|address|salary|credit score)\b",
+        re.IGNORECASE
+    )
+]
+
+
+def contains_personal_data(text: str) -> bool:
+    """
+    Whether text looks like it carries personal or account-specific data
+    
+    Used to keep such messages out of shared caches; errs on the side of
+    flagging.
+    """
+    return any(pattern.search(text) for pattern in PERSONAL_DATA_PATTERNS)
@@ -0,0 +1,114 @@
+﻿"""
+ANN Benchmark Script
+Reports recall@k and latency of the IVF index against exact search
+on the local vector store, using sentences from our own documents as queries
+"""
+import sys
+import os
+import time
+from pathlib import Path
+from typing import List
+
+# Add parent directory to path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+from app.config import settings
+from app.core.rag.ann_index import IVFIndex
+from app.core.rag.chunking import chunker
+from app.core.rag.embeddings import embedding_service
+from app.core.rag.local_vector_store import LocalVectorStore
+from app.core.rag.vector_ops import l2_normalize
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def load_queries(directory: Path, count: int, seed: int = 0) -> List[str]:
+    """Sample sentences from the document corpus to use as queries"""
+    sentences = []
+    for file_path in sorted(directory.rglob("*.txt")) + sorted(directory.rglob("*.md")):
+        text = chunker._clean_text(file_path.read_text(encoding="utf-8"))
+        sentences.extend(s for s in chunker._split_sentences(text) if len(s.split()) >= 4)
+
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(sentences), min(count, len(sentences)), replace=False)
+    return [sentences[i] for i in picks]
+
+
+def percentile_ms(timings: List[float], q: float) -> float:
+    return float(np.percentile(timings, q) * 1000)
+
+
+def main():
+    """Run the benchmark and print a markdown report"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Recall vs latency of the IVF index")
+    parser.add_argument("--documents", type=str, default="../data/documents", help="Query source directory")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+    parser.add_argument("--k", type=int, default=5, help="Results per query")
+    parser.add_argument("--nlist", type=int, default=settings.IVF_NLIST, help="IVF lists (0 = auto)")
+    parser.add_argument("--nprobe", type=str, default="1,2,4,8,16,32", help="Comma-separated nprobe values")
+    parser.add_argument("--output", type=str, help="Optional path to write the report to")
+    args = parser.parse_args()
+
+    store = LocalVectorStore()
+    if not store.count:
+        logger.error("Local vector store is empty; ingest documents with VECTOR_BACKEND=local first")
+        return
+    vectors = store._vectors
+
+    queries = load_queries(Path(args.documents), args.queries)
+    query_vectors = l2_normalize(embedding_service.embed_batch(queries))
+    k = min(args.k, store.count)
+
+    # Exact baseline
+    exact, timings = [], []
+    for query in query_vectors:
+        start = time.perf_counter()
+        scores = vectors @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        timings.append(time.perf_counter() - start)
+        exact.append(set(top.tolist()))
+
+    lines = [
+        f"# IVF recall vs latency ({store.count} vectors, {len(queries)} queries, k={k})",
+        "",
+        "| index | nprobe | recall@k | p50 ms | p95 ms | rows scanned |",
+        "|---|---|---|---|---|---|",
+        f"| exact | - | 1.000 | {percentile_ms(timings, 50):.3f} | {percentile_ms(timings, 95):.3f} | {store.count} |"
+    ]
+
+    start = time.perf_counter()
+    index = IVFIndex(store.path, store.dimension, nlist=args.nlist)
+    index.train(vectors)
+    train_seconds = time.perf_counter() - start
+
+    for nprobe in [int(n) for n in args.nprobe.split(",")]:
+        hits, scanned, timings = 0, 0, []
+        for query, expected in zip(query_vectors, exact):
+            start = time.perf_counter()
+            rows = np.sort(index.candidates(query, nprobe))
+            scores = vectors[rows] @ query
+            top = rows[np.argpartition(-scores, min(k, len(rows)) - 1)[:k]]
+            timings.append(time.perf_counter() - start)
+            hits += len(expected & set(top.tolist()))
+            scanned += len(rows)
+
+        lines.append(
+            f"| ivf ({len(index.centroids)} lists) | {nprobe} | {hits / (k * len(queries)):.3f} | "
+            f"{percentile_ms(timings, 50):.3f} | {percentile_ms(timings, 95):.3f} | {scanned // len(queries)} |"
+        )
+
+    lines += ["", f"IVF training time: {train_seconds:.2f}s"]
+    report = "\n".join(lines)
+    print(report)
+
+    if args.output:
+        Path(args.output).write_text(report + "\n", encoding="utf-8")
+        logger.info(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
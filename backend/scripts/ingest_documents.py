@@ -4,15 +4,20 @@ Ingests documents into the vector database
 """
 import sys
 import os
+import time
 from pathlib import Path
 import asyncio
 
 # Add parent directory to path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from app.config import settings
 from app.core.rag.embeddings import embedding_service
+from app.core.rag.keyword_index import keyword_index
+from app.core.rag.sentence_store import sentence_store
 from app.core.rag.vector_store import vector_store
 from app.core.rag.chunking import chunker
+from app.utils.cache import corpus_version
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
@@ -47,14 +52,41 @@ async def ingest_document(file_path: Path, doc_type: str = "policy"):
         # Prepare metadata
         metadata = [chunk["metadata"] for chunk in chunks]
         
-        # Add to vector store
-        doc_ids = vector_store.add_documents(
+        # Upsert into vector store (content-derived ids make re-runs idempotent)
+        start = time.perf_counter()
+        doc_ids = await vector_store.aadd_documents(
             texts=texts,
             embeddings=embeddings,
             metadata=metadata
         )
+        elapsed = time.perf_counter() - start
         
-        logger.info(f"✓ Ingested {len(doc_ids)} chunks from {file_path.name}")
+        # Same point ids in the BM25 index so hybrid results fuse by id
+        # (written once at the end of the run, not per file)
+        keyword_index.add_documents(doc_ids, texts, metadata, save=False)
+        
+        # Chunks the file no longer produces (it was edited) leave all three stores
+        stale = set(await vector_store.adelete_stale(file_path.name, doc_ids))
+        stale.update(keyword_index.delete_stale(file_path.name, doc_ids, save=False))
+        sentence_store.remove(list(stale))
+        
+        # Per-sentence vectors for query-focused context compression; chunks
+        # already in the store (unchanged content, same id) are not re-embedded
+        _, spans = sentence_store.lookup(doc_ids)
+        new_chunks = [(doc_id, text) for doc_id, text, span in zip(doc_ids, texts, spans) if span is None]
+        sentences = [chunker._split_sentences(text) for _, text in new_chunks]
+        flat_sentences = [s for chunk_sentences in sentences for s in chunk_sentences]
+        if flat_sentences:
+            sentence_store.add(
+                [doc_id for doc_id, _ in new_chunks],
+                [len(chunk_sentences) for chunk_sentences in sentences],
+                embedding_service.embed_batch(flat_sentences)
+            )
+        
+        logger.info(
+            f"✓ Ingested {len(doc_ids)} chunks from {file_path.name} "
+            f"({len(doc_ids) / max(elapsed, 1e-9):.0f} points/s)"
+        )
         return len(doc_ids)
         
     except Exception as e:
@@ -72,23 +104,29 @@ async def ingest_directory(directory: Path, doc_type: str = "policy"):
     """
     if not directory.exists():
         logger.error(f"Directory not found: {directory}")
-        return
+        return 0
     
     # Find all text files
     files = list(directory.glob("*.txt")) + list(directory.glob("*.md"))
     
     if not files:
         logger.warning(f"No text files found in {directory}")
-        return
+        return 0
     
     logger.info(f"Found {len(files)} files to ingest")
     
     total_chunks = 0
+    start = time.perf_counter()
     for file_path in files:
         chunks = await ingest_document(file_path, doc_type)
         total_chunks += chunks
+    elapsed = time.perf_counter() - start
     
-    logger.info(f"\n✅ Ingestion complete! Total chunks: {total_chunks}")
+    logger.info(
+        f"\n✅ Ingestion complete! Total chunks: {total_chunks} "
+        f"in {elapsed:.1f}s ({total_chunks / max(elapsed, 1e-9):.0f} points/s end to end)"
+    )
+    return total_chunks
 
 
 async def main():
@@ -103,12 +141,25 @@ async def main():
     
     path = Path(args.path)
     
+    total_chunks = 0
     if path.is_file():
-        await ingest_document(path, args.type)
+        total_chunks = await ingest_document(path, args.type)
     elif path.is_dir():
-        await ingest_directory(path, args.type)
+        total_chunks = await ingest_directory(path, args.type)
     else:
         logger.error(f"Invalid path: {path}")
+    
+    # Publish the keyword index, then invalidate cached retrieval results
+    # computed against the old corpus
+    keyword_index.save()
+    if total_chunks:
+        corpus_version.bump()
+    
+    # Reclaim payload bytes left behind by edited and deleted chunks
+    if settings.VECTOR_BACKEND == "local":
+        vector_store.compact()
+    
+    await vector_store.close()
 
 
 if __name__ == "__main__":
@@ -1 +1,29 @@
-# Pytest fixtures
\ No newline at end of file
+# Pytest fixtures
+import os
+import tempfile
+
+import pytest
+
+# Settings require API keys; unit tests never call the real services
+os.environ.setdefault("GROQ_API_KEY", "test")
+os.environ.setdefault("TAVILY_API_KEY", "test")
+# Keep the embedding model out of the test process (the thin client never connects)
+os.environ.setdefault("EMBEDDING_SERVER_SOCKET", "/tmp/bank-support-tests.sock")
+# Global stores built at import (retriever, agent) use empty local files, not Qdrant or ../data
+_data_dir = tempfile.mkdtemp(prefix="bank-support-tests-")
+os.environ.setdefault("VECTOR_BACKEND", "local")
+os.environ.setdefault("LOCAL_VECTOR_PATH", os.path.join(_data_dir, "embeddings"))
+os.environ.setdefault("KEYWORD_INDEX_PATH", os.path.join(_data_dir, "keyword_index.json"))
+os.environ.setdefault("SENTENCE_STORE_PATH", os.path.join(_data_dir, "sentences"))
+os.environ.setdefault("CORPUS_VERSION_PATH", os.path.join(_data_dir, "corpus_version"))
+
+
+@pytest.fixture
+def corpus_version(tmp_path, monkeypatch):
+    """File-backed corpus version without Redis or the in-process refresh delay"""
+    from app.utils import cache
+
+    monkeypatch.setattr(cache, "redis_client", None)
+    version = cache.CorpusVersion(path=str(tmp_path / "corpus_version"))
+    version.refresh = 0
+    return version
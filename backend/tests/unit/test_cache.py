@@ -0,0 +1,239 @@
+# Cache unit tests
+import asyncio
+import threading
+import types
+
+import numpy as np
+import pytest
+
+from app.config import settings
+from app.core.orchestrator.answer_cache import SemanticAnswerCache
+from app.core.orchestrator.router import QueryType
+from app.core.rag.retrieval_cache import RetrievalCache
+from app.utils import cache
+from app.utils.cache import LRUCache
+from app.utils.metrics import metrics
+from app.utils.singleflight import SingleFlight
+
+
+class FakeEmbeddings:
+    """Maps known questions to fixed vectors"""
+
+    vectors = {
+        "what is the overdraft fee": np.array([1.0, 0.0, 0.0], dtype=np.float32),
+        "how much is the overdraft fee": np.array([0.99, 0.05, 0.0], dtype=np.float32),
+    }
+
+    async def aembed_text(self, text):
+        return self.vectors[text]
+
+
+def test_corpus_version_bump_is_seen_immediately(corpus_version):
+    assert corpus_version.get() == 0
+    assert corpus_version.bump() == 1
+    assert corpus_version.get() == 1
+
+
+def test_corpus_version_is_reused_within_refresh_interval(corpus_version, tmp_path):
+    corpus_version.refresh = 60
+    assert corpus_version.get() == 0
+    (tmp_path / "corpus_version").write_text("7", encoding="utf-8")
+    assert corpus_version.get() == 0  # another process bumped it; seen after the interval
+    corpus_version.refresh = 0
+    assert corpus_version.get() == 7
+
+
+def test_corpus_version_survives_a_failed_redis_publish(corpus_version, monkeypatch, tmp_path):
+    class StaleRedis:
+        def get(self, key):
+            return "1"
+
+        def set(self, key, value):
+            raise ConnectionError("redis down")
+
+    monkeypatch.setattr(cache, "redis_client", StaleRedis())
+    assert corpus_version.bump() == 2
+
+    # Another process reads the stale Redis value but the newer file wins
+    other = cache.CorpusVersion(path=str(tmp_path / "corpus_version"))
+    other.refresh = 0
+    assert other.get() == 2
+
+
+def test_bump_invalidates_retrieval_cache(corpus_version):
+    cache = RetrievalCache()
+    cache.enabled = True
+    cache.redis = None
+    cache.versions = corpus_version
+    key = cache.key("overdraft fee", top_k=5)
+
+    asyncio.run(cache.set(key, [{"id": "a", "text": "Overdraft fee is $35"}]))
+    assert asyncio.run(cache.get(key)) == [{"id": "a", "text": "Overdraft fee is $35"}]
+
+    corpus_version.bump()
+    assert asyncio.run(cache.get(key)) is None
+
+
+def test_retrieval_cache_keeps_redis_off_the_event_loop(corpus_version):
+    class ThreadRecordingRedis:
+        def __init__(self):
+            self.threads = []
+
+        def get(self, key):
+            self.threads.append(threading.get_ident())
+            return None
+
+        def setex(self, key, ttl, value):
+            self.threads.append(threading.get_ident())
+
+    cache = RetrievalCache()
+    cache.enabled = True
+    cache.redis = ThreadRecordingRedis()
+    cache.versions = corpus_version
+    key = cache.key("overdraft fee", top_k=5)
+
+    async def scenario():
+        assert await cache.get(key) is None
+        await cache.set(key, [{"id": "a", "text": "Overdraft fee is $35"}])
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(scenario())
+    assert len(cache.redis.threads) == 2
+    assert loop_thread not in cache.redis.threads
+
+
+def test_bump_invalidates_semantic_answer_cache(corpus_version):
+    cache = SemanticAnswerCache(max_entries=4, dimension=3)
+    cache.enabled = True
+    cache.embedding_service = FakeEmbeddings()
+    cache.versions = corpus_version
+    result = {"answer": "$35", "sources": [], "method": "rag"}
+
+    async def scenario():
+        await cache.store("what is the overdraft fee", QueryType.RAG_ONLY, result)
+        hit = await cache.lookup("how much is the overdraft fee", QueryType.RAG_ONLY)
+        corpus_version.bump()
+        miss = await cache.lookup("how much is the overdraft fee", QueryType.RAG_ONLY)
+        return hit, miss
+
+    hit, miss = asyncio.run(scenario())
+    assert hit["answer"] == "$35"
+    assert miss is None
+
+
+def test_answer_cache_never_caches_escalations_or_web_search(monkeypatch):
+    monkeypatch.setattr(settings, "ANSWER_CACHE_ROUTES", ["rag", "hybrid", "search", "escalate"])
+    cache = SemanticAnswerCache(max_entries=4, dimension=3)
+    cache.enabled = True
+
+    assert cache.is_cacheable("what is the overdraft fee", QueryType.RAG_ONLY, [])
+    assert not cache.is_cacheable("what is the overdraft fee", QueryType.SEARCH_ONLY, [])
+    assert not cache.is_cacheable("what is the overdraft fee", QueryType.ESCALATE, [])
+
+
+def test_lru_cache_evicts_least_recently_used():
+    lru = LRUCache("test", max_entries=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+
+    assert lru.get("b") is None
+    assert (lru.get("a"), lru.get("c")) == (1, 3)
+    assert lru.stats()["evictions"] == 1
+
+
+def test_lru_cache_evicts_by_size():
+    lru = LRUCache("test", max_entries=10, max_bytes=10, sizeof=len)
+    lru.set("a", "x" * 4)
+    lru.set("b", "x" * 4)
+    lru.set("c", "x" * 4)
+    lru.set("huge", "x" * 11)
+
+    assert lru.get("a") is None
+    assert lru.get("huge") is None
+    assert len(lru) == 2
+    assert lru.total_bytes == 8
+
+
+def test_lru_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    lru = LRUCache("test", max_entries=10, ttl=5)
+    lru.set("a", 1)
+
+    now[0] += 4.9
+    assert lru.get("a") == 1
+    now[0] += 0.2
+    assert lru.get("a") is None
+    assert len(lru) == 0
+
+
+@pytest.fixture
+def flight(monkeypatch):
+    monkeypatch.setattr(settings, "SINGLEFLIGHT_ENABLED", True)
+    return SingleFlight("test", use_redis=False)
+
+
+def counted(delay=0.05, result="answer"):
+    """Call that records each execution"""
+    executions = []
+
+    async def func():
+        executions.append(1)
+        await asyncio.sleep(delay)
+        return result
+    return func, executions
+
+
+def test_singleflight_shares_one_execution(flight):
+    func, executions = counted()
+
+    async def scenario():
+        return await asyncio.gather(*[flight.do("k", func) for _ in range(3)], flight.do("other", func))
+
+    assert asyncio.run(scenario()) == ["answer"] * 4
+    assert len(executions) == 2
+    assert (flight.calls, flight.shared) == (4, 2)
+    assert metrics.gauges["test_singleflight_dedup_ratio"] == 0.5
+    assert flight._inflight == {}
+
+
+def test_singleflight_runs_again_once_finished(flight):
+    func, executions = counted(delay=0)
+
+    async def scenario():
+        await flight.do("k", func)
+        await flight.do("k", func)
+
+    asyncio.run(scenario())
+    assert len(executions) == 2
+    assert metrics.gauges["test_singleflight_dedup_ratio"] == 0.0
+
+
+def test_singleflight_cancelling_one_caller_keeps_the_call(flight):
+    func, executions = counted(delay=0.1)
+
+    async def scenario():
+        first = asyncio.ensure_future(flight.do("k", func))
+        second = asyncio.ensure_future(flight.do("k", func))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(scenario()) == "answer"
+    assert len(executions) == 1
+
+
+def test_singleflight_disabled_runs_every_call(flight, monkeypatch):
+    monkeypatch.setattr(settings, "SINGLEFLIGHT_ENABLED", False)
+    func, executions = counted(delay=0.01)
+
+    async def scenario():
+        await asyncio.gather(flight.do("k", func), flight.do("k", func))
+
+    asyncio.run(scenario())
+    assert len(executions) == 2
+    assert flight.calls == 0
@@ -0,0 +1,111 @@
+# Chat streaming unit tests
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.v1.routes import chat
+from app.core.session.manager import SessionManager
+from app.core.session.summarizer import ConversationSummarizer
+from app.services.chat_service import ChatService
+
+META = {"type": "meta", "sources": [{"source": "fees.pdf"}], "method": "rag", "escalate": False, "metadata": {}}
+ANSWER = [{"type": "token", "content": "The fee "}, {"type": "token", "content": "is $35."}]
+
+
+class FakeAgent:
+    """Streams a fixed list of events"""
+
+    def __init__(self, *events):
+        self.events = events
+
+    async def stream_query(self, query, conversation_history=None):
+        for event in self.events:
+            await asyncio.sleep(0)
+            yield dict(event)
+
+
+@pytest.fixture
+def service():
+    """Chat service over an in-memory session store"""
+    sessions = SessionManager.__new__(SessionManager)
+    sessions.redis_client = None
+    sessions.memory_storage = {}
+    sessions.memory_summaries = {}
+    service = ChatService()
+    service.session_manager = sessions
+    service.summarizer = ConversationSummarizer()
+    service.summarizer.session_manager = sessions
+    return service
+
+
+def collect(service, message="What is the fee?", session_id="s"):
+    """Event types of the stream, and the stored message count as each was yielded"""
+    async def scenario():
+        seen = []
+        async for event in service.stream_message(message, session_id=session_id):
+            seen.append((event, service.session_manager.count_messages(session_id)))
+        return seen
+
+    return asyncio.run(scenario())
+
+
+def parse_sse(body):
+    """(event, data) pairs of a server-sent event stream"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        name, data = block.split("\n")
+        events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_stream_emits_meta_tokens_then_done_and_saves_after(service):
+    service.agent = FakeAgent(META, *ANSWER)
+
+    seen = collect(service)
+
+    assert [event["type"] for event, _ in seen] == ["meta", "token", "token", "done"]
+    assert seen[0][0]["session_id"] == seen[-1][0]["session_id"] == "s"
+    assert seen[-1][0]["ttft_ms"] is not None
+    # Nothing is stored while tokens are streaming; the exchange is stored before "done"
+    assert [count for _, count in seen] == [0, 0, 0, 2]
+    assert service.session_manager.get_history("s") == [
+        {"role": "user", "content": "What is the fee?"},
+        {"role": "assistant", "content": "The fee is $35."}
+    ]
+
+
+def test_stream_stops_at_an_error_without_saving(service):
+    service.agent = FakeAgent(META, ANSWER[0], {"type": "error", "message": "boom"})
+
+    seen = collect(service)
+
+    assert [event["type"] for event, _ in seen] == ["meta", "token", "error"]
+    assert service.session_manager.count_messages("s") == 0
+
+
+def test_stream_route_sends_sse_and_summarizes_after_saving(service, monkeypatch):
+    service.agent = FakeAgent(META, *ANSWER)
+    summarized = []
+
+    async def summarize_session(session_id):
+        summarized.append((session_id, service.session_manager.count_messages(session_id)))
+
+    service.summarize_session = summarize_session
+    monkeypatch.setattr(chat, "chat_service", service)
+    app = FastAPI()
+    app.include_router(chat.router, prefix="/api/v1")
+
+    response = TestClient(app).post("/api/v1/chat/stream", json={"message": "What is the fee?"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+    assert [name for name, _ in events] == ["meta", "token", "token", "done"]
+    assert "".join(data["content"] for name, data in events if name == "token") == "The fee is $35."
+    session_id = events[0][1]["session_id"]
+    assert events[-1][1]["session_id"] == session_id
+    # The background summary runs once the stream (and the save) has finished
+    assert summarized == [(session_id, 2)]
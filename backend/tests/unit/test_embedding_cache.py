@@ -0,0 +1,24 @@
+# Embedding cache unit tests
+import numpy as np
+
+from app.core.rag.embeddings import EmbeddingCache
+
+
+def test_lookup_is_normalized_and_read_only():
+    cache = EmbeddingCache("model-a", max_entries=10, max_bytes=1 << 20)
+    stored = cache.set("model-a", "What is  APR?", np.arange(3))
+
+    cached = cache.get("model-a", "what is apr?")
+    assert cached is stored
+    assert cached.dtype == np.float32
+    assert not cached.flags.writeable
+
+
+def test_entries_are_scoped_to_the_model():
+    cache = EmbeddingCache("model-a", max_entries=10, max_bytes=1 << 20)
+    cache.set("model-a", "apr", np.ones(3))
+
+    assert cache.get("model-b", "apr") is None
+    cache.set("model-b", "apr", np.zeros(3))
+    assert cache.get("model-a", "apr")[0] == 1.0
+    assert cache.get("model-b", "apr")[0] == 0.0
@@ -1 +1,354 @@
-# LLM unit tests
\ No newline at end of file
+# LLM unit tests
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app.config import settings
+from app.core.llm.context_packer import ContextPacker, TokenCounter
+from app.core.llm.groq_client import GroqClient, LLMDeadlineExceeded
+from app.core.llm.rate_limiter import LLMOverloadedError, Priority, RateLimiter, parse_duration
+from app.core.llm.response_parser import StreamingJSONParser, parse_json
+from app.utils.metrics import metrics
+
+
+def feed_chars(parser, text):
+    """Feed text one character at a time, collecting completed fields"""
+    fields = []
+    for char in text:
+        fields.extend(parser.feed(char))
+    return fields
+
+
+def test_parse_json_accepts_any_bare_value():
+    assert parse_json('{"a": 1}') == {"a": 1}
+    assert parse_json("[1, 2]") == [1, 2]
+    assert parse_json("3") == 3
+    assert parse_json('"text"') == "text"
+
+
+def test_parse_json_ignores_code_fences_and_prose():
+    assert parse_json('```json\n{"intent": "fees"}\n```') == {"intent": "fees"}
+    assert parse_json('Sure:\n```\n[{"a": 1}, [2, 3]]\n```\nDone.') == [{"a": 1}, [2, 3]]
+
+
+def test_parse_json_rejects_incomplete_and_invalid_values():
+    with pytest.raises(ValueError):
+        parse_json('{"a": 1, "b": ')
+    with pytest.raises(ValueError):
+        parse_json('{"a": }')
+    with pytest.raises(ValueError):
+        parse_json("[1,]")
+    with pytest.raises(ValueError):
+        parse_json("no json here")
+
+
+def test_streaming_parser_emits_fields_as_they_complete():
+    parser = StreamingJSONParser()
+    assert parser.feed('{"intent": "fees", "confi') == [("intent", "fees")]
+    assert parser.feed('dence": 0.9, "tags": ["a",') == [("confidence", 0.9)]
+    assert parser.feed(' "b"]}') == [("tags", ["a", "b"])]
+    assert parser.done
+    assert parser.close() == {"intent": "fees", "confidence": 0.9, "tags": ["a", "b"]}
+
+
+def test_streaming_parser_handles_escapes_and_brackets_in_strings():
+    text = '```json\n{"say": "a \\"quoted\\" } and \\\\", "next": {"k": "]"}}\n```'
+    parser = StreamingJSONParser()
+    fields = feed_chars(parser, text)
+    assert fields == [("say", 'a "quoted" } and \\'), ("next", {"k": "]"})]
+    assert parser.close() == {"say": 'a "quoted" } and \\', "next": {"k": "]"}}
+
+
+def test_streaming_parser_emits_array_items():
+    parser = StreamingJSONParser()
+    fields = feed_chars(parser, '[{"a": 1}, "x", 3]')
+    assert fields == [(0, {"a": 1}), (1, "x"), (2, 3)]
+    assert parser.close() == [{"a": 1}, "x", 3]
+
+
+def test_streaming_parser_close_fails_on_partial_object():
+    parser = StreamingJSONParser()
+    assert parser.feed('{"a": 1, "b": [1, 2') == [("a", 1)]
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+FEES = "Overdraft fees are $35. They are waived under $5."  # 6 + 7 estimated tokens
+
+
+def make_packer(budget, item_max_tokens=300):
+    return ContextPacker(budget=budget, item_max_tokens=item_max_tokens, counter=TokenCounter(margin=1.0))
+
+
+def test_token_estimate_applies_the_margin():
+    assert TokenCounter(margin=1.0).count("x" * 40) == 10
+    assert TokenCounter(margin=1.25).count("x" * 40) == 13
+
+
+def test_packer_fills_the_budget_in_section_order():
+    packed = make_packer(budget=20).pack([
+        ("documents", [{"text": FEES, "source": "a.pdf"}, {"text": FEES, "source": "b.pdf"}]),
+        ("web", [{"text": FEES}])
+    ])
+
+    assert packed["sections"]["documents"] == [
+        {"text": FEES, "source": "a.pdf"},
+        {"text": "Overdraft fees are $35.", "source": "b.pdf"}
+    ]
+    assert packed["sections"]["web"] == []
+    assert packed["tokens"] == {"documents": 19, "web": 0, "history": 0, "total": 19, "budget": 20}
+
+
+def test_packer_cuts_items_at_sentence_boundaries():
+    packer = make_packer(budget=100, item_max_tokens=12)
+
+    assert packer.pack([("documents", [{"text": FEES}])])["sections"]["documents"][0]["text"] == "Overdraft fees are $35."
+    assert packer._extract(FEES, 13) == (FEES, 13)
+
+
+def test_packer_truncates_an_overlong_sentence_by_words():
+    sentence = "Wire transfers submitted after the daily cutoff are processed on the next business day."
+
+    assert make_packer(budget=5)._extract(sentence, 5) == ("Wire transfers", 4)
+    assert make_packer(budget=5)._extract(sentence, 0) == ("", 0)
+
+
+def test_packer_puts_the_summary_before_the_most_recent_turns():
+    history = [
+        {"role": "user", "content": "What is the overdraft fee?"},
+        {"role": "assistant", "content": "It is $35 per item."},
+        {"role": "system", "content": "The user asked about fees."},
+        {"role": "user", "content": "And for wires?"},
+        {"role": "assistant", "content": "Wires cost $25."}
+    ]
+
+    packed = make_packer(budget=20).pack([], history)
+
+    assert [msg["content"] for msg in packed["history"]] == [
+        "The user asked about fees.", "It is $35 per item.", "And for wires?", "Wires cost $25."
+    ]
+    assert packed["history"][0]["role"] == "system"
+    assert packed["tokens"]["history"] == 20
+
+
+def make_limiter(requests=600, tokens=60000, max_queue=10):
+    limiter = RateLimiter(requests_per_minute=requests, tokens_per_minute=tokens, counter=TokenCounter())
+    limiter.max_queue = max_queue
+    return limiter
+
+
+def test_parse_duration_formats():
+    assert parse_duration("30") == 30
+    assert parse_duration("7.66s") == pytest.approx(7.66)
+    assert parse_duration("2m59.56s") == pytest.approx(179.56)
+    assert parse_duration("120ms") == pytest.approx(0.12)
+    assert parse_duration("soon") is None
+    assert parse_duration(None) is None
+
+
+def test_rate_limiter_admits_higher_priority_first():
+    async def scenario():
+        limiter = make_limiter()
+        limiter.paused_until = time.monotonic() + 0.05
+        admitted = []
+
+        async def request(name, priority):
+            await limiter.acquire(10, priority)
+            admitted.append(name)
+
+        await asyncio.gather(
+            request("warmup", Priority.WARMUP),
+            request("background", Priority.BACKGROUND),
+            request("interactive", Priority.INTERACTIVE)
+        )
+        return admitted
+
+    assert asyncio.run(scenario()) == ["interactive", "background", "warmup"]
+
+
+def test_rate_limiter_sheds_when_queue_is_full():
+    async def scenario():
+        limiter = make_limiter(max_queue=1)
+        limiter.paused_until = time.monotonic() + 0.05
+        background = asyncio.ensure_future(limiter.acquire(10, Priority.BACKGROUND))
+        await asyncio.sleep(0)
+
+        # A more important request evicts the queued background one...
+        interactive = asyncio.ensure_future(limiter.acquire(10, Priority.INTERACTIVE))
+        await asyncio.sleep(0)
+        with pytest.raises(LLMOverloadedError):
+            await background
+
+        # ...while an equal one is shed on arrival
+        with pytest.raises(LLMOverloadedError):
+            await limiter.acquire(10, Priority.INTERACTIVE)
+        await interactive
+
+    asyncio.run(scenario())
+
+
+def test_rate_limiter_sheds_after_max_wait():
+    async def scenario():
+        limiter = make_limiter()
+        limiter.max_wait[Priority.INTERACTIVE] = 0.05
+        limiter.paused_until = time.monotonic() + 10
+        with pytest.raises(LLMOverloadedError):
+            await limiter.acquire(10)
+        assert limiter.queue_depth() == 0
+
+    asyncio.run(scenario())
+
+
+def test_rate_limiter_syncs_buckets_from_headers():
+    limiter = make_limiter(requests=30, tokens=12000)
+    limiter.update_from_headers({
+        "x-ratelimit-remaining-requests": "5",
+        "x-ratelimit-remaining-tokens": "100",
+        "x-ratelimit-reset-tokens": "7.66s"
+    })
+    assert limiter.requests.available == pytest.approx(5, abs=0.1)
+    assert limiter.tokens.available == pytest.approx(100, abs=5)
+
+    # Higher remaining counts never raise the local estimate
+    limiter.update_from_headers({"x-ratelimit-remaining-tokens": "11000"})
+    assert limiter.tokens.available < 200
+
+    # Exhausted: nothing refills before the reported reset
+    limiter.update_from_headers({"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "3s"})
+    assert limiter.tokens.wait_time(1) == pytest.approx(3, abs=0.1)
+
+
+def test_rate_limiter_pauses_after_429():
+    limiter = make_limiter()
+    limiter.on_rate_limited({"retry-after": "2"})
+    assert limiter.paused_until - time.monotonic() == pytest.approx(2, abs=0.1)
+
+    async def scenario():
+        limiter.max_wait[Priority.INTERACTIVE] = 0.05
+        with pytest.raises(LLMOverloadedError):
+            await limiter.acquire(10)
+
+    asyncio.run(scenario())
+
+
+def test_rate_limiter_settle_returns_unused_tokens():
+    limiter = make_limiter(tokens=6000)
+    limiter.tokens.take(1000)
+    limiter.settle(1000, 200)
+    assert limiter.tokens.available == pytest.approx(5800, abs=1)
+    limiter.settle(1000, 0)
+    assert limiter.tokens.available == pytest.approx(6000, abs=1)
+
+
+def test_rate_limiter_refunds_a_caller_cancelled_after_admission():
+    async def scenario():
+        limiter = make_limiter(tokens=6000)
+        request = asyncio.ensure_future(limiter.acquire(1000))
+        await asyncio.sleep(0)  # queued, dispatcher not run yet
+
+        limiter._admit()  # admitted and charged before the caller resumes
+        assert limiter.tokens.available == pytest.approx(5000, abs=1)
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+        return limiter
+
+    assert asyncio.run(scenario()).tokens.available == pytest.approx(6000, abs=1)
+
+
+@pytest.fixture
+def hedged_client(monkeypatch):
+    """Client that hedges after 50ms and whose per-model attempts are scripted"""
+    monkeypatch.setattr(settings, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(settings, "LLM_HEDGE_DEFAULT_DELAY", 0.05)
+    monkeypatch.setattr(settings, "LLM_HEDGE_MIN_DELAY", 0.05)
+    monkeypatch.setattr(settings, "LLM_HEDGE_MIN_SAMPLES", 10 ** 9)
+    monkeypatch.setattr(settings, "LLM_HARD_DEADLINE", 1.0)
+    client = GroqClient()
+    client.model, client.fallback_model = "primary", "fallback"
+    client.cancelled = []
+
+    def script(**behaviours):
+        async def attempt(model, messages, temperature, max_tokens, priority):
+            delay, outcome = behaviours[model]
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                client.cancelled.append(model)
+                raise
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        client._attempt = attempt
+    client.script = script
+    return client
+
+
+def ask(client, text):
+    return asyncio.run(client.generate([{"role": "user", "content": text}]))
+
+
+def test_hedge_wins_when_primary_is_slow(hedged_client):
+    hedged_client.script(primary=(5, "slow answer"), fallback=(0, "hedged answer"))
+
+    assert ask(hedged_client, "hedge wins") == "hedged answer"
+    assert (hedged_client.hedged, hedged_client.hedge_wins) == (1, 1)
+    assert hedged_client.cancelled == ["primary"]
+
+
+def test_primary_wins_after_hedge_started(hedged_client):
+    hedged_client.script(primary=(0.1, "primary answer"), fallback=(5, "hedged answer"))
+
+    assert ask(hedged_client, "primary wins") == "primary answer"
+    assert (hedged_client.hedged, hedged_client.hedge_wins) == (1, 0)
+    assert hedged_client.cancelled == ["fallback"]
+
+
+def test_fast_primary_is_not_hedged(hedged_client):
+    hedged_client.script(primary=(0, "primary answer"), fallback=(0, "hedged answer"))
+
+    assert ask(hedged_client, "fast") == "primary answer"
+    assert hedged_client.hedged == 0
+
+
+def test_both_attempts_failing_raises_the_first_error(hedged_client):
+    hedged_client.script(primary=(0.1, ValueError("primary down")), fallback=(0.15, RuntimeError("fallback down")))
+
+    with pytest.raises(ValueError, match="primary down"):
+        ask(hedged_client, "both fail")
+    assert hedged_client.hedged == 1
+
+
+def test_deadline_cancels_both_attempts(hedged_client, monkeypatch):
+    monkeypatch.setattr(settings, "LLM_HARD_DEADLINE", 0.15)
+    hedged_client.script(primary=(5, "late"), fallback=(5, "late"))
+
+    start = time.monotonic()
+    with pytest.raises(LLMDeadlineExceeded):
+        ask(hedged_client, "too slow")
+    assert time.monotonic() - start < 0.5
+    assert sorted(hedged_client.cancelled) == ["fallback", "primary"]
+
+
+def test_streamed_calls_do_not_feed_the_hedge_latency(monkeypatch):
+    monkeypatch.setattr(settings, "LLM_RATE_LIMIT_ENABLED", False)
+    client = GroqClient()
+
+    async def create(**params):
+        async def parse():
+            return "response"
+        return SimpleNamespace(headers={}, parse=parse)
+    client.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+        with_raw_response=SimpleNamespace(create=create)
+    )))
+    histogram = metrics.histogram("llm_latency_ms")
+    messages = [{"role": "user", "content": "hi"}]
+    before = histogram.count
+
+    asyncio.run(client._create(Priority.INTERACTIVE, messages=messages, max_tokens=10, stream=True))
+    assert histogram.count == before
+
+    asyncio.run(client._create(Priority.INTERACTIVE, messages=messages, max_tokens=10))
+    assert histogram.count == before + 1
@@ -0,0 +1,296 @@
+# Orchestrator unit tests
+import asyncio
+import time
+
+import pytest
+
+from app.config import settings
+from app.core.llm.context_packer import ContextPacker, TokenCounter
+from app.core.llm.groq_client import GroqClient
+from app.core.orchestrator import tools
+from app.core.orchestrator.agent import BankingSupportAgent
+from app.core.orchestrator.router import QueryType
+from app.core.orchestrator.tools import Tool, ToolRegistry, ToolRunner
+
+SCHEMA = {"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
+
+
+def make_registry(*tool_list, budget=1000):
+    return ToolRegistry(list(tool_list), packer=ContextPacker(budget=budget, item_max_tokens=300, counter=TokenCounter(margin=1.0)))
+
+
+def sleeper(name, delay, timeout=1.0):
+    async def func(query):
+        await asyncio.sleep(delay)
+        return [{"text": f"{name}: {query}", "source": f"{name}.pdf"}]
+    return Tool(name, f"{name} tool", SCHEMA, func, timeout=timeout)
+
+
+class ScriptedLLM:
+    """Returns queued responses and records every generate_with_tools call"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    async def generate_with_tools(self, messages, tools, temperature=None, tool_choice=None, deadline=None):
+        self.calls.append({"messages": list(messages), "tool_choice": tool_choice, "deadline": deadline})
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+def tool_call(call_id, name, **arguments):
+    return {"id": call_id, "name": name, "arguments": arguments}
+
+
+class FakeRouter:
+    async def route(self, query, context):
+        return QueryType.RAG_ONLY, {}
+
+
+class NoCache:
+    def is_cacheable(self, query, query_type, history):
+        return False
+
+
+@pytest.fixture
+def slow_agent(monkeypatch):
+    """Agent whose RAG plan is fixed and whose LLM never answers in time"""
+    monkeypatch.setattr(settings, "LLM_HARD_DEADLINE", 0.05)
+
+    async def never(model, messages, temperature, max_tokens, priority):
+        await asyncio.sleep(5)
+
+    agent = BankingSupportAgent()
+    agent.router = FakeRouter()
+    agent.answer_cache = NoCache()
+    agent.llm = GroqClient()
+    agent.llm._attempt = never
+
+    def prepare(excerpt):
+        async def _prepare(query, history, query_type, metadata):
+            return {
+                "messages": [{"role": "user", "content": query}],
+                "excerpt": excerpt,
+                "sources": [{"source": "fees.pdf"}],
+                "method": "rag"
+            }
+        agent._prepare = _prepare
+    agent.prepare = prepare
+    return agent
+
+
+def test_agent_degrades_to_the_best_passage_past_the_deadline(slow_agent):
+    slow_agent.prepare("The overdraft fee is $35 per item.")
+
+    result = asyncio.run(slow_agent.process_query("What is the overdraft fee?"))
+
+    assert result["method"] == "degraded"
+    assert result["answer"].endswith("The overdraft fee is $35 per item.")
+    assert result["sources"] == [{"source": "fees.pdf"}]
+    assert "excerpt" not in result and "messages" not in result
+
+
+def test_agent_degrades_without_a_passage(slow_agent):
+    slow_agent.prepare(None)
+
+    result = asyncio.run(slow_agent.process_query("What is the overdraft fee?"))
+
+    assert result["method"] == "degraded"
+    assert "try again" in result["answer"]
+
+
+@pytest.fixture
+def hybrid_agent():
+    """Agent whose RAG and web-search branches return fixed results after a delay"""
+    agent = BankingSupportAgent()
+    agent.delays = {"rag": 0.0, "search": 0.0}
+
+    class FakeRetriever:
+        async def retrieve(self, query, top_k=None, filters=None, query_variants=None):
+            await asyncio.sleep(agent.delays["rag"])
+            return [{"text": "The overdraft fee is $35 per item.", "metadata": {"source": "fees.pdf"}}]
+
+    class FakeSearch:
+        async def search_banking_info(self, query):
+            await asyncio.sleep(agent.delays["search"])
+            return [{"title": "Fee survey", "url": "https://example.com/fees", "content": "Overdraft fees average $27."}]
+
+    agent.retriever = FakeRetriever()
+    agent.search = FakeSearch()
+    return agent
+
+
+def test_hybrid_runs_rag_and_web_search_concurrently(hybrid_agent):
+    hybrid_agent.delays = {"rag": 0.2, "search": 0.2}
+
+    start = time.perf_counter()
+    plan = asyncio.run(hybrid_agent._prepare_hybrid("What is the overdraft fee?", []))
+
+    assert time.perf_counter() - start < 0.35
+    assert plan["method"] == "hybrid"
+    assert plan["sources"] == [{"source": "fees.pdf"}, {"title": "Fee survey", "url": "https://example.com/fees"}]
+    branches = plan["metadata"]["branches"]
+    for name in ("rag", "search"):
+        assert branches[name]["status"] == "ok"
+        assert branches[name]["results"] == 1
+        assert 150 <= branches[name]["latency_ms"] < 350
+
+
+def test_hybrid_degrades_to_the_other_branch_on_timeout(hybrid_agent, monkeypatch):
+    monkeypatch.setattr(settings, "HYBRID_RAG_TIMEOUT", 0.05)
+    hybrid_agent.delays["rag"] = 5
+
+    start = time.perf_counter()
+    plan = asyncio.run(hybrid_agent._prepare_hybrid("What is the overdraft fee?", []))
+
+    assert time.perf_counter() - start < 0.5
+    assert plan["method"] == "hybrid"
+    assert plan["sources"] == [{"title": "Fee survey", "url": "https://example.com/fees"}]
+    assert plan["excerpt"] == "Overdraft fees average $27."
+    assert plan["metadata"]["branches"]["rag"]["status"] == "timeout"
+    assert plan["metadata"]["branches"]["rag"]["results"] == 0
+    assert plan["metadata"]["branches"]["search"]["status"] == "ok"
+
+
+class RecordingCache:
+    """Answer cache that never hits and records what gets stored"""
+
+    def __init__(self):
+        self.stored = []
+
+    def is_cacheable(self, query, query_type, history):
+        return True
+
+    async def lookup(self, query, query_type):
+        return None
+
+    async def store(self, query, query_type, result):
+        self.stored.append(result)
+
+
+class HybridRouter:
+    async def route(self, query, context):
+        return QueryType.HYBRID, {}
+
+
+class AnsweringLLM:
+    async def generate(self, messages):
+        return "The overdraft fee is $35."
+
+
+def test_hybrid_answer_with_a_timed_out_branch_is_not_cached(hybrid_agent, monkeypatch):
+    monkeypatch.setattr(settings, "TOOL_CALLING_ENABLED", False)
+    monkeypatch.setattr(settings, "HYBRID_SEARCH_TIMEOUT", 0.05)
+    hybrid_agent.router = HybridRouter()
+    hybrid_agent.llm = AnsweringLLM()
+    hybrid_agent.answer_cache = RecordingCache()
+
+    complete = asyncio.run(hybrid_agent.process_query("What is the overdraft fee?"))
+    assert [result["answer"] for result in hybrid_agent.answer_cache.stored] == [complete["answer"]]
+
+    hybrid_agent.delays["search"] = 5
+    partial = asyncio.run(hybrid_agent.process_query("What is the overdraft fee?"))
+    assert partial["metadata"]["branches"]["search"]["status"] == "timeout"
+    assert len(hybrid_agent.answer_cache.stored) == 1
+
+
+def test_registry_runs_calls_concurrently_in_call_order():
+    registry = make_registry(sleeper("slow", 0.2), sleeper("fast", 0.1))
+
+    start = time.perf_counter()
+    results = asyncio.run(registry.execute_all([
+        tool_call("1", "slow", query="fees"),
+        tool_call("2", "fast", query="rates")
+    ]))
+
+    assert time.perf_counter() - start < 0.35
+    assert [result["tool_call_id"] for result in results] == ["1", "2"]
+    assert [result["status"] for result in results] == ["ok", "ok"]
+    assert results[1]["sources"] == [{"source": "fast.pdf"}]
+
+
+def test_registry_turns_timeouts_and_bad_calls_into_error_results():
+    called = []
+
+    async def record(query):
+        called.append(query)
+        return []
+
+    registry = make_registry(sleeper("slow", 1.0, timeout=0.05), Tool("record", "", SCHEMA, record))
+    results = asyncio.run(registry.execute_all([
+        tool_call("1", "slow", query="fees"),
+        {"id": "2", "name": "record", "arguments": {}, "raw_arguments": "{bad", "error": "Invalid arguments"},
+        tool_call("3", "missing", query="x")
+    ]))
+
+    assert [result["status"] for result in results] == ["timeout", "invalid_arguments", "unknown_tool"]
+    assert "timed out" in results[0]["content"]
+    assert "Invalid arguments" in results[1]["content"]
+    assert all(result["sources"] == [] for result in results)
+    assert called == []
+
+
+def test_registry_packs_passages_into_the_token_budget():
+    first = "The overdraft fee is $35 per item. It is waived for balances under $5. " * 2
+
+    async def search(query):
+        return [{"text": first, "source": "fees.pdf"}, {"text": "Wires cut off at 5pm.", "source": "wires.pdf"}]
+
+    # Two 9-token sentences fill the budget; the second passage gets no room
+    registry = make_registry(Tool("search", "", SCHEMA, search), budget=18)
+    result = asyncio.run(registry.execute_all([tool_call("1", "search", query="fees")]))[0]
+
+    assert result["content"] == '[{"text": "The overdraft fee is $35 per item. It is waived for balances under $5.", "source": "fees.pdf"}]'
+    assert result["sources"] == [{"source": "fees.pdf"}]
+    assert result["tokens"] == 18
+
+
+def test_runner_feeds_tool_results_back_until_text():
+    registry = make_registry(sleeper("search", 0))
+    runner = ToolRunner(registry)
+    runner.llm = ScriptedLLM(
+        {"type": "tool_call", "tool_calls": [tool_call("1", "search", query="fees")]},
+        {"type": "text", "content": "The fee is $35."}
+    )
+
+    result = asyncio.run(runner.run([{"role": "user", "content": "What is the fee?"}]))
+
+    assert result["answer"] == "The fee is $35."
+    assert result["sources"] == [{"source": "search.pdf"}]
+    assert [call["status"] for call in result["tool_calls"]] == ["ok"]
+    second = runner.llm.calls[1]["messages"]
+    assert [message["role"] for message in second] == ["user", "assistant", "tool"]
+    assert second[2]["tool_call_id"] == "1"
+    # One hard deadline covers every completion of the loop
+    assert runner.llm.calls[0]["deadline"] == runner.llm.calls[1]["deadline"] is not None
+
+
+def test_runner_forces_a_text_answer_after_max_rounds():
+    runner = ToolRunner(make_registry(sleeper("search", 0)))
+    runner.max_rounds = 2
+    runner.llm = ScriptedLLM(
+        {"type": "tool_call", "tool_calls": [tool_call("1", "search", query="fees")]},
+        {"type": "tool_call", "tool_calls": [tool_call("2", "search", query="fees")]},
+        {"type": "text", "content": "Done."}
+    )
+
+    result = asyncio.run(runner.run([{"role": "user", "content": "fees"}]))
+
+    assert result["answer"] == "Done."
+    assert [call["tool_choice"] for call in runner.llm.calls] == [None, None, "none"]
+    assert len(result["tool_calls"]) == 2
+
+
+def test_search_documents_clamps_top_k(monkeypatch):
+    requested = []
+
+    class FakeRetriever:
+        async def retrieve(self, query, top_k):
+            requested.append(top_k)
+            return []
+
+    monkeypatch.setattr(tools, "retriever", FakeRetriever())
+    asyncio.run(tools.search_documents("fees", top_k=1000))
+    asyncio.run(tools.search_documents("fees", top_k=0))
+
+    assert requested == [tools.settings.RERANK_TOP_K, 1]
@@ -1 +1,451 @@
-# RAG unit tests
\ No newline at end of file
+# RAG unit tests
+import asyncio
+import json
+import time
+import types
+
+import numpy as np
+import pytest
+
+from app.config import settings
+from app.core.rag.ann_index import IVFIndex
+from app.core.rag.diversity import mmr_select
+from app.core.rag.embedding_server import EmbeddingClient, EmbeddingServer
+from app.core.rag.fusion import reciprocal_rank_fusion
+from app.core.rag.keyword_index import KeywordIndex, tokenize
+from app.core.rag.local_vector_store import LocalVectorStore
+from app.core.rag.reranker import CrossEncoderReranker
+from app.core.rag.retriever import HybridRetriever
+from app.core.rag.sentence_store import SentenceStore
+
+
+@pytest.fixture
+def exact_store(tmp_path, monkeypatch):
+    """Factory for 4-d exact local stores sharing one directory"""
+    monkeypatch.setattr(settings, "EMBEDDING_DIMENSION", 4)
+    monkeypatch.setattr(settings, "LOCAL_VECTOR_INDEX", "exact")
+    return lambda: LocalVectorStore(path=str(tmp_path), collection_name="test")
+
+
+def clustered_vectors(count, dimension=4, seed=0):
+    """Normalized vectors scattered around the coordinate axes"""
+    rng = np.random.default_rng(seed)
+    vectors = np.eye(dimension, dtype=np.float32)[np.arange(count) % dimension]
+    vectors += rng.normal(scale=0.05, size=vectors.shape).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class FakeCrossEncoder:
+    """Scores a pair by the length of its text; records every forward pass"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.passes = []
+
+    def predict(self, pairs, batch_size, show_progress_bar):
+        self.passes.append(list(pairs))
+        time.sleep(self.delay)
+        return np.array([len(text) for _, text in pairs], dtype=np.float32)
+
+
+@pytest.fixture
+def local_reranker(monkeypatch):
+    """Reranker with a fake in-process model and a generous budget"""
+    monkeypatch.setattr(settings, "RERANKER_ENABLED", True)
+    reranker = CrossEncoderReranker(budget_ms=2000, socket_path="")
+    reranker.model = FakeCrossEncoder()
+    return reranker
+
+
+def docs(*ids):
+    return [{"id": doc_id, "text": f"text {doc_id}"} for doc_id in ids]
+
+
+def test_rrf_ranks_documents_found_by_several_lists_first():
+    fused = reciprocal_rank_fusion([docs("a", "b", "c"), docs("c", "d", "a")], k=60)
+
+    assert [doc["id"] for doc in fused] == ["a", "c", "b", "d"]
+    assert fused[0]["rrf_score"] == pytest.approx(1 / 61 + 1 / 63)
+    assert fused[2]["rrf_score"] == pytest.approx(1 / 62)
+
+
+def test_rrf_weights_and_limit():
+    fused = reciprocal_rank_fusion([docs("a", "b"), docs("b", "c")], weights=[1.0, 3.0], limit=2)
+
+    assert [doc["id"] for doc in fused] == ["b", "c"]
+
+
+def test_rrf_keeps_the_first_copy_of_a_document():
+    first = {"id": 1, "text": "from vector search"}
+    fused = reciprocal_rank_fusion([[first], [{"id": "1", "text": "from keyword search"}]])
+
+    assert len(fused) == 1
+    assert fused[0]["text"] == "from vector search"
+
+
+def test_mmr_prefers_a_diverse_second_pick():
+    vectors = np.array([[1.0, 0.0], [0.9, 0.1], [0.0, 1.0]], dtype=np.float32)
+    relevance = np.array([1.0, 0.95, 0.8])
+
+    assert mmr_select(vectors, relevance, k=2, lambda_mult=0.5, duplicate_threshold=1.1) == [0, 2]
+    assert mmr_select(vectors, relevance, k=2, lambda_mult=1.0, duplicate_threshold=1.1) == [0, 1]
+
+
+def test_mmr_drops_near_duplicates():
+    vectors = np.array([[1.0, 0.0], [1.0, 0.001], [0.0, 1.0]], dtype=np.float32)
+
+    assert mmr_select(vectors, np.array([3.0, 2.0, 1.0]), k=3, duplicate_threshold=0.95) == [0, 2]
+
+
+def test_mmr_handles_empty_input_and_equal_relevance():
+    assert mmr_select(np.empty((0, 2)), np.empty(0), k=3) == []
+    vectors = np.eye(3, dtype=np.float32)
+    assert sorted(mmr_select(vectors, np.ones(3), k=5)) == [0, 1, 2]
+
+
+def test_tokenize_drops_stopwords_and_punctuation():
+    assert tokenize("What is the Wire-Transfer cutoff?") == ["wire", "transfer", "cutoff"]
+
+
+def test_keyword_index_ranks_exact_terms(tmp_path):
+    index = KeywordIndex(path=str(tmp_path / "keywords.json"))
+    index.add_documents(
+        ["1", "2", "3"],
+        ["Overdraft fee is $35 per item", "Wire transfer cutoff is 5pm", "Savings accounts earn interest"],
+        [{"category": "fees"}, {"category": "transfers"}, {"category": "accounts"}]
+    )
+
+    results = index.search("wire cutoff time")
+    assert [doc["id"] for doc in results] == ["2"]
+    assert results[0]["metadata"] == {"category": "transfers"}
+    assert index.search("wire", filters={"category": "fees"}) == []
+    assert index.search("mortgage") == []
+
+
+def test_keyword_index_reingest_replaces_terms(tmp_path):
+    index = KeywordIndex(path=str(tmp_path / "keywords.json"))
+    index.add_documents(["1"], ["overdraft fee"], [{}])
+    index.add_documents(["1"], ["monthly maintenance fee"], [{}])
+
+    assert index.count == 1
+    assert index.search("overdraft") == []
+    assert [doc["id"] for doc in index.search("maintenance")] == ["1"]
+
+
+def test_keyword_index_reloads_from_disk(tmp_path):
+    path = str(tmp_path / "keywords.json")
+    reader = KeywordIndex(path=path)
+    KeywordIndex(path=path).add_documents(["1", "2"], ["overdraft fee", "wire cutoff"], [{}, {}])
+
+    assert [doc["id"] for doc in reader.search("overdraft")] == ["1"]
+    assert reader.count == 2
+
+
+def test_keyword_index_defers_saving_and_stores_no_text(tmp_path):
+    path = tmp_path / "keywords.json"
+    writer = KeywordIndex(path=str(path))
+    writer.add_documents(["1"], ["overdraft fee"], [{"source": "fees.md"}], save=False)
+    writer.add_documents(["2"], ["wire cutoff"], [{"source": "wires.md"}], save=False)
+
+    assert not path.exists()
+    assert [doc["id"] for doc in writer.search("wire")] == ["2"]
+    writer.save()
+
+    assert KeywordIndex(path=str(path)).count == 2
+    stored = json.loads(path.read_text(encoding="utf-8"))["documents"]
+    assert stored["1"] == {"metadata": {"source": "fees.md"}, "terms": {"overdraft": 1, "fee": 1}}
+    assert "text" not in writer.search("overdraft")[0]
+
+
+def test_keyword_index_deletes_stale_chunks_of_a_source(tmp_path):
+    path = str(tmp_path / "keywords.json")
+    index = KeywordIndex(path=path)
+    index.add_documents(
+        ["1", "2", "3"],
+        ["overdraft fee", "old wire cutoff", "wire limits"],
+        [{"source": "fees.md"}, {"source": "fees.md"}, {"source": "wires.md"}]
+    )
+
+    assert index.delete_stale("fees.md", ["1"]) == ["2"]
+    assert [doc["id"] for doc in index.search("wire")] == ["3"]
+    assert KeywordIndex(path=path).count == 2
+    assert index.delete_stale("fees.md", ["1"]) == []
+
+
+def test_sentence_store_removes_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "EMBEDDING_DIMENSION", 4)
+    store = SentenceStore(path=str(tmp_path))
+    store.add(["a", "b"], [2, 1], clustered_vectors(3))
+    store.remove(["a", "missing"])
+
+    reader = SentenceStore(path=str(tmp_path))
+    assert reader.lookup(["a", "b"])[1] == [None, (2, 3)]
+    # A removed chunk that comes back is stored again
+    store.add(["a"], [1], clustered_vectors(1))
+    assert store.lookup(["a"])[1] == [(3, 4)]
+
+
+def test_local_store_search_and_filters(exact_store):
+    store = exact_store()
+    store.add_documents(
+        ["fees", "wires", "savings"],
+        np.eye(4, dtype=np.float32)[:3],
+        [{"doc_type": "faq"}, {"doc_type": "policy"}, {"doc_type": "faq"}],
+        ids=["a", "b", "c"]
+    )
+
+    results = store.search(np.array([0.1, 1.0, 0.0, 0.0]), limit=2)
+    assert [doc["id"] for doc in results] == ["b", "a"]
+    assert results[0]["text"] == "wires"
+    assert results[0]["metadata"] == {"doc_type": "policy"}
+    assert [doc["id"] for doc in store.search(np.array([0.1, 1.0, 0.0, 0.0]), filters={"doc_type": "faq"})] == ["a", "c"]
+
+
+def test_local_store_readd_is_idempotent(exact_store):
+    store = exact_store()
+    vectors = np.eye(4, dtype=np.float32)[:2]
+    store.add_documents(["one", "two"], vectors, [{}, {}], ids=["a", "b"])
+    store.add_documents(["one", "two"], vectors, [{}, {}], ids=["a", "b"])
+    store.add_documents(["two, revised"], np.array([[0.0, 0.0, 1.0, 0.0]]), [{"doc_type": "faq"}], ids=["b"])
+
+    assert store.count == 2
+    results = store.search(np.array([0.0, 0.0, 1.0, 0.0]), limit=1)
+    assert results[0]["id"] == "b"
+    assert results[0]["text"] == "two, revised"
+    assert results[0]["score"] == pytest.approx(1.0)
+
+
+def test_local_store_reingest_does_not_grow_payloads(exact_store, tmp_path):
+    store = exact_store()
+    vectors = np.eye(4, dtype=np.float32)[:2]
+    store.add_documents(["one", "two"], vectors, [{}, {}], ids=["a", "b"])
+    payloads = tmp_path / "test" / "payloads.bin"
+    size = payloads.stat().st_size
+
+    store.add_documents(["one", "two"], vectors, [{}, {}], ids=["a", "b"])
+    assert payloads.stat().st_size == size
+    assert [doc["text"] for doc in store.get_documents(["a", "b"])] == ["one", "two"]
+
+    store.add_documents(["two, revised"], vectors[1:], [{}], ids=["b"])
+    assert payloads.stat().st_size > size
+    assert store.get_documents(["b"])[0]["text"] == "two, revised"
+
+
+def test_local_store_appends_past_dead_bytes_until_compacted(exact_store, tmp_path):
+    store = exact_store()
+    store.add_documents(
+        ["fees", "old wires", "savings"],
+        np.eye(4, dtype=np.float32)[:3],
+        [{"source": "a.md"}, {"source": "b.md"}, {"source": "a.md"}],
+        ids=["a", "b", "c"]
+    )
+    store.delete_stale("b.md", [])
+    payloads = tmp_path / "test" / "payloads.bin"
+    before = payloads.read_bytes()
+
+    # Spans of a reader still on the old manifest stay intact
+    store.add_documents(["new wires"], np.eye(4, dtype=np.float32)[3:], [{"source": "b.md"}], ids=["d"])
+    assert payloads.read_bytes().startswith(before)
+    assert store.compact(min_dead_ratio=0.9) == 0
+
+    reclaimed = store.compact(min_dead_ratio=0)
+    assert reclaimed > 0
+    assert payloads.stat().st_size == len(before) + len(b'{"text": "new wires", "source": "b.md"}') - reclaimed
+    reader = exact_store()
+    assert [doc["text"] for doc in reader.get_documents(["a", "c", "d"])] == ["fees", "savings", "new wires"]
+    assert store.compact(min_dead_ratio=0) == 0
+
+
+def test_local_store_deletes_stale_chunks_of_a_source(exact_store):
+    store = exact_store()
+    store.add_documents(
+        ["fees", "old fees", "wires", "new fees"],
+        np.eye(4, dtype=np.float32),
+        [{"source": "fees.md"}, {"source": "fees.md"}, {"source": "wires.md"}, {"source": "fees.md"}],
+        ids=["a", "b", "c", "d"]
+    )
+
+    assert store.delete_stale("fees.md", ["a", "d"]) == ["b"]
+    reader = exact_store()
+    assert reader.ids == ["a", "c", "d"]
+    results = reader.search(np.array([0.0, 0.0, 0.0, 1.0]), limit=1)
+    assert (results[0]["id"], results[0]["text"]) == ("d", "new fees")
+    assert [doc["id"] for doc in reader.search(np.ones(4), filters={"source": "fees.md"})] == ["a", "d"]
+    np.testing.assert_allclose(reader.get_vectors(["b"]), np.zeros((1, 4)))
+
+    store.add_documents(["more wires"], np.array([[0.0, 1.0, 0.0, 0.0]]), [{"source": "wires.md"}], ids=["e"])
+    assert store.search(np.array([0.0, 1.0, 0.0, 0.0]), limit=1)[0]["text"] == "more wires"
+
+
+def test_local_store_get_documents(exact_store):
+    store = exact_store()
+    store.add_documents(["fees"], np.eye(4, dtype=np.float32)[:1], [{"source": "fees.md"}], ids=["a"])
+
+    assert store.get_documents(["missing", "a"]) == [None, {"id": "a", "text": "fees", "metadata": {"source": "fees.md"}}]
+
+
+def test_retriever_fetches_texts_of_keyword_only_hits(exact_store):
+    store = exact_store()
+    store.add_documents(["wire cutoff is 5pm"], np.eye(4, dtype=np.float32)[:1], [{}], ids=["k"])
+    retriever = HybridRetriever.__new__(HybridRetriever)
+    retriever.vector_store = store
+    documents = [{"id": "v", "text": "from vector search"}, {"id": "k", "metadata": {}}, {"id": "gone", "metadata": {}}]
+
+    hydrated = asyncio.run(retriever._hydrate(documents))
+    assert [(doc["id"], doc["text"]) for doc in hydrated] == [("v", "from vector search"), ("k", "wire cutoff is 5pm")]
+
+
+def test_local_store_reloads_rows_written_elsewhere(exact_store):
+    reader = exact_store()
+    exact_store().add_documents(["one"], np.array([[3.0, 4.0, 0.0, 0.0]]), [{"source": "faq.pdf"}], ids=["a"])
+
+    results = reader.search(np.array([3.0, 4.0, 0.0, 0.0]))
+    assert [doc["id"] for doc in results] == ["a"]
+    assert results[0]["score"] == pytest.approx(1.0)
+    np.testing.assert_allclose(reader.get_vectors(["a", "missing"]), [[0.6, 0.8, 0.0, 0.0], [0.0] * 4], atol=1e-6)
+
+
+def test_ivf_candidates_come_from_the_closest_lists(tmp_path):
+    vectors = clustered_vectors(40)
+    index = IVFIndex(tmp_path, 4, nlist=4, nprobe=1)
+    index.train(vectors)
+
+    candidates = index.candidates(vectors[0])
+    assert 0 in candidates
+    assert set(candidates) == {row for row in range(40) if row % 4 == 0}
+    assert len(index.candidates(vectors[0], nprobe=4)) == 40
+
+
+def test_ivf_add_update_and_reload(tmp_path):
+    vectors = clustered_vectors(40)
+    index = IVFIndex(tmp_path, 4, nlist=4, nprobe=1)
+    index.train(vectors[:36])
+    index.add(vectors[36:])
+    index.update(np.array([0]), vectors[1:2])
+    index.save()
+
+    reloaded = IVFIndex(tmp_path, 4, nlist=4, nprobe=1)
+    assert reloaded.load()
+    np.testing.assert_array_equal(reloaded.assignments, index.assignments)
+    assert 39 in reloaded.candidates(vectors[39])
+    assert 0 in reloaded.candidates(vectors[1])
+    assert not IVFIndex(tmp_path, 8).load()
+
+
+def test_local_store_trains_ivf_and_keeps_it_in_step(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "EMBEDDING_DIMENSION", 4)
+    monkeypatch.setattr(settings, "LOCAL_VECTOR_INDEX", "ivf")
+    monkeypatch.setattr(settings, "IVF_MIN_TRAIN_SIZE", 20)
+    monkeypatch.setattr(settings, "IVF_NLIST", 4)
+    monkeypatch.setattr(settings, "IVF_NPROBE", 1)
+    vectors = clustered_vectors(30)
+    ids = [str(i) for i in range(30)]
+    store = LocalVectorStore(path=str(tmp_path), collection_name="test")
+    store.add_documents([f"doc {i}" for i in ids[:10]], vectors[:10], [{}] * 10, ids=ids[:10])
+    assert not store.index.is_trained
+
+    store.add_documents([f"doc {i}" for i in ids[10:]], vectors[10:], [{}] * 20, ids=ids[10:])
+    assert store.index.is_trained
+    store.add_documents(["late"], clustered_vectors(31)[30:], [{}], ids=["30"])
+
+    reloaded = LocalVectorStore(path=str(tmp_path), collection_name="test")
+    assert reloaded.index.is_trained
+    assert len(reloaded.index.assignments) == 31
+    assert reloaded.search(vectors[7], limit=1)[0]["id"] == "7"
+    assert reloaded.search(clustered_vectors(31)[30], limit=1)[0]["id"] == "30"
+
+
+def test_local_store_deletion_keeps_ivf_in_step(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "EMBEDDING_DIMENSION", 4)
+    monkeypatch.setattr(settings, "LOCAL_VECTOR_INDEX", "ivf")
+    monkeypatch.setattr(settings, "IVF_MIN_TRAIN_SIZE", 20)
+    monkeypatch.setattr(settings, "IVF_NLIST", 4)
+    monkeypatch.setattr(settings, "IVF_NPROBE", 1)
+    vectors = clustered_vectors(30)
+    ids = [str(i) for i in range(30)]
+    store = LocalVectorStore(path=str(tmp_path), collection_name="test")
+    store.add_documents([f"doc {i}" for i in ids], vectors, [{"source": "s"}] * 30, ids=ids)
+
+    assert store.delete_stale("s", [i for i in ids if i != "3"]) == ["3"]
+    reloaded = LocalVectorStore(path=str(tmp_path), collection_name="test")
+    assert len(reloaded.index.assignments) == 29
+    assert reloaded.search(vectors[7], limit=1)[0]["id"] == "7"
+    assert reloaded.search(vectors[29], limit=1)[0]["id"] == "29"
+    assert "3" not in [doc["id"] for doc in reloaded.search(vectors[3], limit=10)]
+
+
+def test_reranker_orders_by_score(local_reranker):
+    documents = [{"id": "a", "text": "x"}, {"id": "b", "text": "xxx"}, {"id": "c", "text": "xx"}]
+    ranked = asyncio.run(local_reranker.rerank("fees", documents, top_k=2))
+
+    assert [doc["id"] for doc in ranked] == ["b", "c"]
+    assert ranked[0]["rerank_score"] == 3.0
+
+
+def test_reranker_batches_concurrent_requests(local_reranker):
+    async def scenario():
+        return await asyncio.gather(
+            local_reranker.rerank("fees", [{"text": "a"}, {"text": "bb"}], top_k=2),
+            local_reranker.rerank("wires", [{"text": "ccc"}, {"text": "d"}], top_k=2)
+        )
+
+    first, second = asyncio.run(scenario())
+    assert [doc["text"] for doc in first] == ["bb", "a"]
+    assert [doc["text"] for doc in second] == ["ccc", "d"]
+    assert len(local_reranker.model.passes) == 1
+    assert len(local_reranker.model.passes[0]) == 4
+
+
+def test_reranker_keeps_fused_order_past_budget_and_warms_cache(local_reranker):
+    local_reranker.model.delay = 0.2
+    local_reranker.budget = 0.02
+    documents = [{"text": "a"}, {"text": "bb"}]
+
+    async def scenario():
+        fused = await local_reranker.rerank("fees", [dict(doc) for doc in documents], top_k=2)
+        await asyncio.sleep(0.3)  # the pass finishes in the background
+        warm = await local_reranker.rerank("fees", [dict(doc) for doc in documents], top_k=2)
+        return fused, warm
+
+    fused, warm = asyncio.run(scenario())
+    assert [doc["text"] for doc in fused] == ["a", "bb"]
+    assert [doc["text"] for doc in warm] == ["bb", "a"]
+    assert len(local_reranker.model.passes) == 1
+
+
+def test_reranker_model_load_is_not_charged_to_the_budget(monkeypatch):
+    monkeypatch.setattr(settings, "RERANKER_ENABLED", True)
+    reranker = CrossEncoderReranker(budget_ms=50, socket_path="")
+
+    def slow_load():
+        if reranker.model is None:
+            time.sleep(0.2)
+            reranker.model = FakeCrossEncoder()
+        return reranker.model
+    reranker.load = slow_load
+
+    ranked = asyncio.run(reranker.rerank("fees", [{"text": "a"}, {"text": "bb"}], top_k=2))
+    assert [doc["text"] for doc in ranked] == ["bb", "a"]
+
+
+def test_reranker_client_never_loads_model_and_scores_on_server(tmp_path, local_reranker):
+    socket_path = str(tmp_path / "embed.sock")
+    client_reranker = CrossEncoderReranker(budget_ms=2000, socket_path=socket_path)
+
+    async def scenario():
+        service = types.SimpleNamespace(model_name="fake-embedder")
+        server = EmbeddingServer(service, socket_path, reranker=local_reranker)
+        serving = asyncio.ensure_future(server.serve())
+        while not (tmp_path / "embed.sock").exists():
+            await asyncio.sleep(0.01)
+        try:
+            return await client_reranker.rerank("fees", [{"text": "a"}, {"text": "bbb"}], top_k=2)
+        finally:
+            assert not serving.done()
+            serving.cancel()
+
+    ranked = asyncio.run(scenario())
+    assert [doc["text"] for doc in ranked] == ["bbb", "a"]
+    assert client_reranker.model is None
+    assert len(local_reranker.model.passes) == 1
+    assert isinstance(client_reranker.remote, EmbeddingClient)
@@ -0,0 +1,129 @@
+# Session unit tests
+import asyncio
+
+import pytest
+
+from app.config import settings
+from app.core.llm.context_packer import ContextPacker, TokenCounter
+from app.core.session.manager import SessionManager
+from app.core.session.summarizer import ConversationSummarizer
+
+
+class FakeLLM:
+    """Returns a numbered summary and records every prompt"""
+
+    def __init__(self):
+        self.prompts = []
+
+    async def generate(self, messages, temperature=None, max_tokens=None, priority=None):
+        self.prompts.append(messages[0]["content"])
+        return f" summary {len(self.prompts)} "
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    """Summarizer over an in-memory session store, window 6, keeping 2"""
+    monkeypatch.setattr(settings, "SUMMARY_ENABLED", True)
+    monkeypatch.setattr(settings, "SUMMARY_WINDOW_MESSAGES", 6)
+    monkeypatch.setattr(settings, "SUMMARY_KEEP_MESSAGES", 2)
+    sessions = SessionManager.__new__(SessionManager)
+    sessions.redis_client = None
+    sessions.memory_storage = {}
+    sessions.memory_summaries = {}
+    summarizer = ConversationSummarizer()
+    summarizer.session_manager = sessions
+    summarizer.llm = FakeLLM()
+    return summarizer
+
+
+def add_turns(summarizer, first, count):
+    """Add count user/assistant turns numbered from first"""
+    for turn in range(first, first + count):
+        summarizer.session_manager.add_message("s", "user", f"question {turn}")
+        summarizer.session_manager.add_message("s", "assistant", f"answer {turn}")
+
+
+def test_no_fold_while_history_fits_the_window(summarizer):
+    add_turns(summarizer, 1, 3)
+    asyncio.run(summarizer.update("s"))
+
+    assert summarizer.llm.prompts == []
+    history = summarizer.build_history("s")
+    assert [message["content"] for message in history][0] == "question 1"
+    assert len(history) == 6
+
+
+def test_fold_covers_all_but_the_kept_messages(summarizer):
+    add_turns(summarizer, 1, 4)
+    asyncio.run(summarizer.update("s"))
+
+    assert len(summarizer.llm.prompts) == 1
+    assert "question 1" in summarizer.llm.prompts[0] and "answer 3" in summarizer.llm.prompts[0]
+    assert "question 4" not in summarizer.llm.prompts[0]
+    assert summarizer.session_manager.get_summary("s") == {"summary": "summary 1", "summarized": 6}
+
+
+def test_folds_are_batched_across_turns(summarizer):
+    add_turns(summarizer, 1, 4)
+    asyncio.run(summarizer.update("s"))
+    for turn in range(5, 8):
+        add_turns(summarizer, turn, 1)
+        asyncio.run(summarizer.update("s"))
+
+    # Turns 5 and 6 fit the window next to the kept turn 4; turn 7 triggers the second fold
+    assert len(summarizer.llm.prompts) == 2
+    assert "summary 1" in summarizer.llm.prompts[1]
+    assert summarizer.session_manager.get_summary("s")["summarized"] == 12
+
+
+def test_build_history_puts_the_summary_first(summarizer):
+    add_turns(summarizer, 1, 4)
+    asyncio.run(summarizer.update("s"))
+    add_turns(summarizer, 5, 1)
+
+    history = summarizer.build_history("s")
+    assert history[0] == {"role": "system", "content": "Summary of the earlier conversation: summary 1"}
+    assert [message["content"] for message in history[1:]] == ["question 4", "answer 4", "question 5", "answer 5"]
+    # Messages the summary does not cover are kept even past max_messages
+    assert len(summarizer.build_history("s", max_messages=2)) == 5
+
+
+def test_build_history_keeps_messages_of_a_failed_fold(summarizer):
+    async def fail(messages, **kwargs):
+        raise RuntimeError("LLM down")
+    summarizer.llm.generate = fail
+    add_turns(summarizer, 1, 5)
+    asyncio.run(summarizer.update("s"))
+
+    assert summarizer.session_manager.get_summary("s")["summarized"] == 0
+    history = summarizer.build_history("s")
+    assert len(history) == 10
+    assert history[0]["content"] == "question 1"
+
+
+def test_build_history_without_summaries_returns_the_window(summarizer, monkeypatch):
+    monkeypatch.setattr(settings, "SUMMARY_ENABLED", False)
+    add_turns(summarizer, 1, 4)
+    asyncio.run(summarizer.update("s"))
+
+    history = summarizer.build_history("s")
+    assert summarizer.llm.prompts == []
+    assert [message["content"] for message in history][:2] == ["question 2", "answer 2"]
+    assert len(history) == 6
+
+
+def test_every_unsummarized_message_reaches_the_packed_prompt(summarizer):
+    add_turns(summarizer, 1, 5)
+    asyncio.run(summarizer.update("s"))
+    add_turns(summarizer, 6, 2)
+    asyncio.run(summarizer.update("s"))
+
+    # A full window of unsummarized messages, not yet folded
+    assert summarizer.session_manager.get_summary("s")["summarized"] == 8
+    packer = ContextPacker(budget=1000, item_max_tokens=300, counter=TokenCounter(margin=1.0))
+    packed = packer.pack([], summarizer.build_history("s"))
+
+    assert [message["content"] for message in packed["history"]] == [
+        "Summary of the earlier conversation: summary 1",
+        "question 5", "answer 5", "question 6", "answer 6", "question 7", "answer 7"
+    ]